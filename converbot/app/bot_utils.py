@@ -1,10 +1,17 @@
+import asyncio
+import contextlib
 from pathlib import Path
+from typing import AsyncIterator, Optional
 
+from aiogram import Bot, types
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter
+
+from converbot.constants import EMPTY_MESSAGE
 from converbot.core import GPT3Conversation
 from converbot.prompt.prompt import ConversationPrompt
 
 
-def create_conversation(
+async def create_conversation(
     prompt: ConversationPrompt,
     tone: str,
     config_path: Path,
@@ -18,5 +25,92 @@ def create_conversation(
         config_path: The path to the configuration file.
     """
     conversation = GPT3Conversation.from_config_file(prompt, config_path)
-    conversation.set_tone(tone)
+    await conversation.aset_tone(tone)
     return conversation
+
+
+async def send_streaming_message(
+    bot: Bot,
+    chat_id: int,
+    chunks: AsyncIterator[str],
+    min_edit_interval: float = 1.0,
+    reply_markup: Optional[types.ReplyKeyboardMarkup] = None,
+    max_final_edit_attempts: int = 3,
+) -> str:
+    """
+    Send a message as soon as its first chunk arrives and edit it as the rest
+    of the chunks arrive, at most once per `min_edit_interval` seconds.
+
+    When Telegram asks to slow down the edits, the intermediate edits are
+    skipped until it allows them again, and the final one waits for it.
+
+    Args:
+        bot: The Telegram bot.
+        chat_id: The chat to send the message to.
+        chunks: The message chunks.
+        min_edit_interval: The minimum number of seconds between two edits.
+        reply_markup: The keyboard to send with the message.
+        max_final_edit_attempts: The maximum number of attempts of the edit
+            sending the full text.
+
+    Returns: The full message text.
+    """
+    loop = asyncio.get_running_loop()
+    text = ""
+    sent_text = ""
+    message = None
+    last_sent_at = 0.0
+    edits_allowed_at = 0.0
+
+    # Closed even when sending fails, which cancels the generation.
+    async with contextlib.aclosing(chunks):
+        async for chunk in chunks:
+            text += chunk
+            if not text.strip():
+                continue
+            if message is None:
+                message = await bot.send_message(
+                    chat_id, text=text, reply_markup=reply_markup
+                )
+            elif (
+                loop.time() - last_sent_at >= min_edit_interval
+                and loop.time() >= edits_allowed_at
+                # Telegram ignores the trailing whitespace.
+                and text.strip() != sent_text.strip()
+            ):
+                try:
+                    await bot.edit_message_text(
+                        text, chat_id=chat_id, message_id=message.message_id
+                    )
+                except MessageNotModified:
+                    pass
+                except RetryAfter as e:
+                    edits_allowed_at = loop.time() + e.timeout
+                    continue
+            else:
+                continue
+            sent_text = text
+            last_sent_at = loop.time()
+
+    if message is None:
+        await bot.send_message(
+            chat_id, text=EMPTY_MESSAGE, reply_markup=reply_markup
+        )
+        return text
+
+    for attempt in range(max_final_edit_attempts):
+        if text.strip() == sent_text.strip():
+            break
+        await asyncio.sleep(max(0.0, edits_allowed_at - loop.time()))
+        try:
+            await bot.edit_message_text(
+                text, chat_id=chat_id, message_id=message.message_id
+            )
+        except MessageNotModified:
+            break
+        except RetryAfter as e:
+            print(e)
+            edits_allowed_at = loop.time() + e.timeout
+            continue
+        sent_text = text
+    return text
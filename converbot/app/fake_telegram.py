@@ -0,0 +1,233 @@
+import argparse
+import asyncio
+import itertools
+import time
+from typing import Any, Dict, List, Optional
+
+from aiohttp import ClientSession, web
+
+from converbot.app.webhook import SECRET_TOKEN_HEADER
+
+
+class FakeTelegram:
+    """
+    A local stand-in for Telegram to drive a webhook deployment in tests.
+
+    It serves a fake Bot API recording the calls of the bot, point the bot at
+    it with `--telegram_api_url`, and sends fake message updates to the
+    webhook.
+
+    Args:
+        webhook_url: The full url of the webhook.
+        secret_token: The secret token to send with the updates.
+    """
+
+    def __init__(self, webhook_url: str, secret_token: Optional[str] = None) -> None:
+        self._webhook_url = webhook_url
+        self._secret_token = secret_token
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self.calls: List[Dict[str, Any]] = []
+        self.replies: Dict[int, List[str]] = {}
+        self._reply_event = asyncio.Event()
+
+    def create_app(self) -> web.Application:
+        """
+        Create the fake Bot API web application.
+        """
+
+        async def call(request: web.Request) -> web.Response:
+            method = request.match_info["method"].lower()
+            if request.content_type == "application/json":
+                data = await request.json()
+            else:
+                data = dict(await request.post())
+            self.calls.append({"method": method, **data})
+
+            result: Any = True
+            if method == "getme":
+                result = {"id": 1, "is_bot": True, "first_name": "Bot", "username": "bot"}
+            elif method in ("sendmessage", "editmessagetext"):
+                chat_id = int(data["chat_id"])
+                if method == "sendmessage":
+                    self.replies.setdefault(chat_id, []).append(data["text"])
+                    self._reply_event.set()
+                result = {
+                    "message_id": int(data.get("message_id") or next(self._message_ids)),
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "text": data["text"],
+                }
+            return web.json_response({"ok": True, "result": result})
+
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", call)
+        return app
+
+    def make_update(self, user_id: int, text: str) -> Dict[str, Any]:
+        """
+        Make a private text message update.
+
+        Args:
+            user_id: The id of the sending user.
+            text: The message text.
+        """
+        user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "from": user,
+                "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+                "text": text,
+            },
+        }
+
+    async def send_update(self, session: ClientSession, update: Dict[str, Any]) -> float:
+        """
+        Send an update to the webhook.
+
+        Returns: The number of seconds the webhook took to acknowledge it.
+        """
+        headers = {}
+        if self._secret_token is not None:
+            headers[SECRET_TOKEN_HEADER] = self._secret_token
+        start = time.perf_counter()
+        async with session.post(self._webhook_url, json=update, headers=headers) as response:
+            response.raise_for_status()
+        return time.perf_counter() - start
+
+    async def wait_for_replies(self, count: int, timeout: float) -> int:
+        """
+        Wait until the bot sent `count` messages in total.
+
+        Returns: The number of messages sent by the bot.
+        """
+        deadline = time.monotonic() + timeout
+        while sum(map(len, self.replies.values())) < count:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._reply_event.clear()
+            try:
+                await asyncio.wait_for(self._reply_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return sum(map(len, self.replies.values()))
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile))]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--webhook_url",
+        help="Full url of the webhook to send the updates to",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "--webhook_secret",
+        help="Secret token to send with the updates",
+        type=str,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--api_port",
+        help="Port to serve the fake Bot API on",
+        type=int,
+        required=False,
+        default=8090,
+    )
+    parser.add_argument(
+        "--users",
+        help="Number of users sending messages",
+        type=int,
+        required=False,
+        default=10,
+    )
+    parser.add_argument(
+        "--messages",
+        help="Number of messages sent by every user",
+        type=int,
+        required=False,
+        default=5,
+    )
+    parser.add_argument(
+        "--first_user_id",
+        help="Id of the first user",
+        type=int,
+        required=False,
+        default=1000,
+    )
+    parser.add_argument(
+        "--text",
+        help="Text of the messages",
+        type=str,
+        required=False,
+        default="Hello!",
+    )
+    parser.add_argument(
+        "--reply_timeout",
+        help="Seconds to wait for the replies after sending the updates",
+        type=float,
+        required=False,
+        default=60.0,
+    )
+    return parser.parse_args()
+
+
+async def run(args) -> None:
+    fake_telegram = FakeTelegram(args.webhook_url, args.webhook_secret)
+    runner = web.AppRunner(fake_telegram.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.api_port).start()
+    print(f"Fake Bot API at http://127.0.0.1:{args.api_port}")
+
+    user_ids = range(args.first_user_id, args.first_user_id + args.users)
+
+    async def send_messages(session: ClientSession, user_id: int) -> List[float]:
+        # A user sends the next message once the previous one is acknowledged.
+        return [
+            await fake_telegram.send_update(
+                session, fake_telegram.make_update(user_id, args.text)
+            )
+            for _ in range(args.messages)
+        ]
+
+    try:
+        async with ClientSession() as session:
+            start = time.perf_counter()
+            latencies = list(
+                itertools.chain.from_iterable(
+                    await asyncio.gather(
+                        *(send_messages(session, user_id) for user_id in user_ids)
+                    )
+                )
+            )
+            elapsed = time.perf_counter() - start
+        replies = await fake_telegram.wait_for_replies(
+            len(latencies), args.reply_timeout
+        )
+    finally:
+        await runner.cleanup()
+
+    print(f"Updates sent: {len(latencies)} in {elapsed:.2f}s")
+    print(
+        f"Ack latency p50: {_percentile(latencies, 0.5) * 1000:.1f}ms, "
+        f"p95: {_percentile(latencies, 0.95) * 1000:.1f}ms"
+    )
+    print(f"Replies received: {replies}")
+
+
+def main():
+    asyncio.run(run(parse_args()))
+
+
+if __name__ == "__main__":
+    main()
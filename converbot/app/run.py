@@ -1,22 +1,69 @@
 import argparse
 import asyncio
+import functools
 import json
 import os
 from pathlib import Path
 
 import aioschedule
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import KeyboardButton
 from aiogram.utils import executor
+from aiohttp import web
 
-from converbot.app.bot_utils import create_conversation
-from converbot.constants import PROD_ENV, DEV_ENV
+from converbot.app.bot_utils import (
+    create_conversation,
+    send_streaming_message,
+)
+from converbot.app.webhook import DEFAULT_WEBHOOK_PATH, create_webhook_app
+from converbot.config.gptconversation import GPT3ConversationConfig
+from converbot.constants import (
+    DEV_ENV,
+    JOURNAL_STORAGE,
+    PROD_ENV,
+    SNAPSHOT_STORAGE,
+)
+from converbot.database.batched_writer import BatchedHistoryWriter
+from converbot.database.checkpoint_store import (
+    CHECKPOINT_BACKENDS,
+    FILE_CHECKPOINT_BACKEND,
+    POSTGRES_CHECKPOINT_BACKEND,
+    PostgresCheckpointStore,
+)
 from converbot.database.conversations import ConversationDB
 from converbot.database.history_writer import SQLHistoryWriter
+from converbot.database.postgres import DB_TRANSIENT_ERRORS
+from converbot.llm import (
+    CHAT_PRIORITY,
+    LLM_TRANSIENT_ERRORS,
+    ONBOARDING_PRIORITY,
+    BatchingDispatcher,
+    LLMBusyError,
+    LLMScheduler,
+    close_http_session,
+    get_batching_dispatcher,
+    get_tokenizer,
+    is_overload_error,
+    open_http_session,
+    set_batching_dispatcher,
+    set_llm_priority,
+    set_llm_retry_policy,
+    set_llm_scheduler,
+    set_llm_user,
+)
 from converbot.prompt.generator import ConversationalPromptGenerator
+from converbot.serialization.checkpoint import (
+    BINARY_CHECKPOINT_SUFFIX,
+    JSON_CHECKPOINT_SUFFIX,
+)
+from converbot.sharding import ShardWorker
+from converbot.sharding.dispatcher import LOOPBACK_HOSTS
+from converbot.utils.keyed_executor import KeyedExecutor
+from converbot.utils.retry import CircuitBreaker, RetryPolicy
 
 
 def parse_args():
@@ -50,19 +97,351 @@ def parse_args():
         required=False,
         default=DEV_ENV,
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--http_pool_size",
+        help="Maximum number of pooled connections to the OpenAI API",
+        type=int,
+        required=False,
+        default=100,
+    )
+    parser.add_argument(
+        "--stream",
+        help="Stream replies by editing the message as tokens arrive",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stream_edit_interval",
+        help="Minimum number of seconds between two streamed message edits",
+        type=float,
+        required=False,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--batch_window_ms",
+        help="Milliseconds to collect concurrent completions into one request "
+             "(0 disables batching)",
+        type=int,
+        required=False,
+        default=0,
+    )
+    parser.add_argument(
+        "--batch_max_size",
+        help="Maximum number of completions in one batched request",
+        type=int,
+        required=False,
+        default=16,
+    )
+    parser.add_argument(
+        "--max_live_conversations",
+        help="Maximum number of conversations kept in memory, the least "
+             "recently used ones are saved and evicted",
+        type=int,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--storage_mode",
+        help="Rewrite the conversation checkpoint or append to its journal "
+             "after every message",
+        type=str,
+        choices=[SNAPSHOT_STORAGE, JOURNAL_STORAGE],
+        required=False,
+        default=SNAPSHOT_STORAGE,
+    )
+    parser.add_argument(
+        "--journal_compaction_interval",
+        help="Number of journal records folded into a new checkpoint",
+        type=int,
+        required=False,
+        default=100,
+    )
+    parser.add_argument(
+        "--checkpoint_format",
+        help="Format of the written conversation checkpoints",
+        type=str,
+        choices=["json", "binary"],
+        required=False,
+        default="json",
+    )
+    parser.add_argument(
+        "--checkpoint_backend",
+        help="Where the conversation checkpoints are stored",
+        type=str,
+        choices=CHECKPOINT_BACKENDS,
+        required=False,
+        default=FILE_CHECKPOINT_BACKEND,
+    )
+    parser.add_argument(
+        "--checkpoint_store_config_path",
+        help="Path to the SQL config of the postgres checkpoint backend, "
+             "the history SQL config by default",
+        type=str,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--flush_interval",
+        help="Seconds between two writes of the changed conversations",
+        type=int,
+        required=False,
+        default=10,
+    )
+    parser.add_argument(
+        "--max_dirty_age",
+        help="Seconds a changed conversation waits before it is written, "
+             "coalescing the writes of rapid messages",
+        type=float,
+        required=False,
+        default=30.0,
+    )
+    parser.add_argument(
+        "--history_batch_size",
+        help="The maximum number of history rows written in one insert",
+        type=int,
+        required=False,
+        default=500,
+    )
+    parser.add_argument(
+        "--history_flush_interval",
+        help="The maximum number of seconds a history row waits to be written",
+        type=float,
+        required=False,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--history_queue_size",
+        help="The maximum number of history rows waiting to be written",
+        type=int,
+        required=False,
+        default=10000,
+    )
+    parser.add_argument(
+        "--llm_max_attempts",
+        help="Maximum number of attempts of an LLM call failing transiently",
+        type=int,
+        required=False,
+        default=4,
+    )
+    parser.add_argument(
+        "--llm_failure_threshold",
+        help="Number of consecutive failed LLM calls after which the calls "
+             "fail fast",
+        type=int,
+        required=False,
+        default=5,
+    )
+    parser.add_argument(
+        "--llm_reset_timeout",
+        help="Seconds the LLM calls fail fast before one is tried again",
+        type=float,
+        required=False,
+        default=30.0,
+    )
+    parser.add_argument(
+        "--llm_requests_per_minute",
+        help="Maximum number of LLM calls per minute, 0 to not schedule "
+             "the calls",
+        type=int,
+        required=False,
+        default=3000,
+    )
+    parser.add_argument(
+        "--llm_tokens_per_minute",
+        help="Maximum number of estimated prompt and completion tokens of "
+             "the LLM calls per minute",
+        type=int,
+        required=False,
+        default=250000,
+    )
+    parser.add_argument(
+        "--llm_max_wait",
+        help="Seconds an LLM call waits for capacity before the user is "
+             "told the bot is busy",
+        type=float,
+        required=False,
+        default=20.0,
+    )
+    parser.add_argument(
+        "--history_max_attempts",
+        help="Maximum number of attempts of a history batch write",
+        type=int,
+        required=False,
+        default=3,
+    )
+    parser.add_argument(
+        "--mode",
+        help="How the Telegram updates are received",
+        type=str,
+        choices=["polling", "webhook"],
+        required=False,
+        default="polling",
+    )
+    parser.add_argument(
+        "--webhook_host",
+        help="Host the webhook server listens on",
+        type=str,
+        required=False,
+        default="0.0.0.0",
+    )
+    parser.add_argument(
+        "--webhook_port",
+        help="Port the webhook server listens on",
+        type=int,
+        required=False,
+        default=8443,
+    )
+    parser.add_argument(
+        "--webhook_path",
+        help="Path the webhook server receives the updates on",
+        type=str,
+        required=False,
+        default=DEFAULT_WEBHOOK_PATH,
+    )
+    parser.add_argument(
+        "--webhook_url",
+        help="Public base url of the webhook to register with Telegram, "
+             "not registered if omitted",
+        type=str,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--webhook_secret",
+        help="Secret token Telegram sends with the webhook requests",
+        type=str,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--telegram_api_url",
+        help="Base url of the Telegram Bot API, e.g. a local fake",
+        type=str,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--dispatcher_url",
+        help="Comma separated base urls of the shard dispatchers, "
+             "runs as a shard worker if set",
+        type=str,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--shard_host",
+        help="Host the shard worker listens on",
+        type=str,
+        required=False,
+        default="127.0.0.1",
+    )
+    parser.add_argument(
+        "--shard_port",
+        help="Port the shard worker listens on",
+        type=int,
+        required=False,
+        default=8081,
+    )
+    parser.add_argument(
+        "--shard_secret",
+        help="Secret the shard dispatchers and workers authenticate each "
+             "other with, required unless they only listen on the loopback",
+        type=str,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--shard_url",
+        help="Base url the dispatcher reaches the shard worker at, "
+             "http://{shard_host}:{shard_port} by default",
+        type=str,
+        required=False,
+        default=None,
+    )
+    args = parser.parse_args()
+    if (
+        args.dispatcher_url is not None
+        and args.shard_secret is None
+        and args.shard_host not in LOOPBACK_HOSTS
+    ):
+        parser.error("--shard_secret is required to listen beyond the loopback")
+    return args
 
 
 args = parse_args()
 
-HISTORY_WRITER = SQLHistoryWriter.from_config(Path(args.sql_config_path))
+# Set before any LLM is created, so the OpenAI LLMs leave it the retries.
+set_llm_retry_policy(
+    RetryPolicy(
+        max_attempts=args.llm_max_attempts,
+        transient_errors=LLM_TRANSIENT_ERRORS,
+        breaker=CircuitBreaker(
+            failure_threshold=args.llm_failure_threshold,
+            reset_timeout=args.llm_reset_timeout,
+            name="OpenAI API",
+            transient_errors=LLM_TRANSIENT_ERRORS,
+        ),
+    )
+)
+
+if args.llm_requests_per_minute > 0:
+    set_llm_scheduler(
+        LLMScheduler(
+            requests_per_minute=args.llm_requests_per_minute,
+            tokens_per_minute=args.llm_tokens_per_minute,
+            max_wait=args.llm_max_wait,
+        )
+    )
+
+if args.batch_window_ms > 0:
+    set_batching_dispatcher(
+        BatchingDispatcher(
+            window=args.batch_window_ms / 1000,
+            max_batch_size=args.batch_max_size,
+        )
+    )
+
+HISTORY_WRITER = BatchedHistoryWriter(
+    SQLHistoryWriter.from_config(Path(args.sql_config_path)),
+    batch_size=args.history_batch_size,
+    flush_interval=args.history_flush_interval,
+    max_queue_size=args.history_queue_size,
+    retry_policy=RetryPolicy(
+        max_attempts=args.history_max_attempts,
+        transient_errors=DB_TRANSIENT_ERRORS,
+    ),
+)
 
-CONVERSATIONS = ConversationDB()
+CONVERSATIONS = ConversationDB(
+    max_conversations=args.max_live_conversations,
+    storage_mode=args.storage_mode,
+    journal_compaction_interval=args.journal_compaction_interval,
+    checkpoint_suffix=(
+        BINARY_CHECKPOINT_SUFFIX
+        if args.checkpoint_format == "binary"
+        else JSON_CHECKPOINT_SUFFIX
+    ),
+    checkpoint_store=(
+        PostgresCheckpointStore.from_config(
+            Path(args.checkpoint_store_config_path or args.sql_config_path)
+        )
+        if args.checkpoint_backend == POSTGRES_CHECKPOINT_BACKEND
+        else None
+    ),
+    # Shard workers take users over from each other.
+    adopt_saved_users=args.dispatcher_url is not None,
+)
 PROMPT_GENERATOR = ConversationalPromptGenerator.from_json(
     args.prompt_config_path
 )
 
-bot = Bot(token=args.telegram_token)
+bot = Bot(
+    token=args.telegram_token,
+    server=(
+        TelegramAPIServer.from_base(args.telegram_api_url)
+        if args.telegram_api_url is not None
+        else TELEGRAM_PRODUCTION
+    ),
+)
 storage = MemoryStorage()
 dispatcher = Dispatcher(bot, storage=storage)
 
@@ -74,36 +453,39 @@ DEFAULT_KEYBOARD = types.ReplyKeyboardMarkup(
 
 IS_DEBUG = False
 
+# Turns of a user run in order, turns of different users concurrently.
+USER_TURNS = KeyedExecutor()
+ordered_by_user = USER_TURNS.ordered(
+    key=lambda message, *args, **kwargs: message.from_user.id
+)
 
-def try_(func):
-    async def try_except(message):
-        error = ""
-        for i in range(4):
-            try:
-                await func(message)
-                return None
-            except Exception as e:
-                print(e)
-                error = str(e).lower()
-                pass
-            await asyncio.sleep(1)
-        if "overloaded with other requests" in error:
-            await bot.send_message(
-                message.from_user.id,
-                "\nPlease, try again later, We are currently under heavy load",
-            )
-        else:
-            await bot.send_message(
-                message.from_user.id,
-                '\nSomething went wrong, please type "/start" to start over',
-            )
+
+def reply_on_error(func):
+    # The LLM calls and the history writes retry on their own, a failing
+    # handler is never run again, so a turn is not answered or saved twice.
+    @functools.wraps(func)
+    async def handle_error(message, *args, **kwargs):
+        try:
+            await func(message, *args, **kwargs)
+        except Exception as e:
+            print(e)
+            if isinstance(e, LLMBusyError) or is_overload_error(e):
+                await bot.send_message(
+                    message.from_user.id,
+                    "\nPlease, try again later, We are currently under heavy load",
+                )
+            else:
+                await bot.send_message(
+                    message.from_user.id,
+                    '\nSomething went wrong, please type "/start" to start over',
+                )
         return None
 
-    return try_except
+    return handle_error
 
 
 @dispatcher.message_handler(commands=["start"])
-@try_
+@reply_on_error
 async def start(message: types.Message):
     """
     This handler will be called when user sends /start command
@@ -205,7 +587,11 @@ async def start(message: types.Message):
         )
 
     @dispatcher.message_handler(state=BotInfo.mood)
+    @ordered_by_user
+    @reply_on_error
     async def process_mood(message: types.Message, state: FSMContext):
+        set_llm_user(message.from_user.id)
+        set_llm_priority(ONBOARDING_PRIORITY)
         async with state.proxy() as data:
             data["mood"] = message.text
             # You can use the data dictionary here to create your bot object with the collected information
@@ -221,12 +607,12 @@ async def start(message: types.Message):
             message.from_user.id, action=types.ChatActions.TYPING
         )
 
-        conversation = create_conversation(
-            prompt=PROMPT_GENERATOR(context),
+        conversation = await create_conversation(
+            prompt=await PROMPT_GENERATOR.acall(context),
             tone=tone,
             config_path=args.model_config_path
         )
-        CONVERSATIONS.add_conversation(message.from_user.id, conversation, context)
+        await CONVERSATIONS.aadd_conversation(message.from_user.id, conversation, context)
         await bot.send_message(
             message.from_user.id,
             text="Lets start the conversation, can you tell me a little about yourself?", reply_markup=DEFAULT_KEYBOARD
@@ -273,9 +659,10 @@ async def companions_list(message: types.Message):
 
 
 @dispatcher.message_handler(commands=["load_conversation"])
+@ordered_by_user
 async def load_conversation(message: types.Message):
     conv_id = message.text.split(" ")[-1]
-    loaded_conversation = CONVERSATIONS.load_conversation(message.from_user.id, conv_id)
+    loaded_conversation = await CONVERSATIONS.aload_conversation(message.from_user.id, conv_id)
     await bot.send_message(
         message.from_user.id,
         text=loaded_conversation,
@@ -283,6 +670,7 @@ async def load_conversation(message: types.Message):
 
 
 @dispatcher.message_handler(commands=["delete_conversation"])
+@ordered_by_user
 async def delete_conversation(message: types.Message):
     conv_id = message.text.split(" ")[-1]
     deleted_conversation = CONVERSATIONS.delete_conversation(message.from_user.id, conv_id)
@@ -293,6 +681,7 @@ async def delete_conversation(message: types.Message):
 
 
 @dispatcher.message_handler(commands=["delete_all_conversations"])
+@ordered_by_user
 async def delete_all_conversations(message: types.Message):
     deleted_all_conversations = CONVERSATIONS.delete_all_conversations_by_user_id(message.from_user.id)
     await bot.send_message(
@@ -305,8 +694,9 @@ async def delete_all_conversations(message: types.Message):
     )
 
 @dispatcher.message_handler(commands=["debug"])
+@ordered_by_user
 async def debug(message: types.Message):
-    conversation = CONVERSATIONS.get_conversation(message.from_user.id)
+    conversation = await CONVERSATIONS.aget_conversation(message.from_user.id)
     if conversation is None:
         await bot.send_message(
             message.from_user.id, text="Please, provide initial context."
@@ -327,13 +717,16 @@ async def debug(message: types.Message):
 
 
 @dispatcher.message_handler()
-@try_
+@ordered_by_user
+@reply_on_error
 async def handle_message(message: types.Message) -> None:
+    set_llm_user(message.from_user.id)
+    set_llm_priority(CHAT_PRIORITY)
     # Agent side:
     if message.text.startswith("/"):
-        conversation = CONVERSATIONS.get_conversation(message.from_user.id)
+        conversation = await CONVERSATIONS.aget_conversation(message.from_user.id)
         tone_info = f"Information «{message.text[1:]}» has been added."
-        conversation.set_tone(message.text[1:])
+        await conversation.aset_tone(message.text[1:])
         # Proxy side:
         await bot.send_chat_action(
             message.from_user.id, action=types.ChatActions.TYPING
@@ -352,17 +745,31 @@ async def handle_message(message: types.Message) -> None:
         message.from_user.id, action=types.ChatActions.TYPING
     )
 
-    conversation = CONVERSATIONS.get_conversation(message.from_user.id)
-    chatbot_response = conversation.ask(message.text)
+    conversation = await CONVERSATIONS.aget_conversation(message.from_user.id)
+    if args.stream:
+        chatbot_response = await send_streaming_message(
+            bot,
+            message.from_user.id,
+            conversation.astream(message.text),
+            min_edit_interval=args.stream_edit_interval,
+            reply_markup=DEFAULT_KEYBOARD,
+        )
+    else:
+        chatbot_response = await conversation.aask(message.text)
 
-    HISTORY_WRITER.write_message(
+    await HISTORY_WRITER.awrite_message(
         user_id=message.from_user.id,
         conversation_id=CONVERSATIONS.get_conversation_id(message.from_user.id),
         user_message=message.text,
         chatbot_message=chatbot_response,
         env=args.env,
     )
-    CONVERSATIONS.serialize_user_conversation(user_id=message.from_user.id)
+    await CONVERSATIONS.amark_dirty(
+        user_id=message.from_user.id, conversation=conversation
+    )
+    if args.stream:
+        return None
+
     await bot.send_chat_action(
         message.from_user.id, action=types.ChatActions.TYPING
     )
@@ -374,24 +781,96 @@ async def handle_message(message: types.Message) -> None:
 
 
 async def serialize_conversation_task():
-    #CONVERSATIONS.serialize_conversations()
-    pass
+    await CONVERSATIONS.aflush_dirty(max_dirty_age=args.max_dirty_age)
+
+
+async def history_retention_task():
+    expired = await HISTORY_WRITER.writer.aapply_retention()
+    if expired:
+        print(f"Expired history partitions: {', '.join(expired)}")
 
 
 async def scheduler():
-    aioschedule.every(60).seconds.do(serialize_conversation_task)
+    aioschedule.every(args.flush_interval).seconds.do(serialize_conversation_task)
+    aioschedule.every().day.do(history_retention_task)
     while True:
         await aioschedule.run_pending()
         await asyncio.sleep(1)
 
 
 async def on_startup(dispatcher):
-    CONVERSATIONS.load_conversations()
+    # Shard workers only load the users they own, once they joined the ring.
+    if args.dispatcher_url is None:
+        CONVERSATIONS.load_conversations()
+    HISTORY_WRITER.start()
+    if args.mode == "webhook" and args.webhook_url is not None:
+        await bot.set_webhook(
+            args.webhook_url.rstrip("/") + args.webhook_path,
+            secret_token=args.webhook_secret,
+        )
 
     asyncio.create_task(scheduler())
 
 
+async def on_shutdown(dispatcher):
+    CONVERSATIONS.close()
+    await HISTORY_WRITER.aclose()
+    batching_dispatcher = get_batching_dispatcher()
+    if batching_dispatcher is not None:
+        await batching_dispatcher.aclose()
+    await close_http_session()
+
+
+def run_shard_worker(loop: asyncio.AbstractEventLoop) -> None:
+    worker = ShardWorker(
+        dispatcher,
+        CONVERSATIONS,
+        url=args.shard_url or f"http://{args.shard_host}:{args.shard_port}",
+        dispatcher_urls=args.dispatcher_url.split(","),
+        shard_secret=args.shard_secret,
+    )
+
+    async def on_worker_startup(app):
+        await on_startup(dispatcher)
+        await worker.start()
+
+    async def on_worker_shutdown(app):
+        # The site stopped listening already, so the worker releases its
+        # users itself before leaving the ring.
+        await worker.stop()
+        await on_shutdown(dispatcher)
+
+    app = worker.create_app()
+    app.on_startup.append(on_worker_startup)
+    app.on_shutdown.append(on_worker_shutdown)
+    web.run_app(app, host=args.shard_host, port=args.shard_port, loop=loop)
+
+
 def main():
+    get_tokenizer(GPT3ConversationConfig.from_json(args.model_config_path).model)
+    loop = asyncio.get_event_loop()
+    open_http_session(loop, limit=args.http_pool_size)
+    if args.dispatcher_url is not None:
+        run_shard_worker(loop)
+        return
+    if args.mode == "webhook":
+        executor.set_webhook(
+            dispatcher,
+            args.webhook_path,
+            loop=loop,
+            skip_updates=False,
+            on_startup=on_startup,
+            on_shutdown=on_shutdown,
+            web_app=create_webhook_app(args.webhook_path, args.webhook_secret),
+        ).run_app(host=args.webhook_host, port=args.webhook_port)
+        return
     executor.start_polling(
-        dispatcher, skip_updates=False, on_startup=on_startup
+        dispatcher,
+        skip_updates=False,
+        on_startup=on_startup,
+        on_shutdown=on_shutdown,
     )
+
+
+if __name__ == "__main__":
+    main()
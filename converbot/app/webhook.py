@@ -0,0 +1,49 @@
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import web
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+DEFAULT_WEBHOOK_PATH = "/webhook"
+
+
+def create_secret_token_middleware(
+    webhook_path: str, secret_token: Optional[str]
+) -> Callable[..., Awaitable[web.StreamResponse]]:
+    """
+    Create an aiohttp middleware rejecting the webhook requests without the
+    secret token Telegram was given in `set_webhook`.
+
+    Args:
+        webhook_path: The path of the webhook, other routes aren't checked.
+        secret_token: The secret token, None to accept every request.
+    """
+
+    @web.middleware
+    async def check_secret_token(
+        request: web.Request,
+        handler: Callable[[web.Request], Awaitable[web.StreamResponse]],
+    ) -> web.StreamResponse:
+        if (
+            secret_token is not None
+            and request.path == webhook_path
+            and request.headers.get(SECRET_TOKEN_HEADER) != secret_token
+        ):
+            raise web.HTTPUnauthorized()
+        return await handler(request)
+
+    return check_secret_token
+
+
+def create_webhook_app(
+    webhook_path: str = DEFAULT_WEBHOOK_PATH, secret_token: Optional[str] = None
+) -> web.Application:
+    """
+    Create the web application to serve the Telegram webhook from.
+
+    Args:
+        webhook_path: The path of the webhook.
+        secret_token: The secret token expected from Telegram.
+    """
+    return web.Application(
+        middlewares=[create_secret_token_middleware(webhook_path, secret_token)]
+    )
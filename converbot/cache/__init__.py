@@ -0,0 +1,2 @@
+from converbot.cache.keys import chain_cache_key, normalize_text
+from converbot.cache.lru import LRUCache
@@ -0,0 +1,43 @@
+import hashlib
+import json
+from typing import Any
+
+from langchain import LLMChain
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize the case and whitespace of a text, so equivalent inputs share
+    their cache entries.
+    """
+    return " ".join(text.lower().split())
+
+
+def _digest(data: Any) -> str:
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def chain_cache_key(handler: str, chain: LLMChain, user_input: str) -> str:
+    """
+    Compute the content address of a handler chain result: a hash of the
+    handler, its prompt template, the normalized input and the model
+    parameters. Editing the template or the model parameters changes every
+    key, so stale results are never served.
+
+    Args:
+        handler: The name of the handler.
+        chain: The chain of the handler.
+        user_input: The input of the chain.
+
+    Returns: The cache key.
+    """
+    return _digest(
+        {
+            "handler": handler,
+            "template": _digest(chain.prompt.template),
+            "input": normalize_text(user_input),
+            "model": chain.llm._identifying_params,
+        }
+    )
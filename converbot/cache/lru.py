@@ -0,0 +1,164 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+
+class LRUCache:
+    """
+    A bounded least recently used string cache with optional expiry and
+    persistence.
+
+    Changes are saved from a background thread at most once per
+    `save_delay` seconds, so a put never waits for the disk. Several
+    processes may share the file, the last save wins. A failed save is
+    printed and retried on the next change.
+
+    Args:
+        max_size: The maximum number of entries to keep in memory.
+        file_path: The JSON file to load the entries from and persist them to.
+        ttl: The number of seconds an entry stays valid, None to keep it
+            until evicted.
+        save_delay: The number of seconds changes wait to be saved.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        file_path: Optional[Path] = None,
+        ttl: Optional[float] = None,
+        save_delay: float = 1.0,
+    ) -> None:
+        self._max_size = max_size
+        self._file_path = file_path
+        self._ttl = ttl
+        self._save_delay = save_delay
+        self._save_timer: Optional[threading.Timer] = None
+        # Values with their expiry time, None when they don't expire.
+        self._entries: "OrderedDict[str, Tuple[str, Optional[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+        if self._file_path is not None and self._file_path.exists():
+            try:
+                self._load()
+            except (OSError, ValueError, TypeError, IndexError) as e:
+                print(f"Failed to load the cache from {self._file_path}: {e}")
+            self._evict()
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Get the cached value for the key and mark it as recently used.
+
+        Args:
+            key: The cache key.
+
+        Returns: The cached value or None on a miss or an expired entry.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def put(self, key: str, value: str) -> None:
+        """
+        Cache the value, evicting the least recently used entries if needed.
+
+        Args:
+            key: The cache key.
+            value: The value to cache.
+        """
+        with self._lock:
+            expires_at = None if self._ttl is None else time.time() + self._ttl
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            self._evict()
+            if self._file_path is not None and self._save_timer is None:
+                # Not a daemon, so the changes are saved before exiting.
+                self._save_timer = threading.Timer(self._save_delay, self.save)
+                self._save_timer.start()
+
+    def save(self) -> None:
+        """
+        Save the entries to the file now, if the cache has one.
+        """
+        if self._file_path is None:
+            return
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            data = {
+                key: value if expires_at is None else [value, expires_at]
+                for key, (value, expires_at) in self._entries.items()
+            }
+        try:
+            self._write(data)
+        except Exception as e:
+            print(f"Failed to save the cache to {self._file_path}: {e}")
+
+    def _evict(self) -> None:
+        if self._ttl is not None:
+            now = time.time()
+            for key in [
+                key
+                for key, (_, expires_at) in self._entries.items()
+                if expires_at is not None and expires_at <= now
+            ]:
+                del self._entries[key]
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def _load(self) -> None:
+        for key, value in json.loads(self._file_path.read_text()).items():
+            # Entries without expiry are saved as plain strings.
+            if isinstance(value, str):
+                self._entries[key] = (value, None)
+            else:
+                self._entries[key] = (value[0], value[1])
+
+    def _write(self, data: Dict[str, Any]) -> None:
+        self._file_path.parent.mkdir(parents=True, exist_ok=True)
+        # A unique temporary file, the processes sharing the cache save
+        # concurrently.
+        with tempfile.NamedTemporaryFile(
+            "w",
+            dir=self._file_path.parent,
+            prefix=self._file_path.name,
+            suffix=".tmp",
+            delete=False,
+        ) as tmp_file:
+            try:
+                json.dump(data, tmp_file)
+            except BaseException:
+                tmp_file.close()
+                os.unlink(tmp_file.name)
+                raise
+        try:
+            os.replace(tmp_file.name, self._file_path)
+        except OSError:
+            os.unlink(tmp_file.name)
+            raise
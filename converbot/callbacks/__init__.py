@@ -1 +1,2 @@
 from converbot.callbacks.debug import DebugPromptCallback
+from converbot.callbacks.streaming import TokenStreamCallback, set_token_queue
@@ -0,0 +1,88 @@
+import asyncio
+from contextvars import ContextVar, Token
+from typing import Any, Dict, List, Optional, Union
+
+from langchain.callbacks import BaseCallbackHandler
+from langchain.schema import AgentAction, AgentFinish, LLMResult
+
+_TOKEN_QUEUE: ContextVar[Optional[asyncio.Queue]] = ContextVar(
+    "token_queue", default=None
+)
+
+
+def set_token_queue(queue: Optional[asyncio.Queue]) -> Token:
+    """
+    Route the tokens streamed by the current task to the queue.
+
+    Args:
+        queue: The queue to put the tokens to, None to stop routing.
+
+    Returns: The context variable token to reset the routing with.
+    """
+    return _TOKEN_QUEUE.set(queue)
+
+
+class TokenStreamCallback(BaseCallbackHandler):
+    """
+    Forwards streamed LLM tokens to the queue set for the current task.
+
+    A single instance is shared by every streaming request of an LLM, the
+    queue lookup is what separates the concurrent requests.
+    """
+
+    @property
+    def always_verbose(self) -> bool:
+        return True
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        queue = _TOKEN_QUEUE.get()
+        if queue is not None:
+            queue.put_nowait(token)
+
+    def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
+    ) -> None:
+        pass
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        pass
+
+    def on_llm_error(
+        self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
+    ) -> None:
+        pass
+
+    def on_chain_start(
+        self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any
+    ) -> None:
+        pass
+
+    def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> None:
+        pass
+
+    def on_chain_error(
+        self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
+    ) -> None:
+        pass
+
+    def on_tool_start(
+        self, serialized: Dict[str, Any], action: AgentAction, **kwargs: Any
+    ) -> None:
+        pass
+
+    def on_tool_end(self, output: str, **kwargs: Any) -> None:
+        pass
+
+    def on_tool_error(
+        self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
+    ) -> None:
+        pass
+
+    def on_text(self, text: str, **kwargs: Any) -> None:
+        pass
+
+    def on_agent_finish(self, finish: AgentFinish, **kwargs: Any) -> None:
+        pass
+
+    def on_agent_action(self, action: AgentAction, **kwargs: Any) -> None:
+        pass
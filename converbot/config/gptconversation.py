@@ -11,7 +11,12 @@ class GPT3ConversationConfig(OpenAIModelConfig):
 
     Args:
         summary_buffer_memory_max_token_limit: The maximum number of tokens to store in the summary buffer.
+        summary_buffer_memory_deferred_pruning: Whether to summarize the pruned buffer in the background.
+        summary_buffer_memory_hard_token_limit: The maximum number of buffer tokens in the prompt while the
+            background summarization falls behind.
     """
 
     tone: str = DEFAULT_FRIENDLY_TONE
     summary_buffer_memory_max_token_limit: int = 1000
+    summary_buffer_memory_deferred_pruning: bool = False
+    summary_buffer_memory_hard_token_limit: int = 2000
@@ -4,6 +4,18 @@ CONVERSATION_SAVE_DIR = (
     Path(__file__).parent.parent / "database" / "saved_conversations"
 )
 HISTORY_SAVE_DIR = Path(__file__).parent.parent / "database" / "chat_history"
+TONE_CACHE_PATH = Path(__file__).parent.parent / "database" / "tone_cache.json"
+TONE_CACHE_SIZE = 1024
+TEXT_STYLE_CACHE_PATH = (
+    Path(__file__).parent.parent / "database" / "text_style_cache.json"
+)
+TEXT_STYLE_CACHE_SIZE = 1024
+TEXT_STYLE_CACHE_TTL = 30 * 24 * 60 * 60
+
+SNAPSHOT_STORAGE = "snapshot"
+JOURNAL_STORAGE = "journal"
+JOURNAL_SUFFIX = ".journal"
+CONVERSATION_INDEX_FILE_NAME = "index.sqlite3"
 
 TIME, USER_MESSAGE, CHATBOT_RESPONSE = (
     "time",
@@ -1,18 +1,29 @@
+import asyncio
 from pathlib import Path
-from typing import List
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
 from langchain import LLMChain
 from langchain.callbacks.base import CallbackManager
-from langchain.chains.conversation.memory import \
-    ConversationSummaryBufferMemory
-from langchain.llms import OpenAI
 
-from converbot.callbacks import DebugPromptCallback
+from converbot.callbacks import DebugPromptCallback, set_token_queue
 from converbot.config.gptconversation import GPT3ConversationConfig
 from converbot.constants import DEFAULT_CONFIG_PATH, DEFAULT_FRIENDLY_TONE
-from converbot.handlers.mood_handler import ConversationToneHandler
+from converbot.handlers.shared import get_tone_handler
+from converbot.llm import (
+    BACKGROUND_PRIORITY,
+    acall_language_model,
+    estimate_tokens,
+    get_batching_dispatcher,
+    get_language_model,
+    get_llm_retry_policy,
+    get_llm_scheduler,
+    language_model_kwargs,
+    set_llm_priority,
+)
+from converbot.memory import SummaryBufferMemory
 from converbot.prompt.prompt import ConversationPrompt
 from converbot.serialization.checkpoint import GPT3ConversationCheckpoint
+from converbot.serialization.journal import JournalRecord
 
 
 class GPT3Conversation:
@@ -33,19 +44,16 @@ class GPT3Conversation:
     ):
         self._config = model_config
         self._prompt = prompt
-        self._language_model = OpenAI(
-            model_name=model_config.model,
-            temperature=model_config.temperature,
-            max_tokens=model_config.max_tokens,
-            top_p=model_config.top_p,
-            frequency_penalty=model_config.frequency_penalty,
-            presence_penalty=model_config.presence_penalty,
-            best_of=model_config.best_of,
+        self._language_model = get_language_model(
+            **language_model_kwargs(model_config)
         )
 
-        self._memory = ConversationSummaryBufferMemory(
+        self._memory = SummaryBufferMemory(
             llm=self._language_model,
             max_token_limit=model_config.summary_buffer_memory_max_token_limit,
+            model_name=model_config.model,
+            deferred_pruning=model_config.summary_buffer_memory_deferred_pruning,
+            hard_token_limit=model_config.summary_buffer_memory_hard_token_limit,
             input_key=self._prompt.user_input_key,
             memory_key=self._prompt.memory_key,
             human_prefix=self._prompt.user_name,
@@ -61,9 +69,10 @@ class GPT3Conversation:
             callback_manager=CallbackManager([self._debug_callback]),
         )
 
-        self._tone_processor = ConversationToneHandler()
+        self._tone_processor = get_tone_handler()
         self._tone = DEFAULT_FRIENDLY_TONE
         self._debug = False
+        self._pruning_task: Optional[asyncio.Task] = None
 
     @classmethod
     def from_config_file(
@@ -89,6 +98,10 @@ class GPT3Conversation:
             verbose=verbose,
         )
 
+    @property
+    def debug(self) -> bool:
+        return self._debug
+
     def change_debug_mode(self):
         self._debug = not self._debug
         return self._debug
@@ -104,6 +117,17 @@ class GPT3Conversation:
         """
         self._tone = self._tone_processor(tone)
 
+    async def aset_tone(self, tone: str) -> None:
+        """
+        Set the tone of the chatbot without blocking the event loop.
+
+        Args:
+            tone: The tone of the chatbot.
+
+        Returns: None
+        """
+        self._tone = await self._tone_processor.acall(tone)
+
     def ask(self, user_input: str) -> str:
         """
         Ask the chatbot a question and get a response.
@@ -126,30 +150,213 @@ class GPT3Conversation:
 
         return self._debug_callback.last_used_prompt + output
 
+    def _prepare_inputs(self, user_input: str) -> Dict[str, Any]:
+        inputs = {
+            self._prompt.user_input_key: user_input,
+            self._prompt.conversation_tone_key: self._tone,
+        }
+        inputs.update(self._memory.load_memory_variables(inputs))
+        return inputs
+
+    async def _asave_turn(self, inputs: Dict[str, Any], output: str) -> None:
+        await self._memory.asave_context(
+            inputs, {self._conversation.output_key: output}
+        )
+        if self._memory.deferred_pruning:
+            self._schedule_pruning()
+
+    async def aask(self, user_input: str) -> str:
+        """
+        Ask the chatbot a question and get a response without blocking the
+        event loop.
+
+        Args:
+            user_input: The question to ask the chatbot.
+
+        Returns: The response from the chatbot.
+        """
+        inputs = self._prepare_inputs(user_input)
+        prompt = self._prompt.prompt.format(**inputs)
+
+        output = await self._agenerate(prompt)
+
+        await self._asave_turn(inputs, output)
+
+        if not self._debug:
+            return output
+
+        return prompt + output
+
+    async def _agenerate(self, prompt: str) -> str:
+        estimated_tokens = estimate_tokens(self._language_model, prompt)
+        dispatcher = get_batching_dispatcher()
+        if dispatcher is not None:
+            # The dispatcher admits and retries the whole batch.
+            return await dispatcher.agenerate(
+                self._language_model, prompt, estimated_tokens=estimated_tokens
+            )
+
+        # Only the completion is retried, the turn is saved once.
+        return await acall_language_model(
+            self._agenerate_once, prompt, estimated_tokens=estimated_tokens
+        )
+
+    async def _agenerate_once(self, prompt: str) -> str:
+        response = await self._language_model.agenerate([prompt])
+        return response.generations[0][0].text
+
+    async def astream(self, user_input: str) -> AsyncIterator[str]:
+        """
+        Ask the chatbot a question and stream the response tokens as they are
+        generated. Requires `best_of` of 1.
+
+        The turn is saved once the iterator is exhausted. Closing it earlier
+        cancels the generation and the turn is dropped, so close it, e.g.
+        with `contextlib.aclosing`.
+
+        Args:
+            user_input: The question to ask the chatbot.
+
+        Returns: The iterator over the response tokens.
+        """
+        inputs = self._prepare_inputs(user_input)
+        queue: asyncio.Queue = asyncio.Queue()
+        generation = asyncio.get_running_loop().create_task(
+            self._astream_generate(inputs, queue)
+        )
+        try:
+            while True:
+                token = await queue.get()
+                if token is None:
+                    break
+                yield token
+            # Re-raises the generation error, if any.
+            output = await generation
+        finally:
+            if not generation.done():
+                generation.cancel()
+                await asyncio.wait([generation])
+
+        await self._asave_turn(inputs, output)
+
+    async def _astream_generate(
+        self, inputs: Dict[str, Any], queue: asyncio.Queue
+    ) -> str:
+        try:
+            prompt = self._prompt.prompt.format(**inputs)
+            if self._debug:
+                queue.put_nowait(prompt)
+
+            language_model = get_language_model(
+                streaming=True, **language_model_kwargs(self._config)
+            )
+            scheduler = get_llm_scheduler()
+            if scheduler is not None:
+                await scheduler.acquire(estimate_tokens(language_model, prompt))
+            set_token_queue(queue)
+            # The streamed tokens can't be taken back, so a stream is never
+            # retried, but it still fails fast while the circuit is open.
+            policy = get_llm_retry_policy()
+            if policy is not None and policy.breaker is not None:
+                response = await policy.breaker.call(
+                    language_model.agenerate, [prompt]
+                )
+            else:
+                response = await language_model.agenerate([prompt])
+            set_token_queue(None)
+            return response.generations[0][0].text
+        finally:
+            queue.put_nowait(None)
+
+    def _schedule_pruning(self) -> None:
+        """
+        Start the background memory pruning unless it is already running.
+        """
+        if self._pruning_task is not None and not self._pruning_task.done():
+            return
+        if not self._memory.needs_pruning:
+            return
+        self._pruning_task = asyncio.get_running_loop().create_task(
+            self._prune_memory()
+        )
+
+    async def _prune_memory(self) -> None:
+        # Runs in its own task, the turns of the user keep their priority.
+        set_llm_priority(BACKGROUND_PRIORITY)
+        try:
+            # Turns finishing during the summarization may overflow again.
+            while self._memory.needs_pruning:
+                await self._memory.aprune()
+        except Exception as e:
+            print(e)
+
     def save(self, file_path: Path, bot_description) -> None:
         """
-        Serialize the chatbot to .json file.
+        Serialize the chatbot to .json file, or to a binary checkpoint if the
+        file has the BINARY_CHECKPOINT_SUFFIX suffix.
 
         Args:
             bot_description: description of the companion (e.g Name, age, hobby...)
             file_path: The path to the file to serialize to.
         """
         file_path.parent.mkdir(exist_ok=True, parents=True)
+        self.to_checkpoint(bot_description).save(file_path)
 
-        checkpoint = GPT3ConversationCheckpoint(
+    def to_checkpoint(
+        self, bot_description: Optional[str] = None
+    ) -> GPT3ConversationCheckpoint:
+        """
+        Take a checkpoint of the chatbot. The checkpoint doesn't change with
+        the chatbot, so it can be written from another thread.
+
+        Args:
+            bot_description: description of the companion (e.g Name, age, hobby...)
+
+        Returns: The checkpoint.
+        """
+        return GPT3ConversationCheckpoint(
             config=self._config,
             prompt_template=self._prompt.original_prompt_text,
             prompt_chatbot_name=self._prompt.chatbot_name,
             prompt_user_name=self._prompt.user_name,
-            memory_buffer=self._memory.buffer,
+            memory_buffer=list(self._memory.buffer),
             memory_moving_summary_buffer=self._memory.moving_summary_buffer,
-            bot_description=bot_description
+            bot_description=bot_description,
+            memory_token_counts=list(self._memory.token_counts),
         )
 
-        checkpoint.to_json(file_path)
+    def memory_cursor(self) -> Tuple[int, int, str]:
+        """
+        Get the current position of the chatbot memory.
+
+        Returns: The cursor to pass to `memory_delta`.
+        """
+        return self._memory.cursor()
+
+    def memory_delta(self, cursor: Tuple[int, int, str]) -> JournalRecord:
+        """
+        Get the change of the chatbot memory since the cursor was taken.
+
+        Args:
+            cursor: The cursor returned by `memory_cursor`.
+
+        Returns: The journal record of the change.
+        """
+        dropped, lines, token_counts, moving_summary_buffer = (
+            self._memory.delta_since(cursor)
+        )
+        return JournalRecord(
+            dropped=dropped,
+            lines=lines,
+            token_counts=token_counts,
+            moving_summary_buffer=moving_summary_buffer,
+        )
 
     def setup_memory(
-        self, buffer: List[str], moving_summary_buffer: str
+        self,
+        buffer: List[str],
+        moving_summary_buffer: str,
+        token_counts: Optional[List[int]] = None,
     ) -> None:
         """
         Setup the memory of the chatbot.
@@ -157,10 +364,11 @@ class GPT3Conversation:
         Args:
             buffer: The buffer to setup.
             moving_summary_buffer: The moving summary buffer to setup.
+            token_counts: The token counts of the buffer lines.
 
         Returns: None
         """
-        self._memory.buffer = buffer
+        self._memory.set_buffer(buffer, token_counts)
         self._memory.moving_summary_buffer = moving_summary_buffer
 
     @classmethod
@@ -168,13 +376,26 @@ class GPT3Conversation:
         cls, file_path: Path, verbose: bool = False
     ) -> "GPT3Conversation":
         """
-        Load a chatbot from .json file.
+        Load a chatbot from .json or binary checkpoint file.
 
         Args:
             file_path: The path to the file to load from.
             verbose: Whether to print verbose output.
         """
-        checkpoint = GPT3ConversationCheckpoint.from_json(file_path)
+        checkpoint = GPT3ConversationCheckpoint.load(file_path)
+        return cls.from_checkpoint_data(checkpoint, verbose=verbose)
+
+    @classmethod
+    def from_checkpoint_data(
+        cls, checkpoint: GPT3ConversationCheckpoint, verbose: bool = False
+    ) -> "GPT3Conversation":
+        """
+        Load a chatbot from a loaded checkpoint.
+
+        Args:
+            checkpoint: The checkpoint to load from.
+            verbose: Whether to print verbose output.
+        """
         conversation = cls(
             prompt=ConversationPrompt(
                 prompt_text=checkpoint.prompt_template,
@@ -187,6 +408,7 @@ class GPT3Conversation:
         conversation.setup_memory(
             buffer=checkpoint.memory_buffer,
             moving_summary_buffer=checkpoint.memory_moving_summary_buffer,
+            token_counts=checkpoint.memory_token_counts,
         )
         return conversation
 
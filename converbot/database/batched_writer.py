@@ -0,0 +1,173 @@
+import asyncio
+import datetime
+import time
+from typing import Dict, List, Optional
+
+from converbot.constants import DEV_ENV
+from converbot.database.history_writer import (
+    HistoryRecord,
+    SQLHistoryWriter,
+    new_record_id,
+)
+from converbot.utils.retry import RetryPolicy
+
+
+class BatchedHistoryWriter:
+    """
+    Queues the history rows and writes them in batches from a background task,
+    with one multi-row insert and one commit per batch.
+
+    A batch is written once it has `batch_size` rows or its oldest row has
+    waited `flush_interval` seconds. The queue is bounded, so writers wait
+    when the database falls behind. A batch is retried by `retry_policy`,
+    a batch still failing is counted and dropped.
+
+    Args:
+        writer: The writer to write the batches with.
+        batch_size: The maximum number of rows in a batch.
+        flush_interval: The maximum number of seconds a row waits in the queue.
+        max_queue_size: The maximum number of queued rows.
+        retry_policy: The policy retrying a failed batch, None to not retry.
+    """
+
+    def __init__(
+        self,
+        writer: SQLHistoryWriter,
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        max_queue_size: int = 10000,
+        retry_policy: Optional[RetryPolicy] = None,
+    ) -> None:
+        self._writer = writer
+        self._retry_policy = retry_policy
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._max_queue_size = max_queue_size
+        self._worker: Optional[asyncio.Task] = None
+
+        self._queued = 0
+        self._written = 0
+        self._failed = 0
+        self._batches = 0
+        self._write_seconds = 0.0
+
+    @property
+    def writer(self) -> SQLHistoryWriter:
+        return self._writer
+
+    @property
+    def metrics(self) -> Dict[str, float]:
+        """
+        The number of rows queued, written and failed, the batches written and
+        the queue depth.
+        """
+        return {
+            "queued": self._queued,
+            "written": self._written,
+            "failed": self._failed,
+            "batches": self._batches,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "average_batch_size": (
+                self._written / self._batches if self._batches else 0.0
+            ),
+            "average_write_seconds": (
+                self._write_seconds / self._batches if self._batches else 0.0
+            ),
+        }
+
+    def start(self) -> None:
+        """
+        Start the background task. Must be called from the event loop.
+        """
+        if self._worker is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self._max_queue_size)
+        self._worker = asyncio.create_task(self._run())
+
+    async def awrite_message(
+        self,
+        conversation_id: str,
+        user_id: int,
+        user_message: str,
+        chatbot_message: str,
+        env: str = DEV_ENV,
+        timestamp: Optional[datetime.datetime] = None,
+    ) -> None:
+        """
+        Queue a new row of the ConversationHistory table, waiting while the
+        queue is full.
+
+        Args:
+            conversation_id: Unique ID for the conversation.
+            user_id: ID of the user who sent the message.
+            user_message: Message sent by the user.
+            chatbot_message: Message sent by the chatbot.
+            env: Environment where the message was sent.
+            timestamp: Timestamp for the message, now by default.
+        """
+        if self._queue is None:
+            raise RuntimeError("The writer is not started")
+        await self._queue.put(
+            HistoryRecord(
+                conversation_id,
+                user_id,
+                user_message,
+                chatbot_message,
+                env,
+                timestamp or datetime.datetime.now(),
+                new_record_id(),
+            )
+        )
+        self._queued += 1
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._flush_interval
+            while len(batch) < self._batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(
+                        await asyncio.wait_for(self._queue.get(), timeout)
+                    )
+                except asyncio.TimeoutError:
+                    break
+            await self._write_batch(batch)
+
+    async def _write_batch(self, batch: List[HistoryRecord]) -> None:
+        start = time.perf_counter()
+        try:
+            # The rows carry their record ids, so a batch whose commit
+            # succeeded before the connection dropped isn't written twice.
+            if self._retry_policy is not None:
+                await self._retry_policy.call(self._writer.awrite_messages, batch)
+            else:
+                await self._writer.awrite_messages(batch)
+        except Exception as e:
+            print(f"Dropped a batch of {len(batch)} history rows: {e}")
+            self._failed += len(batch)
+        else:
+            self._written += len(batch)
+            self._batches += 1
+            self._write_seconds += time.perf_counter() - start
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    async def aclose(self) -> None:
+        """
+        Write the queued rows, stop the background task and close the writer.
+        """
+        if self._worker is not None:
+            await self._queue.join()
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        self._writer.close()
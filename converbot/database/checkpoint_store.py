@@ -0,0 +1,523 @@
+import json
+from dataclasses import asdict
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from psycopg2.extras import Json
+
+from converbot.constants import (
+    CONVERSATION_INDEX_FILE_NAME,
+    CONVERSATION_SAVE_DIR,
+    JOURNAL_SUFFIX,
+)
+from converbot.database.index import ConversationIndex
+from converbot.database.postgres import PostgresPool
+from converbot.serialization.checkpoint import (
+    CHECKPOINT_SUFFIXES,
+    DEFAULT_COMPRESSION,
+    JSON_CHECKPOINT_SUFFIX,
+    GPT3ConversationCheckpoint,
+)
+from converbot.serialization.journal import ConversationJournal, JournalRecord
+
+FILE_CHECKPOINT_BACKEND = "file"
+POSTGRES_CHECKPOINT_BACKEND = "postgres"
+CHECKPOINT_BACKENDS = (FILE_CHECKPOINT_BACKEND, POSTGRES_CHECKPOINT_BACKEND)
+
+
+class CheckpointStore:
+    """
+    Storage of the conversation checkpoints, their journals and metadata.
+
+    A conversation is identified by the user id and the conversation id.
+    Saving a checkpoint discards the journal of the conversation.
+    """
+
+    def exists(self, user_id: str, conversation_id: str) -> bool:
+        raise NotImplementedError
+
+    def load(
+        self, user_id: str, conversation_id: str
+    ) -> Tuple[GPT3ConversationCheckpoint, int]:
+        """
+        Load the checkpoint of a conversation with its journal replayed.
+
+        Args:
+            user_id: Telegram user_id of the user.
+            conversation_id: The conversation id.
+
+        Returns: The checkpoint and the number of journal records replayed.
+        """
+        raise NotImplementedError
+
+    def save(
+        self,
+        user_id: str,
+        conversation_id: str,
+        checkpoint: GPT3ConversationCheckpoint,
+    ) -> None:
+        raise NotImplementedError
+
+    def append_journal(
+        self, user_id: str, conversation_id: str, record: JournalRecord
+    ) -> None:
+        raise NotImplementedError
+
+    def delete(self, user_id: str, conversation_id: str) -> bool:
+        """
+        Delete a conversation.
+
+        Returns: Whether the conversation existed.
+        """
+        raise NotImplementedError
+
+    def delete_user(self, user_id: str) -> None:
+        raise NotImplementedError
+
+    def get_latest(self, user_id: str) -> Optional[str]:
+        """
+        Get the id of the latest conversation of the user, None if the user
+        has no conversations.
+        """
+        raise NotImplementedError
+
+    def list_descriptions(self, user_id: str) -> List[Tuple[str, str]]:
+        """
+        List the companion descriptions of the user.
+
+        Returns: The bot descriptions and conversation ids, oldest first.
+        """
+        raise NotImplementedError
+
+    def iter_latest(self) -> Iterator[Tuple[str, str]]:
+        """
+        Iterate over the latest conversation of every user.
+
+        Returns: The user ids and conversation ids.
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class FileCheckpointStore(CheckpointStore):
+    """
+    Stores the checkpoints as files under `{conversation_save_dir}/{user_id}`,
+    with the journals next to them and a SQLite index of the metadata, built
+    from the checkpoints on disk the first time.
+
+    Checkpoints are written in the format given by `checkpoint_suffix` and
+    read in any format.
+
+    Args:
+        conversation_save_dir: The directory to save the checkpoints to.
+        checkpoint_suffix: The suffix of the written checkpoints, one of
+            CHECKPOINT_SUFFIXES.
+        index_path: The path to the SQLite index of the saved conversations.
+    """
+
+    def __init__(
+        self,
+        conversation_save_dir: Path = CONVERSATION_SAVE_DIR,
+        checkpoint_suffix: str = JSON_CHECKPOINT_SUFFIX,
+        index_path: Optional[Path] = None,
+    ) -> None:
+        if checkpoint_suffix not in CHECKPOINT_SUFFIXES:
+            raise ValueError(f"Unknown checkpoint suffix: {checkpoint_suffix}")
+
+        self._conversation_save_dir = conversation_save_dir
+        self._conversation_save_dir.mkdir(parents=True, exist_ok=True)
+        self._checkpoint_suffix = checkpoint_suffix
+
+        self._index = ConversationIndex(
+            index_path or self._conversation_save_dir / CONVERSATION_INDEX_FILE_NAME,
+            self._conversation_save_dir,
+        )
+        if self._index.is_empty():
+            self._build_index()
+
+    def _build_index(self) -> None:
+        """
+        Index the checkpoints saved on disk.
+        """
+        for suffix in CHECKPOINT_SUFFIXES:
+            for checkpoint_path in self._conversation_save_dir.rglob(f"*{suffix}"):
+                checkpoint = GPT3ConversationCheckpoint.load(checkpoint_path)
+                self._index.upsert(
+                    user_id=checkpoint_path.parent.name,
+                    conversation_id=checkpoint_path.stem,
+                    bot_description=checkpoint.bot_description,
+                    path=checkpoint_path,
+                )
+
+    def _get_save_path(self, user_id: str, conversation_id: str) -> Path:
+        return (
+            self._conversation_save_dir / user_id / conversation_id
+        ).with_suffix(self._checkpoint_suffix)
+
+    def _get_path(self, user_id: str, conversation_id: str) -> Path:
+        path = self._index.get_path(user_id, conversation_id)
+        return path or self._get_save_path(user_id, conversation_id)
+
+    def exists(self, user_id: str, conversation_id: str) -> bool:
+        return self._get_path(user_id, conversation_id).exists()
+
+    def load(
+        self, user_id: str, conversation_id: str
+    ) -> Tuple[GPT3ConversationCheckpoint, int]:
+        checkpoint_path = self._get_path(user_id, conversation_id)
+        checkpoint = GPT3ConversationCheckpoint.load(checkpoint_path)
+        journal = ConversationJournal(checkpoint_path.with_suffix(JOURNAL_SUFFIX))
+        return checkpoint, journal.replay(checkpoint)
+
+    def save(
+        self,
+        user_id: str,
+        conversation_id: str,
+        checkpoint: GPT3ConversationCheckpoint,
+    ) -> None:
+        save_path = self._get_save_path(user_id, conversation_id)
+        save_path.parent.mkdir(exist_ok=True)
+        checkpoint.save(save_path)
+        if self._index.get_path(user_id, conversation_id) != save_path:
+            self._index.upsert(
+                user_id, conversation_id, checkpoint.bot_description, save_path
+            )
+        ConversationJournal(save_path.with_suffix(JOURNAL_SUFFIX)).clear()
+        for suffix in CHECKPOINT_SUFFIXES:
+            # Checkpoint loaded from the other format.
+            if suffix != self._checkpoint_suffix:
+                save_path.with_suffix(suffix).unlink(missing_ok=True)
+
+    def append_journal(
+        self, user_id: str, conversation_id: str, record: JournalRecord
+    ) -> None:
+        checkpoint_path = self._get_path(user_id, conversation_id)
+        ConversationJournal(checkpoint_path.with_suffix(JOURNAL_SUFFIX)).append(record)
+
+    def delete(self, user_id: str, conversation_id: str) -> bool:
+        checkpoint_path = self._get_path(user_id, conversation_id)
+        if not checkpoint_path.exists():
+            return False
+        checkpoint_path.unlink()
+        checkpoint_path.with_suffix(JOURNAL_SUFFIX).unlink(missing_ok=True)
+        self._index.delete(conversation_id)
+        return True
+
+    def delete_user(self, user_id: str) -> None:
+        for checkpoint_path in self._index.list_paths(user_id):
+            checkpoint_path.unlink(missing_ok=True)
+            checkpoint_path.with_suffix(JOURNAL_SUFFIX).unlink(missing_ok=True)
+        self._index.delete_user(user_id)
+
+    def get_latest(self, user_id: str) -> Optional[str]:
+        latest = self._index.get_latest(user_id)
+        return None if latest is None else latest[0]
+
+    def list_descriptions(self, user_id: str) -> List[Tuple[str, str]]:
+        return self._index.list_descriptions(user_id)
+
+    def iter_latest(self) -> Iterator[Tuple[str, str]]:
+        for user_id, conversation_id, _ in self._index.iter_latest():
+            yield user_id, conversation_id
+
+    def close(self) -> None:
+        self._index.close()
+
+
+class PostgresCheckpointStore(CheckpointStore):
+    """
+    Stores the checkpoints as compressed binary checkpoints in PostgreSQL, so
+    several bot processes can share the conversations.
+
+    Saving upserts the checkpoint and discards the journal in one transaction.
+    The latest conversation of a user is looked up by an index on
+    (user_id, created_at).
+
+    Args:
+        host: PostgreSQL Database host.
+        port: PostgreSQL Database port.
+        user: PostgreSQL Database user.
+        password: PostgreSQL Database user password.
+        database: PostgreSQL Database name.
+        min_connections: The number of connections kept open.
+        max_connections: The maximum number of open connections.
+        compression: The checkpoint compression, one of COMPRESSIONS.
+        **kwargs: Additional arguments to pass to psycopg2.connect.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: str,
+        user: str,
+        password: str,
+        database: str,
+        min_connections: int = 1,
+        max_connections: int = 4,
+        compression: str = DEFAULT_COMPRESSION,
+        **kwargs
+    ) -> None:
+        self._pool = PostgresPool(
+            min_connections,
+            max_connections,
+            host=host,
+            port=port,
+            user=user,
+            password=password,
+            database=database,
+            **kwargs
+        )
+        self._compression = compression
+
+        self._create_tables()
+
+    @classmethod
+    def from_config(cls, file_path: Path) -> "PostgresCheckpointStore":
+        """
+        Load the database configuration from a JSON file. Only the connection
+        settings are used, so the file can be shared with SQLHistoryWriter.
+
+        Args:
+            file_path: Path to JSON file.
+        """
+        data = json.loads(file_path.read_text())
+        return cls(
+            **{
+                key: value
+                for key, value in data.items()
+                if key
+                in (
+                    "host",
+                    "port",
+                    "user",
+                    "password",
+                    "database",
+                    "min_connections",
+                    "max_connections",
+                    "compression",
+                )
+            }
+        )
+
+    def _create_tables(self) -> None:
+        def create(connection) -> None:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS ConversationCheckpoints (
+                        conversation_id VARCHAR(255) PRIMARY KEY,
+                        user_id VARCHAR(255) NOT NULL,
+                        created_at BIGINT NOT NULL,
+                        bot_description TEXT,
+                        checkpoint BYTEA NOT NULL,
+                        updated_at TIMESTAMP DEFAULT NOW() NOT NULL
+                    )
+                    """
+                )
+                cursor.execute(
+                    """
+                    CREATE INDEX IF NOT EXISTS ConversationCheckpoints_user_created
+                    ON ConversationCheckpoints (user_id, created_at)
+                    """
+                )
+                cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS ConversationJournal (
+                        id BIGSERIAL PRIMARY KEY,
+                        conversation_id VARCHAR(255) NOT NULL
+                            REFERENCES ConversationCheckpoints ON DELETE CASCADE,
+                        record JSONB NOT NULL,
+                        record_id UUID
+                    )
+                    """
+                )
+                # Tables created before the record ids.
+                cursor.execute(
+                    """
+                    ALTER TABLE ConversationJournal
+                    ADD COLUMN IF NOT EXISTS record_id UUID
+                    """
+                )
+                cursor.execute(
+                    """
+                    CREATE UNIQUE INDEX IF NOT EXISTS ConversationJournal_record_id
+                    ON ConversationJournal (record_id)
+                    """
+                )
+                cursor.execute(
+                    """
+                    CREATE INDEX IF NOT EXISTS ConversationJournal_conversation
+                    ON ConversationJournal (conversation_id, id)
+                    """
+                )
+
+        self._pool.run(create)
+
+    def exists(self, user_id: str, conversation_id: str) -> bool:
+        def read(connection) -> bool:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT 1 FROM ConversationCheckpoints
+                    WHERE user_id = %s AND conversation_id = %s
+                    """,
+                    (user_id, conversation_id),
+                )
+                return cursor.fetchone() is not None
+
+        return self._pool.run(read)
+
+    def load(
+        self, user_id: str, conversation_id: str
+    ) -> Tuple[GPT3ConversationCheckpoint, int]:
+        def read(connection) -> Tuple[GPT3ConversationCheckpoint, int]:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT checkpoint FROM ConversationCheckpoints
+                    WHERE user_id = %s AND conversation_id = %s
+                    """,
+                    (user_id, conversation_id),
+                )
+                row = cursor.fetchone()
+                if row is None:
+                    raise FileNotFoundError(
+                        f"No checkpoint for conversation {conversation_id}"
+                    )
+                checkpoint = GPT3ConversationCheckpoint.from_bytes(bytes(row[0]))
+
+                cursor.execute(
+                    """
+                    SELECT record FROM ConversationJournal
+                    WHERE conversation_id = %s ORDER BY id
+                    """,
+                    (conversation_id,),
+                )
+                records = [JournalRecord(**record) for (record,) in cursor]
+            for record in records:
+                record.apply(checkpoint)
+            return checkpoint, len(records)
+
+        return self._pool.run(read)
+
+    def save(
+        self,
+        user_id: str,
+        conversation_id: str,
+        checkpoint: GPT3ConversationCheckpoint,
+    ) -> None:
+        data = checkpoint.to_bytes(self._compression)
+
+        def write(connection) -> None:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    INSERT INTO ConversationCheckpoints (conversation_id, user_id, created_at, bot_description, checkpoint)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (conversation_id) DO UPDATE SET
+                        bot_description = excluded.bot_description,
+                        checkpoint = excluded.checkpoint,
+                        updated_at = NOW()
+                    """,
+                    (
+                        conversation_id,
+                        user_id,
+                        ConversationIndex.get_created_at(conversation_id),
+                        checkpoint.bot_description,
+                        data,
+                    ),
+                )
+                cursor.execute(
+                    "DELETE FROM ConversationJournal WHERE conversation_id = %s",
+                    (conversation_id,),
+                )
+
+        self._pool.run(write)
+
+    def append_journal(
+        self, user_id: str, conversation_id: str, record: JournalRecord
+    ) -> None:
+        def write(connection) -> None:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    INSERT INTO ConversationJournal (conversation_id, record, record_id)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (record_id) DO NOTHING
+                    """,
+                    (conversation_id, Json(asdict(record)), record.record_id),
+                )
+
+        self._pool.run(write)
+
+    def delete(self, user_id: str, conversation_id: str) -> bool:
+        def write(connection) -> bool:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    DELETE FROM ConversationCheckpoints
+                    WHERE user_id = %s AND conversation_id = %s
+                    """,
+                    (user_id, conversation_id),
+                )
+                return cursor.rowcount > 0
+
+        return self._pool.run(write)
+
+    def delete_user(self, user_id: str) -> None:
+        def write(connection) -> None:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM ConversationCheckpoints WHERE user_id = %s",
+                    (user_id,),
+                )
+
+        self._pool.run(write)
+
+    def get_latest(self, user_id: str) -> Optional[str]:
+        def read(connection) -> Optional[str]:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT conversation_id FROM ConversationCheckpoints
+                    WHERE user_id = %s ORDER BY created_at DESC LIMIT 1
+                    """,
+                    (user_id,),
+                )
+                row = cursor.fetchone()
+                return None if row is None else row[0]
+
+        return self._pool.run(read)
+
+    def list_descriptions(self, user_id: str) -> List[Tuple[str, str]]:
+        def read(connection) -> List[Tuple[str, str]]:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT bot_description, conversation_id FROM ConversationCheckpoints
+                    WHERE user_id = %s ORDER BY created_at
+                    """,
+                    (user_id,),
+                )
+                return [tuple(row) for row in cursor.fetchall()]
+
+        return self._pool.run(read)
+
+    def iter_latest(self) -> Iterator[Tuple[str, str]]:
+        def read(connection) -> List[Tuple[str, str]]:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT DISTINCT ON (user_id) user_id, conversation_id
+                    FROM ConversationCheckpoints
+                    ORDER BY user_id, created_at DESC
+                    """
+                )
+                return [tuple(row) for row in cursor.fetchall()]
+
+        yield from self._pool.run(read)
+
+    def close(self) -> None:
+        self._pool.close()
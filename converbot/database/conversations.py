@@ -1,106 +1,465 @@
-import json
+import asyncio
 import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Tuple, List, Optional, Union
+from typing import Any, Callable, Dict, Iterable, Tuple, List, Optional, Set, Union
 
-from converbot.constants import CONVERSATION_SAVE_DIR
+from converbot.constants import (
+    CONVERSATION_SAVE_DIR,
+    JOURNAL_STORAGE,
+    SNAPSHOT_STORAGE,
+)
 from converbot.core import GPT3Conversation
+from converbot.database.checkpoint_store import (
+    CheckpointStore,
+    FileCheckpointStore,
+)
+from converbot.serialization.checkpoint import JSON_CHECKPOINT_SUFFIX
 
 
 class ConversationDB:
     """
     A database for storing conversations with GPT-3 chatbots.
 
+    Saved conversations are only registered and materialized on first
+    access. With `max_conversations` the least
+    recently used conversations are serialized and evicted from memory, and
+    materialized again on their next access.
+
+    In the journal storage mode a serialization appends the memory change
+    since the previous one to the journal of the checkpoint. Every
+    `journal_compaction_interval` records, and on `serialize_conversations`,
+    the journal is folded into a new checkpoint. Loading a checkpoint always
+    replays its journal.
+
+    The checkpoints are kept in a CheckpointStore, by default a
+    FileCheckpointStore under `conversation_save_dir`.
+
+    Changed conversations can be marked dirty and written behind by
+    `aflush_dirty`. The state to write is captured on the calling thread and
+    written by a single writer thread, in order. A dirty conversation is
+    written before it is evicted or replaced, and `close` writes the rest.
+
     Args:
         conversation_save_dir: The directory to serialize conversations to.
+        max_conversations: The maximum number of conversations kept in memory.
+        storage_mode: The storage mode, SNAPSHOT_STORAGE or JOURNAL_STORAGE.
+        journal_compaction_interval: The number of journal records that
+            triggers a new checkpoint.
+        checkpoint_suffix: The suffix of the checkpoint files written by the
+            default store, one of CHECKPOINT_SUFFIXES.
+        index_path: The path to the SQLite index of the default store.
+        checkpoint_store: The store of the checkpoints, replacing the default
+            one.
+        adopt_saved_users: Whether to look up the store for users unknown to
+            this database, for processes taking users over from each other.
     """
 
     def __init__(
             self,
             conversation_save_dir: Path = CONVERSATION_SAVE_DIR,
+            max_conversations: Optional[int] = None,
+            storage_mode: str = SNAPSHOT_STORAGE,
+            journal_compaction_interval: int = 100,
+            checkpoint_suffix: str = JSON_CHECKPOINT_SUFFIX,
+            index_path: Optional[Path] = None,
+            checkpoint_store: Optional[CheckpointStore] = None,
+            adopt_saved_users: bool = False,
     ) -> None:
-        self._conversation_save_dir = conversation_save_dir
-        self._conversation_save_dir.mkdir(parents=True, exist_ok=True)
+        if storage_mode not in (SNAPSHOT_STORAGE, JOURNAL_STORAGE):
+            raise ValueError(f"Unknown storage mode: {storage_mode}")
+
+        self._max_conversations = max_conversations
+        self._adopt_saved_users = adopt_saved_users
+        self._storage_mode = storage_mode
+        self._journal_compaction_interval = journal_compaction_interval
+        self._store = checkpoint_store or FileCheckpointStore(
+            conversation_save_dir, checkpoint_suffix, index_path
+        )
 
-        self._user_to_conversation: Dict[str, GPT3Conversation] = {}
+        self._user_to_conversation: "OrderedDict[str, GPT3Conversation]" = OrderedDict()
         self._user_to_conversation_id: Dict[str, str] = {}
         self._conversation_id_to_bot_description: Dict[str, str] = {}
+        self._saved_users: Set[str] = set()
+        # Users without a saved conversation when last looked up.
+        self._unsaved_users: Set[str] = set()
+        self._user_to_journal_cursor: Dict[str, Tuple[int, int, str]] = {}
+        self._user_to_journal_length: Dict[str, int] = {}
+        self._user_to_dirty_since: Dict[str, float] = {}
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._user_to_pending_writes: Dict[str, List[Future]] = {}
+
+        self._evictions = 0
+        self._reloads = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """
+        The number of conversations in memory, evicted and materialized.
+        """
+        return {
+            "live_conversations": len(self._user_to_conversation),
+            "evictions": self._evictions,
+            "reloads": self._reloads,
+        }
 
     def exists(self, user_id: int) -> bool:
-        return str(user_id) in self._user_to_conversation
+        return (
+            str(user_id) in self._user_to_conversation
+            or str(user_id) in self._saved_users
+        )
 
     def remove_conversation(self, user_id: int) -> None:
         self._user_to_conversation.pop(str(user_id), None)
+        self._saved_users.discard(str(user_id))
+        self._user_to_dirty_since.pop(str(user_id), None)
+
+    async def aget_conversation(self, user_id: int) -> GPT3Conversation:
+        conversation = self._user_to_conversation.get(str(user_id), None)
+        if conversation is not None:
+            self._user_to_conversation.move_to_end(str(user_id))
+        elif str(user_id) in self._saved_users or self._adopt_user(str(user_id)):
+            conversation = await self._ahydrate_conversation(str(user_id))
+        return conversation
+
+    def _adopt_user(self, user_id: str) -> bool:
+        """
+        Register the latest saved conversation of a user unknown to this
+        database, e.g. saved by another process sharing the store. The users
+        without one aren't looked up again until the users are released.
+
+        Args:
+            user_id: Telegram user_id of the user.
+
+        Returns: Whether the user has a saved conversation.
+        """
+        if (
+                not self._adopt_saved_users
+                or user_id in self._user_to_conversation_id
+                or user_id in self._unsaved_users
+        ):
+            return False
+        conversation_id = self._store.get_latest(user_id)
+        if conversation_id is None:
+            self._unsaved_users.add(user_id)
+            return False
+        self._saved_users.add(user_id)
+        self._user_to_conversation_id[user_id] = conversation_id
+        return True
+
+    async def _ahydrate_conversation(self, user_id: str) -> GPT3Conversation:
+        """
+        Materialize the registered conversation of the user from its checkpoint.
 
-    def get_conversation(self, user_id: int) -> GPT3Conversation:
-        return self._user_to_conversation.get(str(user_id), None)
+        Args:
+            user_id: Telegram user_id of the user.
+        """
+        # The checkpoint may still be being written, e.g. by the eviction.
+        await self._await_pending_writes(user_id)
+        conversation = self._user_to_conversation.get(user_id)
+        if conversation is not None:
+            # Materialized by another task meanwhile.
+            return conversation
+        conversation_id = self._user_to_conversation_id[user_id]
+        checkpoint, journal_length = self._store.load(user_id, conversation_id)
+        self._saved_users.discard(user_id)
+        conversation = GPT3Conversation.from_checkpoint_data(checkpoint)
+        self._user_to_journal_cursor[user_id] = conversation.memory_cursor()
+        self._user_to_journal_length[user_id] = journal_length
+
+        self._conversation_id_to_bot_description[conversation_id] = checkpoint.bot_description
+        self._user_to_conversation[user_id] = conversation
+        self._reloads += 1
+        await self._aevict_conversations()
+        return conversation
+
+    async def _aevict_conversations(self) -> None:
+        """
+        Serialize and evict the least recently used conversations exceeding
+        the capacity.
+        """
+        if self._max_conversations is None:
+            return
+        while len(self._user_to_conversation) > self._max_conversations:
+            user_id = next(iter(self._user_to_conversation))
+            # Captured and dropped at once, the conversation may be used and
+            # materialized again while it is written.
+            write = None
+            if user_id in self._user_to_dirty_since:
+                write = self._capture_conversation(user_id)
+            conversation = self._user_to_conversation.pop(user_id)
+            self._saved_users.add(user_id)
+            self._evictions += 1
+            if write is None:
+                continue
+            try:
+                await asyncio.wrap_future(self._submit_write([user_id], write))
+            except Exception:
+                if user_id in self._saved_users:
+                    # Kept in memory until it can be written.
+                    self._saved_users.discard(user_id)
+                    self._user_to_conversation[user_id] = conversation
+                    self._user_to_dirty_since.setdefault(user_id, time.monotonic())
+                raise
+
+    async def _awrite_before_replacing(self, user_id: str) -> None:
+        """
+        Write the live conversation of the user if it is dirty, and wait for
+        its queued writes, before it is dropped from memory.
+
+        Args:
+            user_id: Telegram user_id of the user.
+        """
+        if user_id in self._user_to_conversation and user_id in self._user_to_dirty_since:
+            await self.aserialize_user_conversation(user_id)
+        else:
+            # A write captured by aflush_dirty may still be queued.
+            await self._await_pending_writes(user_id)
+
+    def _submit_write(
+            self, user_ids: Iterable[str], write: Callable[..., Any], *args: Any
+    ) -> Future:
+        """
+        Queue a write on the writer thread, tracking it as pending for the users.
+
+        Args:
+            user_ids: The users whose conversations are written.
+            write: The write to run on the writer thread.
+            *args: The arguments of the write.
+
+        Returns: The future of the write.
+        """
+        future = self._writer.submit(write, *args)
+        for user_id in user_ids:
+            pending = self._user_to_pending_writes.get(user_id, [])
+            self._user_to_pending_writes[user_id] = [
+                pending_write for pending_write in pending if not pending_write.done()
+            ] + [future]
+        return future
+
+    async def _await_pending_writes(self, user_id: str) -> None:
+        """
+        Wait for the queued writes of the user, without waiting for the others.
+
+        Args:
+            user_id: Telegram user_id of the user.
+        """
+        pending = [
+            future
+            for future in self._user_to_pending_writes.pop(user_id, [])
+            if not future.done()
+        ]
+        if pending:
+            # The failures are reported by the writes.
+            await asyncio.gather(
+                *(asyncio.wrap_future(future) for future in pending),
+                return_exceptions=True,
+            )
 
     def get_conversation_id(self, user_id: int) -> str:
         return self._user_to_conversation_id.get(str(user_id), None)
 
-    def add_conversation(
+    async def aadd_conversation(
             self, user_id: int, conversation: GPT3Conversation, bot_description: str
     ) -> str:
         conversation_id = f"{user_id}-{int(time.time())}"
+        await self._awrite_before_replacing(str(user_id))
         self._user_to_conversation[str(user_id)] = conversation
         self._user_to_conversation_id[str(user_id)] = conversation_id
+        self._saved_users.discard(str(user_id))
+        self._user_to_journal_cursor.pop(str(user_id), None)
         self._conversation_id_to_bot_description[conversation_id] = bot_description
+        self._user_to_conversation.move_to_end(str(user_id))
+        self._user_to_dirty_since[str(user_id)] = time.monotonic()
+        await self._aevict_conversations()
         return conversation_id
 
-    def serialize_user_conversation(self, user_id: int) -> None:
+    async def amark_dirty(
+            self, user_id: int, conversation: Optional[GPT3Conversation] = None
+    ) -> None:
         """
-        Serialize the conversations to disk.
+        Mark the conversation of the user as changed since it was written.
 
-        Returns: None
+        Args:
+            user_id: Telegram user_id of the user.
+            conversation: The conversation of the user, pass it if it may have
+                been evicted since it was taken.
         """
         user_id = str(user_id)
-        conversation_id = self._user_to_conversation_id[user_id]
-        chatbot_description = self._conversation_id_to_bot_description[conversation_id]
-        conversation_save_path = self._conversation_save_dir / str(user_id)
-        conversation_save_path.mkdir(exist_ok=True)
-        conversation_save_path = (
-                conversation_save_path / self._user_to_conversation_id[user_id]
+        if user_id not in self._user_to_conversation_id:
+            # Released to another process, which serves the user now.
+            print(f"Dropping the changes of released user {user_id}")
+            return
+        if conversation is not None and conversation is not self._user_to_conversation.get(user_id):
+            # Evicted while in use, so the eviction missed the last changes.
+            await self.aserialize_user_conversation(user_id, conversation)
+            return
+        self._user_to_dirty_since.setdefault(user_id, time.monotonic())
+
+    async def aflush_dirty(self, max_dirty_age: float = 0.0) -> int:
+        """
+        Write the conversations dirty for at least `max_dirty_age` seconds
+        without blocking the event loop.
+
+        Args:
+            max_dirty_age: The minimum number of seconds since a conversation
+                became dirty for it to be written.
+
+        Returns: The number of conversations written.
+        """
+        now = time.monotonic()
+        writes = {
+            user_id: self._capture_conversation(user_id)
+            for user_id, dirty_since in list(self._user_to_dirty_since.items())
+            if now - dirty_since >= max_dirty_age and user_id in self._user_to_conversation
+        }
+        if not writes:
+            return 0
+
+        failed = await asyncio.wrap_future(
+            self._submit_write(writes, self._run_writes, writes)
         )
-        conversation_save_path = conversation_save_path.with_suffix(".json")
-        self._user_to_conversation[user_id].save(conversation_save_path, bot_description=chatbot_description)
+        for user_id in failed:
+            self._user_to_dirty_since.setdefault(user_id, now)
+            # The journal may not have a checkpoint to follow anymore.
+            self._user_to_journal_cursor.pop(user_id, None)
+        return len(writes) - len(failed)
+
+    @staticmethod
+    def _run_writes(writes: Dict[str, Callable[[], None]]) -> List[str]:
+        """
+        Run the captured writes.
 
+        Args:
+            writes: The writes by user_id.
 
-    def serialize_conversations(self) -> None:
+        Returns: The user_ids whose writes failed.
         """
-        Serialize the conversations to disk.
+        failed = []
+        for user_id, write in writes.items():
+            try:
+                write()
+            except Exception as e:
+                print(e)
+                failed.append(user_id)
+        return failed
+
+    def serialize_user_conversation(
+            self,
+            user_id: int,
+            conversation: Optional[GPT3Conversation] = None,
+            compact: bool = False,
+    ) -> None:
+        """
+        Serialize the conversation of the user.
+
+        Args:
+            user_id: Telegram user_id of the user.
+            conversation: The conversation of the user, pass it if it may have
+                been evicted since it was taken.
+            compact: Whether to write a checkpoint even in the journal mode.
 
         Returns: None
         """
-        for user_id, conversation in self._user_to_conversation.items():
-            conversation_id = self._user_to_conversation_id[user_id]
-            chatbot_description = self._conversation_id_to_bot_description[conversation_id]
+        write = self._capture_conversation(str(user_id), conversation, compact)
+        self._writer.submit(write).result()
 
-            conversation_save_path = self._conversation_save_dir / str(user_id)
-            conversation_save_path.mkdir(exist_ok=True)
+    async def aserialize_user_conversation(
+            self,
+            user_id: int,
+            conversation: Optional[GPT3Conversation] = None,
+            compact: bool = False,
+    ) -> None:
+        """
+        Serialize the conversation of the user without blocking the event loop.
 
-            conversation_save_path = (
-                    conversation_save_path / self._user_to_conversation_id[user_id]
-            )
-            conversation_save_path = conversation_save_path.with_suffix(".json")
+        Args:
+            user_id: Telegram user_id of the user.
+            conversation: The conversation of the user, pass it if it may have
+                been evicted since it was taken.
+            compact: Whether to write a checkpoint even in the journal mode.
 
-            conversation.save(conversation_save_path, bot_description=chatbot_description)
+        Returns: None
+        """
+        write = self._capture_conversation(str(user_id), conversation, compact)
+        await asyncio.wrap_future(self._submit_write([str(user_id)], write))
 
-    @staticmethod
-    def get_latest_conversation_checkpoint_path(
-            checkpoints_path: Path,
-    ) -> Tuple[Path, str]:
+    def _capture_conversation(
+            self,
+            user_id: str,
+            conversation: Optional[GPT3Conversation] = None,
+            compact: bool = False,
+    ) -> Callable[[], None]:
+        """
+        Capture the state of the conversation to write and mark it clean.
+
+        Args:
+            user_id: Telegram user_id of the user.
+            conversation: The conversation of the user, defaults to the live one.
+            compact: Whether to write a checkpoint even in the journal mode.
+
+        Returns: The write of the captured state, safe to run on another thread.
+        """
+        live_conversation = self._user_to_conversation.get(user_id)
+        conversation = conversation or live_conversation
+        conversation_id = self._user_to_conversation_id[user_id]
+        self._user_to_dirty_since.pop(user_id, None)
+
+        if (
+                self._storage_mode == JOURNAL_STORAGE
+                and not compact
+                # The journal cursor belongs to the live conversation.
+                and conversation is live_conversation
+        ):
+            write = self._capture_journal(user_id, conversation_id, conversation)
+            if write is not None:
+                return write
+
+        chatbot_description = self._conversation_id_to_bot_description.get(conversation_id)
+        checkpoint = conversation.to_checkpoint(chatbot_description)
+        self._user_to_journal_cursor[user_id] = conversation.memory_cursor()
+        self._user_to_journal_length[user_id] = 0
+
+        return lambda: self._store.save(user_id, conversation_id, checkpoint)
+
+    def _capture_journal(
+            self, user_id: str, conversation_id: str, conversation: GPT3Conversation
+    ) -> Optional[Callable[[], None]]:
         """
-        Find the latest conversation checkpoint for the user at disk.
+        Capture the memory change of the conversation for its journal.
+
+        The cursor is only set once the conversation has a checkpoint, loaded
+        or queued for writing, for the journal to follow.
 
         Args:
-            checkpoints_path: The path to the checkpoints directory.
+            user_id: Telegram user_id of the user.
+            conversation_id: The conversation id.
+            conversation: The conversation of the user.
+
+        Returns: The journal append, or None if a checkpoint is due.
+        """
+        cursor = self._user_to_journal_cursor.get(user_id)
+        journal_length = self._user_to_journal_length.get(user_id, 0)
+        if cursor is None or journal_length >= self._journal_compaction_interval:
+            return None
+
+        record = conversation.memory_delta(cursor)
+        self._user_to_journal_cursor[user_id] = conversation.memory_cursor()
+        if record.empty:
+            return lambda: None
+
+        self._user_to_journal_length[user_id] = journal_length + 1
+        return lambda: self._store.append_journal(user_id, conversation_id, record)
+
+    def serialize_conversations(self) -> None:
         """
-        checkpoints = list(checkpoints_path.glob("*.json"))
-        latest_checkpoint = sorted(
-            checkpoints, key=lambda x: int(x.name.split("-")[-1].replace(".json", "")), reverse=True
-        )[0]
+        Serialize the conversations, folding their journals into checkpoints.
 
-        return latest_checkpoint, latest_checkpoint.stem
+        Returns: None
+        """
+        for user_id in list(self._user_to_conversation):
+            self.serialize_user_conversation(user_id, compact=True)
 
     def get_companion_descriptions_list(
             self,
@@ -112,53 +471,31 @@ class ConversationDB:
         Args:
             user_id: Telegram user_ids of the user.
         """
-        checkpoints = list(self._conversation_save_dir.rglob(f"{user_id}-*.json"))
-        bot_descriptions = []
-        for file in checkpoints:
-            data = json.loads(file.read_text())
-            bot_descriptions.append((data["bot_description"], file.stem))
+        bot_descriptions = self._store.list_descriptions(str(user_id))
         if len(bot_descriptions) == 0:
             return None
         return bot_descriptions
 
-    def get_checkpoint_path_by_conversation_id(
-            self,
-            user_id: int,
-            conversation_id: str
-    ) -> Path:
-        """
-        Find the checkpoint path by conversation id of the user.
-
-        Args:
-            conversation_id: conversation id of the user.
-            user_id: Telegram user_ids of the user.
-        """
-
-        path = self._conversation_save_dir / str(user_id) / conversation_id
-        path = path.with_suffix('.json')
-        return path
-
     def delete_conversation(
             self,
             user_id: int,
             conversation_id: str
     ) -> str:
-        file_path = self.get_checkpoint_path_by_conversation_id(user_id, conversation_id)
-        if file_path.exists():
-            file_path.unlink()
+        if self._store.delete(str(user_id), conversation_id):
             return f"#{conversation_id} conversation ID has been delete."
         else:
             return f"#{conversation_id} conversation ID does not exist."
 
-    def load_conversation(
+    async def aload_conversation(
             self,
             user_id: int,
             conversation_id: str
     ) -> str:
-        file_path = self.get_checkpoint_path_by_conversation_id(user_id, conversation_id)
-        if file_path.exists():
-            conversation = GPT3Conversation.from_checkpoint(file_path)
-            self._user_to_conversation[str(user_id)] = conversation
+        if self._store.exists(str(user_id), conversation_id):
+            await self._awrite_before_replacing(str(user_id))
+            self._user_to_conversation.pop(str(user_id), None)
+            self._saved_users.add(str(user_id))
+            self._user_to_journal_cursor.pop(str(user_id), None)
             self._user_to_conversation_id[
                 str(user_id)
             ] = conversation_id
@@ -171,31 +508,88 @@ class ConversationDB:
             self,
             user_id: int
     ) -> str:
-        directory_path = self._conversation_save_dir / str(user_id)
-        for file_path in directory_path.glob("*.json"):
-            file_path.unlink()
+        self._store.delete_user(str(user_id))
         return "All conversation ID`s deleted successfully."
 
-    def load_conversations(self) -> None:
+    def load_conversations(
+            self, owns: Optional[Callable[[str], bool]] = None
+    ) -> None:
         """
-        Load the conversations from disk.
+        Register the latest saved conversation of every user. The
+        conversations are materialized on first access.
+
+        Args:
+            owns: Whether a user_id is served by this database, all users by
+                default.
 
         Returns: None
         """
-        for user_id in self._conversation_save_dir.iterdir():
-            if user_id.is_dir() and len(list(user_id.iterdir())) > 0:
-                (
-                    checkpoint,
-                    conversation_id,
-                ) = self.get_latest_conversation_checkpoint_path(user_id)
-                conversation = GPT3Conversation.from_checkpoint(checkpoint)
-                self._user_to_conversation[str(user_id.name)] = conversation
-                self._user_to_conversation_id[
-                    str(user_id.name)
-                ] = conversation_id
+        self._unsaved_users.clear()
+        for user_id, conversation_id in self._store.iter_latest():
+            if owns is not None and not owns(user_id):
+                continue
+            self._saved_users.add(user_id)
+            self._user_to_conversation_id[user_id] = conversation_id
+
+    async def arelease_users(self, owns: Callable[[str], bool]) -> int:
+        """
+        Write and forget the conversations of the users no longer served by
+        this database, so another process can take them over from the store.
 
-    def __del__(self) -> None:
+        Args:
+            owns: Whether a user_id is still served by this database.
+
+        Returns: The number of users released.
+        """
+        # Other processes may have saved the users gained by this one.
+        self._unsaved_users.clear()
+        released = [
+            user_id for user_id in self._user_to_conversation_id if not owns(user_id)
+        ]
+        writes = {
+            user_id: self._capture_conversation(user_id, compact=True)
+            for user_id in released
+            if user_id in self._user_to_conversation
+            and user_id in self._user_to_dirty_since
+        }
+        try:
+            if writes:
+                await asyncio.wrap_future(
+                    self._submit_write(writes, self._run_writes, writes)
+                )
+        finally:
+            # Forgotten only once written, the conversation ids are needed
+            # until then.
+            for user_id in released:
+                self._forget_user(user_id)
+        return len(released)
+
+    def discard_users(self) -> int:
+        """
+        Forget every user without writing, after another process took them
+        over and may have changed them since.
+
+        Returns: The number of users discarded.
+        """
+        self._unsaved_users.clear()
+        users = list(self._user_to_conversation_id)
+        for user_id in users:
+            self._forget_user(user_id)
+        return len(users)
+
+    def _forget_user(self, user_id: str) -> None:
+        self._user_to_conversation.pop(user_id, None)
+        self._saved_users.discard(user_id)
+        self._user_to_dirty_since.pop(user_id, None)
+        self._user_to_journal_cursor.pop(user_id, None)
+        self._user_to_journal_length.pop(user_id, None)
+        self._user_to_conversation_id.pop(user_id, None)
+        self._user_to_pending_writes.pop(user_id, None)
+
+    def close(self) -> None:
         """
-        Serialize the conversations to disk when the object is deleted.
+        Serialize the conversations, then stop the writer and close the store.
         """
         self.serialize_conversations()
+        self._writer.shutdown(wait=True)
+        self._store.close()
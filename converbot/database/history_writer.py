@@ -1,23 +1,118 @@
+import asyncio
 import datetime
 import json
+import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import (
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+)
 
-import psycopg2
+from psycopg2.extras import execute_values
 
 from converbot.constants import DEV_ENV
+from converbot.database.postgres import PostgresPool
+
+T = TypeVar("T")
+
+HISTORY_COLUMNS = (
+    "id, conversation_id, user_id, user_message, chatbot_message, env, timestamp"
+)
+
+_PARTITION_NAME_PATTERN = re.compile(r"conversationhistory_(\d{4})_(\d{2})")
+
+
+def _month_start(timestamp: datetime.datetime) -> datetime.date:
+    return datetime.date(timestamp.year, timestamp.month, 1)
+
+
+def _next_month(month: datetime.date) -> datetime.date:
+    if month.month == 12:
+        return datetime.date(month.year + 1, 1, 1)
+    return datetime.date(month.year, month.month + 1, 1)
+
+
+def _previous_month(month: datetime.date) -> datetime.date:
+    if month.month == 1:
+        return datetime.date(month.year - 1, 12, 1)
+    return datetime.date(month.year, month.month - 1, 1)
+
+
+def _partition_name(month: datetime.date) -> str:
+    return f"conversationhistory_{month.year:04d}_{month.month:02d}"
+
+
+def _partition_month(partition_name: str) -> datetime.date:
+    year, month = _PARTITION_NAME_PATTERN.fullmatch(partition_name).groups()
+    return datetime.date(int(year), int(month), 1)
+
+
+def new_record_id() -> str:
+    """
+    Create the client id of a history row.
+    """
+    return str(uuid.uuid4())
+
+
+class HistoryRecord(NamedTuple):
+    """
+    A row of the ConversationHistory table.
+
+    The record id makes writing the row idempotent: a row written again,
+    e.g. after its commit was acknowledged on a dropped connection, is
+    skipped. Set it when the row is created, so every retry reuses it.
+    """
+
+    conversation_id: str
+    user_id: int
+    user_message: str
+    chatbot_message: str
+    env: str
+    timestamp: datetime.datetime
+    record_id: Optional[str] = None
 
 
 class SQLHistoryWriter:
     """
     A class to manage the ConversationHistory database.
 
+    With `partitioned` the table is partitioned by month of the timestamp,
+    and the partitions are created on demand before rows are written to them.
+    `apply_retention` detaches or drops the partitions older than
+    `retention_months`. An existing unpartitioned table is kept as it is and
+    not partitioned, migrating it into a partitioned one is left to the
+    operator.
+
+    Connections are taken from a thread-safe pool and checked before use.
+    Broken connections are replaced, and an operation that fails on a dropped
+    connection is retried once on a fresh one. The `a`-prefixed methods run
+    on a thread pool sized to the connection pool, so they don't block the
+    event loop.
+
     Args:
         host: PostgreSQL Database host.
         port: PostgreSQL Database port.
         user: PostgreSQL Database user.
         password: PostgreSQL Database user password.
         database: PostgreSQL Database name.
+        min_connections: The number of connections kept open.
+        max_connections: The maximum number of open connections.
+        partitioned: Whether to partition the table by month.
+        retention_months: The number of whole months of history to keep,
+            besides the current one, None to keep everything.
+        archive_expired: Whether expired partitions are detached and kept as
+            `archived_`-prefixed tables instead of dropped.
         **kwargs: Additional arguments to pass to psycopg2.connect.
     """
 
@@ -28,9 +123,16 @@ class SQLHistoryWriter:
         user: str,
         password: str,
         database: str,
+        min_connections: int = 1,
+        max_connections: int = 10,
+        partitioned: bool = False,
+        retention_months: Optional[int] = None,
+        archive_expired: bool = True,
         **kwargs
     ) -> None:
-        self._connection = psycopg2.connect(
+        self._pool = PostgresPool(
+            min_connections,
+            max_connections,
             host=host,
             port=port,
             user=user,
@@ -38,6 +140,13 @@ class SQLHistoryWriter:
             database=database,
             **kwargs
         )
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_connections, thread_name_prefix="history_writer"
+        )
+        self._partitioned = partitioned
+        self._retention_months = retention_months
+        self._archive_expired = archive_expired
+        self._partitions: Set[datetime.date] = set()
 
         self._create_database()
 
@@ -53,27 +162,199 @@ class SQLHistoryWriter:
         return cls(**data)
 
     def __del__(self) -> None:
-        self._connection.close()
+        self.close()
+
+    def close(self) -> None:
+        """
+        Close the connections.
+        """
+        pool = getattr(self, "_pool", None)
+        if pool is not None:
+            pool.close()
+        executor = getattr(self, "_executor", None)
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def _run(self, operation: Callable[[Any], T]) -> T:
+        return self._pool.run(operation)
+
+    async def _arun(self, function: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, lambda: function(*args, **kwargs)
+        )
 
     def _create_database(self) -> None:
         """
         Create the ConversationHistory database.
         """
-        with self._connection.cursor() as cursor:
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS ConversationHistory (
-                    id SERIAL PRIMARY KEY,
-                    conversation_id VARCHAR(255) NOT NULL,
-                    user_id BIGINT NOT NULL,
-                    user_message TEXT,
-                    chatbot_message TEXT,
-                    env VARCHAR(255) NOT NULL,
-                    timestamp TIMESTAMP DEFAULT NOW() NOT NULL
+
+        def create(connection) -> None:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT relkind FROM pg_class
+                    WHERE oid = to_regclass('conversationhistory')
+                    """
                 )
-                """
-            )
-        self._connection.commit()
+                row = cursor.fetchone()
+                if self._partitioned and row is not None and row[0] != "p":
+                    print(
+                        "ConversationHistory exists and is not partitioned, "
+                        "writing to it unpartitioned without retention"
+                    )
+                    self._partitioned = False
+                if self._partitioned:
+                    cursor.execute(
+                        """
+                        CREATE TABLE IF NOT EXISTS ConversationHistory (
+                            id BIGSERIAL,
+                            conversation_id VARCHAR(255) NOT NULL,
+                            user_id BIGINT NOT NULL,
+                            user_message TEXT,
+                            chatbot_message TEXT,
+                            env VARCHAR(255) NOT NULL,
+                            timestamp TIMESTAMP DEFAULT NOW() NOT NULL,
+                            record_id UUID,
+                            PRIMARY KEY (id, timestamp)
+                        ) PARTITION BY RANGE (timestamp)
+                        """
+                    )
+                else:
+                    cursor.execute(
+                        """
+                        CREATE TABLE IF NOT EXISTS ConversationHistory (
+                            id SERIAL PRIMARY KEY,
+                            conversation_id VARCHAR(255) NOT NULL,
+                            user_id BIGINT NOT NULL,
+                            user_message TEXT,
+                            chatbot_message TEXT,
+                            env VARCHAR(255) NOT NULL,
+                            timestamp TIMESTAMP DEFAULT NOW() NOT NULL,
+                            record_id UUID
+                        )
+                        """
+                    )
+                # Tables created before the record ids get the column added.
+                cursor.execute(
+                    """
+                    ALTER TABLE ConversationHistory
+                    ADD COLUMN IF NOT EXISTS record_id UUID
+                    """
+                )
+                # A unique index of a partitioned table has to include the
+                # partition key.
+                cursor.execute(
+                    """
+                    CREATE UNIQUE INDEX IF NOT EXISTS ConversationHistory_record_id
+                    ON ConversationHistory (record_id, timestamp)
+                    """
+                )
+                cursor.execute(
+                    """
+                    CREATE INDEX IF NOT EXISTS ConversationHistory_conversation_timestamp
+                    ON ConversationHistory (conversation_id, timestamp, id)
+                    """
+                )
+                cursor.execute(
+                    """
+                    CREATE INDEX IF NOT EXISTS ConversationHistory_user_timestamp
+                    ON ConversationHistory (user_id, timestamp, id)
+                    """
+                )
+                cursor.execute(
+                    """
+                    CREATE INDEX IF NOT EXISTS ConversationHistory_env
+                    ON ConversationHistory (env)
+                    """
+                )
+
+        self._run(create)
+        if self._partitioned:
+            month = _month_start(datetime.datetime.now())
+            self._ensure_partitions([month, _next_month(month)])
+
+    def _ensure_partitions(self, months: Iterable[datetime.date]) -> None:
+        """
+        Create the monthly partitions missing for the given months.
+
+        Args:
+            months: The first days of the months.
+        """
+        missing = sorted(set(months) - self._partitions)
+        if not missing:
+            return
+
+        def create(connection) -> None:
+            with connection.cursor() as cursor:
+                for month in missing:
+                    cursor.execute(
+                        f"""
+                        CREATE TABLE IF NOT EXISTS {_partition_name(month)}
+                        PARTITION OF ConversationHistory
+                        FOR VALUES FROM (%s) TO (%s)
+                        """,
+                        (month, _next_month(month)),
+                    )
+
+        # In its own transaction, so the lock on the parent table is short.
+        self._run(create)
+        self._partitions.update(missing)
+
+    def apply_retention(self) -> List[str]:
+        """
+        Detach or drop the monthly partitions older than `retention_months`.
+        Does nothing when the table isn't partitioned.
+
+        Returns: The names of the expired partitions.
+        """
+        if not self._partitioned or self._retention_months is None:
+            return []
+
+        cutoff = _month_start(datetime.datetime.now())
+        for _ in range(self._retention_months):
+            cutoff = _previous_month(cutoff)
+
+        def expire(connection) -> List[str]:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT child.relname FROM pg_inherits
+                    JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+                    JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+                    WHERE parent.relname = 'conversationhistory'
+                    """
+                )
+                expired = [
+                    name
+                    for (name,) in cursor.fetchall()
+                    if _PARTITION_NAME_PATTERN.fullmatch(name)
+                    and _partition_month(name) < cutoff
+                ]
+                for name in expired:
+                    if self._archive_expired:
+                        cursor.execute(
+                            f"ALTER TABLE ConversationHistory DETACH PARTITION {name}"
+                        )
+                        cursor.execute(
+                            f"ALTER TABLE {name} RENAME TO archived_{name}"
+                        )
+                    else:
+                        cursor.execute(f"DROP TABLE {name}")
+            return expired
+
+        expired = self._run(expire)
+        self._partitions = {
+            month for month in self._partitions if month >= cutoff
+        }
+        return expired
+
+    async def aapply_retention(self) -> List[str]:
+        """
+        Detach or drop the expired partitions without blocking the event loop.
+        See `apply_retention`.
+        """
+        return await self._arun(self.apply_retention)
 
     def write_message(
         self,
@@ -82,7 +363,7 @@ class SQLHistoryWriter:
         user_message: str,
         chatbot_message: str,
         env: str = DEV_ENV,
-        timestamp: Optional[str] = None,
+        timestamp: Optional[datetime.datetime] = None,
     ) -> None:
         """
         Add a new row to the ConversationHistory table.
@@ -93,42 +374,254 @@ class SQLHistoryWriter:
             user_message: Message sent by the user.
             chatbot_message: Message sent by the chatbot.
             env: Environment where the message was sent (default: PROD_ENV).
-            timestamp: Timestamp for the message.
+            timestamp: Timestamp for the message, now by default.
         """
-        timestamp = (
-            timestamp
-            if timestamp
-            else datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        )
-        with self._connection.cursor() as cursor:
-            cursor.execute(
-                """
-                INSERT INTO ConversationHistory (conversation_id, user_id, user_message, chatbot_message, env, timestamp)
-                VALUES (%s, %s, %s, %s, %s, to_timestamp(%s, 'YYYY-MM-DD HH24:MI:SS'))
-                """,
-                (
+        self.write_messages(
+            [
+                HistoryRecord(
                     conversation_id,
                     user_id,
                     user_message,
                     chatbot_message,
                     env,
-                    timestamp,
-                ),
+                    timestamp or datetime.datetime.now(),
+                    new_record_id(),
+                )
+            ]
+        )
+
+    def write_messages(
+        self, records: Sequence[HistoryRecord], page_size: int = 1000
+    ) -> None:
+        """
+        Add rows to the ConversationHistory table with multi-row inserts in a
+        single transaction. Rows already written with the same record id are
+        skipped.
+
+        Args:
+            records: The rows to add, rows without a record id get one.
+            page_size: The maximum number of rows per INSERT statement.
+        """
+        records = [
+            record if record.record_id is not None
+            else record._replace(record_id=new_record_id())
+            for record in records
+        ]
+
+        def write(connection) -> None:
+            with connection.cursor() as cursor:
+                execute_values(
+                    cursor,
+                    """
+                    INSERT INTO ConversationHistory (conversation_id, user_id, user_message, chatbot_message, env, timestamp, record_id)
+                    VALUES %s
+                    ON CONFLICT (record_id, timestamp) DO NOTHING
+                    """,
+                    records,
+                    page_size=page_size,
+                )
+
+        if not records:
+            return
+        if self._partitioned:
+            self._ensure_partitions(
+                _month_start(record.timestamp) for record in records
             )
-        self._connection.commit()
+        self._run(write)
+
+    async def awrite_messages(
+        self, records: Sequence[HistoryRecord], page_size: int = 1000
+    ) -> None:
+        """
+        Add rows to the ConversationHistory table without blocking the event
+        loop. See `write_messages`.
+        """
+        await self._arun(self.write_messages, records, page_size=page_size)
 
-    def get_all_messages(self):
+    async def awrite_message(
+        self,
+        conversation_id: str,
+        user_id: int,
+        user_message: str,
+        chatbot_message: str,
+        env: str = DEV_ENV,
+        timestamp: Optional[datetime.datetime] = None,
+    ) -> None:
+        """
+        Add a new row to the ConversationHistory table without blocking the
+        event loop. See `write_message`.
+        """
+        await self._arun(
+            self.write_message,
+            conversation_id=conversation_id,
+            user_id=user_id,
+            user_message=user_message,
+            chatbot_message=chatbot_message,
+            env=env,
+            timestamp=timestamp,
+        )
+
+    def get_all_messages(self) -> List[Tuple]:
         """
         Returns a list of all messages in the ConversationHistory table.
+
+        Prefer `iter_messages` for large tables.
         """
-        with self._connection.cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT * FROM ConversationHistory
-                """
-            )
-            rows = cursor.fetchall()
-        return rows
+        return list(self.iter_messages())
+
+    async def aget_all_messages(self) -> List[Tuple]:
+        """
+        Returns a list of all messages in the ConversationHistory table
+        without blocking the event loop.
+        """
+        return await self._arun(self.get_all_messages)
+
+    def get_last_messages(
+        self,
+        conversation_id: str,
+        limit: int = 20,
+        before: Optional[Tuple[datetime.datetime, int]] = None,
+    ) -> List[Tuple]:
+        """
+        Returns a page of the latest messages of a conversation, newest first.
+
+        Args:
+            conversation_id: Unique ID for the conversation.
+            limit: The maximum number of messages.
+            before: The (timestamp, id) of the last message of the previous
+                page, None for the first page.
+        """
+
+        def read(connection) -> List[Tuple]:
+            with connection.cursor() as cursor:
+                if before is None:
+                    cursor.execute(
+                        f"""
+                        SELECT {HISTORY_COLUMNS} FROM ConversationHistory
+                        WHERE conversation_id = %s
+                        ORDER BY timestamp DESC, id DESC LIMIT %s
+                        """,
+                        (conversation_id, limit),
+                    )
+                else:
+                    cursor.execute(
+                        f"""
+                        SELECT {HISTORY_COLUMNS} FROM ConversationHistory
+                        WHERE conversation_id = %s AND (timestamp, id) < (%s, %s)
+                        ORDER BY timestamp DESC, id DESC LIMIT %s
+                        """,
+                        (conversation_id, *before, limit),
+                    )
+                return cursor.fetchall()
+
+        return self._run(read)
+
+    async def aget_last_messages(
+        self,
+        conversation_id: str,
+        limit: int = 20,
+        before: Optional[Tuple[datetime.datetime, int]] = None,
+    ) -> List[Tuple]:
+        """
+        Returns a page of the latest messages of a conversation without
+        blocking the event loop. See `get_last_messages`.
+        """
+        return await self._arun(
+            self.get_last_messages, conversation_id, limit=limit, before=before
+        )
+
+    def get_user_messages(
+        self,
+        user_id: int,
+        start: datetime.datetime,
+        end: datetime.datetime,
+        limit: int = 100,
+        after: Optional[Tuple[datetime.datetime, int]] = None,
+    ) -> List[Tuple]:
+        """
+        Returns a page of the messages of a user in a time range, oldest first.
+
+        Args:
+            user_id: ID of the user.
+            start: The start of the time range, inclusive.
+            end: The end of the time range, exclusive.
+            limit: The maximum number of messages.
+            after: The (timestamp, id) of the last message of the previous
+                page, None for the first page.
+        """
+
+        def read(connection) -> List[Tuple]:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    SELECT {HISTORY_COLUMNS} FROM ConversationHistory
+                    WHERE user_id = %s AND timestamp >= %s AND timestamp < %s
+                        AND (timestamp, id) > (%s, %s)
+                    ORDER BY timestamp, id LIMIT %s
+                    """,
+                    (user_id, start, end, *(after or (start, 0)), limit),
+                )
+                return cursor.fetchall()
+
+        return self._run(read)
+
+    async def aget_user_messages(
+        self,
+        user_id: int,
+        start: datetime.datetime,
+        end: datetime.datetime,
+        limit: int = 100,
+        after: Optional[Tuple[datetime.datetime, int]] = None,
+    ) -> List[Tuple]:
+        """
+        Returns a page of the messages of a user in a time range without
+        blocking the event loop. See `get_user_messages`.
+        """
+        return await self._arun(
+            self.get_user_messages, user_id, start, end, limit=limit, after=after
+        )
+
+    def iter_messages(
+        self,
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+        env: Optional[str] = None,
+        batch_size: int = 1000,
+    ) -> Iterator[Tuple]:
+        """
+        Stream the messages through a server-side cursor, oldest first,
+        fetching `batch_size` rows at a time. The connection is held until
+        the iteration ends, the writes wait meanwhile if the pool runs out.
+
+        Args:
+            start: The start of the time range, inclusive.
+            end: The end of the time range, exclusive.
+            env: The environment of the messages.
+            batch_size: The number of rows fetched per round-trip.
+        """
+        conditions, parameters = [], []
+        for condition, parameter in (
+            ("timestamp >= %s", start),
+            ("timestamp < %s", end),
+            ("env = %s", env),
+        ):
+            if parameter is not None:
+                conditions.append(condition)
+                parameters.append(parameter)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with self._pool.connection() as connection:
+            with connection.cursor(name="iter_messages") as cursor:
+                cursor.itersize = batch_size
+                cursor.execute(
+                    f"""
+                    SELECT {HISTORY_COLUMNS} FROM ConversationHistory
+                    {where}
+                    ORDER BY timestamp, id
+                    """,
+                    parameters,
+                )
+                yield from cursor
 
 
 if __name__ == "__main__":
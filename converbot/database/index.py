@@ -0,0 +1,217 @@
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+
+class ConversationIndex:
+    """
+    A SQLite index of the saved conversations, so looking them up doesn't
+    need to scan and parse the checkpoints on disk.
+
+    Paths are stored relative to the conversation save directory.
+
+    Args:
+        index_path: The path to the SQLite database file.
+        conversation_save_dir: The directory the conversations are saved to.
+    """
+
+    def __init__(self, index_path: Path, conversation_save_dir: Path) -> None:
+        self._conversation_save_dir = conversation_save_dir
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            str(index_path), check_same_thread=False
+        )
+        self._create_table()
+
+    def _create_table(self) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS Conversations (
+                    conversation_id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    created_at INTEGER NOT NULL,
+                    bot_description TEXT,
+                    path TEXT NOT NULL
+                )
+                """
+            )
+            self._connection.execute(
+                """
+                CREATE INDEX IF NOT EXISTS Conversations_user_created
+                ON Conversations (user_id, created_at)
+                """
+            )
+
+    @staticmethod
+    def get_created_at(conversation_id: str) -> int:
+        """
+        Get the creation time from a `{user_id}-{timestamp}` conversation id.
+
+        Args:
+            conversation_id: The conversation id.
+        """
+        return int(conversation_id.split("-")[-1])
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM Conversations LIMIT 1"
+            ).fetchone()
+        return row is None
+
+    def upsert(
+        self,
+        user_id: str,
+        conversation_id: str,
+        bot_description: Optional[str],
+        path: Path,
+    ) -> None:
+        """
+        Add or update a saved conversation.
+
+        Args:
+            user_id: Telegram user_id of the user.
+            conversation_id: The conversation id.
+            bot_description: The description of the companion.
+            path: The path to the conversation checkpoint.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                """
+                INSERT INTO Conversations (conversation_id, user_id, created_at, bot_description, path)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (conversation_id) DO UPDATE SET
+                    bot_description = excluded.bot_description,
+                    path = excluded.path
+                """,
+                (
+                    conversation_id,
+                    str(user_id),
+                    self.get_created_at(conversation_id),
+                    bot_description,
+                    str(path.relative_to(self._conversation_save_dir)),
+                ),
+            )
+
+    def update_path(self, old_path: Path, new_path: Path) -> None:
+        """
+        Point the conversation saved at a path to its new path, e.g. after
+        its checkpoint was converted to another format.
+
+        Args:
+            old_path: The previous path of the checkpoint.
+            new_path: The new path of the checkpoint.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE Conversations SET path = ? WHERE path = ?",
+                (
+                    str(new_path.relative_to(self._conversation_save_dir)),
+                    str(old_path.relative_to(self._conversation_save_dir)),
+                ),
+            )
+
+    def get_path(self, user_id: str, conversation_id: str) -> Optional[Path]:
+        """
+        Get the checkpoint path of a conversation of the user.
+
+        Args:
+            user_id: Telegram user_id of the user.
+            conversation_id: The conversation id.
+
+        Returns: The checkpoint path or None if the conversation is unknown.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT path FROM Conversations WHERE user_id = ? AND conversation_id = ?",
+                (str(user_id), conversation_id),
+            ).fetchone()
+        return None if row is None else self._conversation_save_dir / row[0]
+
+    def get_latest(self, user_id: str) -> Optional[Tuple[str, Path]]:
+        """
+        Get the latest conversation of the user.
+
+        Args:
+            user_id: Telegram user_id of the user.
+
+        Returns: The conversation id and checkpoint path, or None.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                """
+                SELECT conversation_id, path FROM Conversations
+                WHERE user_id = ? ORDER BY created_at DESC LIMIT 1
+                """,
+                (str(user_id),),
+            ).fetchone()
+        return None if row is None else (row[0], self._conversation_save_dir / row[1])
+
+    def iter_latest(self) -> Iterator[Tuple[str, str, Path]]:
+        """
+        Iterate over the latest conversation of every user.
+
+        Returns: The user ids, conversation ids and checkpoint paths.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                """
+                SELECT user_id, conversation_id, path FROM Conversations AS c
+                WHERE created_at = (
+                    SELECT MAX(created_at) FROM Conversations WHERE user_id = c.user_id
+                )
+                """
+            ).fetchall()
+        for user_id, conversation_id, path in rows:
+            yield user_id, conversation_id, self._conversation_save_dir / path
+
+    def list_descriptions(self, user_id: str) -> List[Tuple[str, str]]:
+        """
+        List the companion descriptions of the user.
+
+        Args:
+            user_id: Telegram user_id of the user.
+
+        Returns: The bot descriptions and conversation ids, oldest first.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                """
+                SELECT bot_description, conversation_id FROM Conversations
+                WHERE user_id = ? ORDER BY created_at
+                """,
+                (str(user_id),),
+            ).fetchall()
+        return [(bot_description, conversation_id) for bot_description, conversation_id in rows]
+
+    def list_paths(self, user_id: str) -> List[Path]:
+        """
+        List the checkpoint paths of the user.
+
+        Args:
+            user_id: Telegram user_id of the user.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT path FROM Conversations WHERE user_id = ?",
+                (str(user_id),),
+            ).fetchall()
+        return [self._conversation_save_dir / row[0] for row in rows]
+
+    def delete(self, conversation_id: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM Conversations WHERE conversation_id = ?",
+                (conversation_id,),
+            )
+
+    def delete_user(self, user_id: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM Conversations WHERE user_id = ?", (str(user_id),)
+            )
+
+    def close(self) -> None:
+        self._connection.close()
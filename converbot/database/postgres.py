@@ -0,0 +1,118 @@
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional, TypeVar
+
+import psycopg2
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+T = TypeVar("T")
+
+# The database errors likely to go away on retry, e.g. a dropped connection.
+DB_TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+class PostgresPool:
+    """
+    A thread-safe pool of PostgreSQL connections.
+
+    Connections are checked before use and broken ones are replaced. An
+    operation that fails on a dropped connection is retried once on a fresh
+    one. When every connection is borrowed, e.g. by long streaming reads,
+    callers wait for one to be returned.
+
+    Args:
+        min_connections: The number of connections kept open.
+        max_connections: The maximum number of open connections.
+        acquire_timeout: The maximum number of seconds to wait for a
+            connection, None to wait as long as needed.
+        **kwargs: Arguments to pass to psycopg2.connect.
+    """
+
+    def __init__(
+        self,
+        min_connections: int = 1,
+        max_connections: int = 10,
+        acquire_timeout: Optional[float] = 30.0,
+        **kwargs,
+    ) -> None:
+        if not 0 < min_connections <= max_connections:
+            raise ValueError(
+                "Expected 0 < min_connections <= max_connections, got "
+                f"{min_connections} and {max_connections}"
+            )
+        self._pool = ThreadedConnectionPool(
+            min_connections, max_connections, **kwargs
+        )
+        # ThreadedConnectionPool raises instead of waiting when exhausted.
+        self._available = threading.BoundedSemaphore(max_connections)
+        self._acquire_timeout = acquire_timeout
+
+    @property
+    def closed(self) -> bool:
+        return self._pool.closed
+
+    def close(self) -> None:
+        """
+        Close the connections.
+        """
+        if not self._pool.closed:
+            self._pool.closeall()
+
+    @staticmethod
+    def _is_healthy(connection) -> bool:
+        if connection.closed:
+            return False
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        """
+        Borrow a healthy connection from the pool, committing on success and
+        rolling back on failure.
+
+        Raises: PoolError if no connection was returned within the timeout.
+        """
+        if not self._available.acquire(
+            timeout=-1 if self._acquire_timeout is None else self._acquire_timeout
+        ):
+            raise PoolError(
+                f"No connection available within {self._acquire_timeout}s"
+            )
+        try:
+            connection = self._pool.getconn()
+            if not self._is_healthy(connection):
+                self._pool.putconn(connection, close=True)
+                connection = self._pool.getconn()
+
+            try:
+                yield connection
+                connection.commit()
+            except BaseException:
+                if not connection.closed:
+                    connection.rollback()
+                raise
+            finally:
+                self._pool.putconn(connection, close=bool(connection.closed))
+        finally:
+            self._available.release()
+
+    def run(self, operation: Callable[[Any], T]) -> T:
+        """
+        Run the operation in a transaction, retrying it once if the
+        connection dropped.
+
+        Args:
+            operation: A function of the connection.
+        """
+        try:
+            with self.connection() as connection:
+                return operation(connection)
+        except DB_TRANSIENT_ERRORS:
+            with self.connection() as connection:
+                return operation(connection)
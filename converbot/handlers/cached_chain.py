@@ -0,0 +1,59 @@
+from typing import Optional
+
+from langchain import LLMChain
+
+from converbot.cache import LRUCache, chain_cache_key
+from converbot.llm import acall_language_model, estimate_tokens
+
+
+class CachedChain:
+    """
+    Runs a single input handler chain, caching its results by the content
+    address of the call, see `chain_cache_key`.
+
+    Args:
+        name: The name of the handler, part of the cache keys.
+        chain: The chain with a `user_input` variable.
+        cache: The cache of the results, None to always run the chain.
+    """
+
+    def __init__(
+        self, name: str, chain: LLMChain, cache: Optional[LRUCache] = None
+    ) -> None:
+        self._name = name
+        self._chain = chain
+        self._cache = cache
+
+    def _cache_key(self, user_input: str) -> str:
+        return chain_cache_key(self._name, self._chain, user_input)
+
+    def __call__(self, user_input: str) -> str:
+        if self._cache is None:
+            return self._chain.predict(user_input=user_input)
+
+        key = self._cache_key(user_input)
+        result = self._cache.get(key)
+        if result is None:
+            result = self._chain.predict(user_input=user_input)
+            self._cache.put(key, result)
+        return result
+
+    async def _apredict(self, user_input: str) -> str:
+        return await acall_language_model(
+            self._chain.apredict,
+            user_input=user_input,
+            estimated_tokens=estimate_tokens(
+                self._chain.llm, self._chain.prompt.format(user_input=user_input)
+            ),
+        )
+
+    async def acall(self, user_input: str) -> str:
+        if self._cache is None:
+            return await self._apredict(user_input)
+
+        key = self._cache_key(user_input)
+        result = self._cache.get(key)
+        if result is None:
+            result = await self._apredict(user_input)
+            self._cache.put(key, result)
+        return result
@@ -1,6 +1,8 @@
 import os
 
-from langchain import LLMChain, OpenAI, PromptTemplate
+from langchain import LLMChain, PromptTemplate
+
+from converbot.llm import get_language_model
 
 
 class ConversationBotContextHandler:
@@ -46,7 +48,7 @@ class ConversationBotContextHandler:
         )
 
         self._chain = LLMChain(
-            llm=OpenAI(),
+            llm=get_language_model(),
             prompt=prompt_template,
             verbose=False,
         )
@@ -56,6 +58,9 @@ class ConversationBotContextHandler:
         return user_input
         # return self._chain.predict(user_input=user_input)
 
+    async def acall(self, user_input: str) -> str:
+        return self(user_input)
+
 
 if __name__ == "__main__":
     b = ConversationBotContextHandler()
@@ -1,8 +1,22 @@
-from langchain import LLMChain, OpenAI, PromptTemplate
+from typing import Optional
+
+from langchain import LLMChain, PromptTemplate
+
+from converbot.cache import LRUCache
+from converbot.handlers.cached_chain import CachedChain
+from converbot.llm import get_language_model
 
 
 class ConversationToneHandler:
-    def __init__(self):
+    """
+    Summarizes a personality description into a conversation tone.
+
+    Args:
+        cache: The cache of already resolved tones, keyed by the content
+            address of the call, see `chain_cache_key`.
+    """
+
+    def __init__(self, cache: Optional[LRUCache] = None):
         prompt_template = """Summarize person's tone for the conversation.
         
         Example:
@@ -35,11 +49,18 @@ class ConversationToneHandler:
             input_variables=["user_input"], template=prompt_template
         )
 
-        self._chain = LLMChain(
-            llm=OpenAI(),
-            prompt=prompt_template,
-            verbose=False,
+        self._chain = CachedChain(
+            type(self).__name__,
+            LLMChain(
+                llm=get_language_model(),
+                prompt=prompt_template,
+                verbose=False,
+            ),
+            cache,
         )
 
     def __call__(self, user_input: str) -> str:
-        return self._chain.predict(user_input=user_input)
+        return self._chain(user_input)
+
+    async def acall(self, user_input: str) -> str:
+        return await self._chain.acall(user_input)
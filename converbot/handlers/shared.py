@@ -0,0 +1,45 @@
+from functools import lru_cache
+
+from converbot.cache import LRUCache
+from converbot.constants import (
+    TEXT_STYLE_CACHE_PATH,
+    TEXT_STYLE_CACHE_SIZE,
+    TEXT_STYLE_CACHE_TTL,
+    TONE_CACHE_PATH,
+    TONE_CACHE_SIZE,
+)
+from converbot.handlers.context_handler import ConversationBotContextHandler
+from converbot.handlers.mood_handler import ConversationToneHandler
+from converbot.handlers.text_style_handler import ConversationTextStyleHandler
+
+
+@lru_cache(maxsize=None)
+def get_tone_handler() -> ConversationToneHandler:
+    """
+    Get the process-wide conversation tone handler.
+    """
+    return ConversationToneHandler(
+        cache=LRUCache(max_size=TONE_CACHE_SIZE, file_path=TONE_CACHE_PATH)
+    )
+
+
+@lru_cache(maxsize=None)
+def get_text_style_handler() -> ConversationTextStyleHandler:
+    """
+    Get the process-wide conversation text style handler.
+    """
+    return ConversationTextStyleHandler(
+        cache=LRUCache(
+            max_size=TEXT_STYLE_CACHE_SIZE,
+            file_path=TEXT_STYLE_CACHE_PATH,
+            ttl=TEXT_STYLE_CACHE_TTL,
+        )
+    )
+
+
+@lru_cache(maxsize=None)
+def get_context_handler() -> ConversationBotContextHandler:
+    """
+    Get the process-wide conversation context handler.
+    """
+    return ConversationBotContextHandler()
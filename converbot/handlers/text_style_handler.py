@@ -1,10 +1,23 @@
 import os
+from typing import Optional
 
-from langchain import LLMChain, OpenAI, PromptTemplate
+from langchain import LLMChain, PromptTemplate
+
+from converbot.cache import LRUCache
+from converbot.handlers.cached_chain import CachedChain
+from converbot.llm import get_language_model
 
 
 class ConversationTextStyleHandler:
-    def __init__(self):
+    """
+    Describes the texting style of a companion from their description.
+
+    Args:
+        cache: The cache of already described styles, keyed by the content
+            address of the call, see `chain_cache_key`.
+    """
+
+    def __init__(self, cache: Optional[LRUCache] = None):
         prompt_template = """Describe the texting style. 
         
         Example:
@@ -79,11 +92,18 @@ class ConversationTextStyleHandler:
             input_variables=["user_input"], template=prompt_template
         )
 
-        self._chain = LLMChain(
-            llm=OpenAI(),
-            prompt=prompt_template,
-            verbose=False,
+        self._chain = CachedChain(
+            type(self).__name__,
+            LLMChain(
+                llm=get_language_model(),
+                prompt=prompt_template,
+                verbose=False,
+            ),
+            cache,
         )
 
     def __call__(self, user_input: str) -> str:
-        return self._chain.predict(user_input=user_input)
+        return self._chain(user_input)
+
+    async def acall(self, user_input: str) -> str:
+        return await self._chain.acall(user_input)
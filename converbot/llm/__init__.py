@@ -0,0 +1,28 @@
+from converbot.llm.batching import BatchingDispatcher
+from converbot.llm.registry import (
+    LLM_TRANSIENT_ERRORS,
+    acall_language_model,
+    close_http_session,
+    estimate_tokens,
+    get_batching_dispatcher,
+    get_language_model,
+    get_llm_retry_policy,
+    get_llm_scheduler,
+    is_overload_error,
+    language_model_kwargs,
+    open_http_session,
+    set_batching_dispatcher,
+    set_llm_retry_policy,
+    set_llm_scheduler,
+)
+from converbot.llm.scheduler import (
+    BACKGROUND_PRIORITY,
+    CHAT_PRIORITY,
+    ONBOARDING_PRIORITY,
+    LLMBusyError,
+    LLMScheduler,
+    get_llm_priority,
+    set_llm_priority,
+    set_llm_user,
+)
+from converbot.llm.tokenizer import count_tokens, get_tokenizer
@@ -0,0 +1,153 @@
+import asyncio
+from typing import Dict, List, Optional, Set
+
+from langchain.llms.base import BaseLLM
+
+from converbot.llm.registry import acall_language_model
+from converbot.llm.scheduler import get_llm_priority, set_llm_priority, set_llm_user
+
+
+class _PendingBatch:
+    def __init__(self, language_model: BaseLLM) -> None:
+        self.language_model = language_model
+        self.prompts: List[str] = []
+        self.futures: List[asyncio.Future] = []
+        self.estimated_tokens = 0
+        self.priority: Optional[int] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class BatchingDispatcher:
+    """
+    Collects the completion requests sent to the same LLM within a short
+    window and sends them as one batched request.
+
+    LLMs from the registry are shared per generation parameters, so the
+    requests batched together always have identical parameters. A batch is
+    admitted by the scheduler and retried as one call, with the combined
+    tokens of its prompts and the most urgent priority among them. A failed
+    request fails every prompt of its batch. Streaming LLMs can't be batched.
+
+    Args:
+        window: The number of seconds to wait for more prompts after the
+            first one of a batch.
+        max_batch_size: The number of prompts sending a batch right away.
+    """
+
+    def __init__(self, window: float = 0.03, max_batch_size: int = 16) -> None:
+        self._window = window
+        self._max_batch_size = max_batch_size
+        self._pending: Dict[int, _PendingBatch] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._batches_sent = 0
+        self._prompts_sent = 0
+
+    @property
+    def metrics(self) -> Dict[str, float]:
+        """
+        The number of batches and prompts sent and the average batch fill.
+        """
+        return {
+            "batches_sent": self._batches_sent,
+            "prompts_sent": self._prompts_sent,
+            "average_batch_size": (
+                self._prompts_sent / self._batches_sent
+                if self._batches_sent
+                else 0.0
+            ),
+            "average_batch_fill": (
+                self._prompts_sent / self._batches_sent / self._max_batch_size
+                if self._batches_sent
+                else 0.0
+            ),
+        }
+
+    async def agenerate(
+        self, language_model: BaseLLM, prompt: str, estimated_tokens: int = 0
+    ) -> str:
+        """
+        Complete the prompt as part of the next batch for the LLM.
+
+        Args:
+            language_model: The LLM to complete the prompt with.
+            prompt: The prompt to complete.
+            estimated_tokens: The tokens of the prompt and its completion,
+                see `estimate_tokens`.
+
+        Returns: The completion text.
+        """
+        loop = asyncio.get_running_loop()
+        key = id(language_model)
+
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = _PendingBatch(language_model)
+            batch.timer = loop.call_later(self._window, self._flush, key)
+            self._pending[key] = batch
+
+        future = loop.create_future()
+        batch.prompts.append(prompt)
+        batch.futures.append(future)
+        batch.estimated_tokens += estimated_tokens
+        priority = get_llm_priority()
+        if batch.priority is None or priority < batch.priority:
+            batch.priority = priority
+
+        if len(batch.prompts) >= self._max_batch_size:
+            batch.timer.cancel()
+            self._flush(key)
+
+        return await future
+
+    def _flush(self, key: int) -> None:
+        batch = self._pending.pop(key, None)
+        if batch is not None:
+            # The loop only keeps weak references to its tasks.
+            task = asyncio.ensure_future(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._on_sent)
+
+    def _on_sent(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(task.exception())
+
+    async def _send(self, batch: _PendingBatch) -> None:
+        self._batches_sent += 1
+        self._prompts_sent += len(batch.prompts)
+        # The task runs in a copy of the context, the batch serves no one user.
+        set_llm_user(None)
+        set_llm_priority(batch.priority)
+        try:
+            result = await acall_language_model(
+                batch.language_model.agenerate,
+                batch.prompts,
+                estimated_tokens=batch.estimated_tokens,
+            )
+        except asyncio.CancelledError:
+            for future in batch.futures:
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, generations in zip(batch.futures, result.generations):
+            if not future.done():
+                future.set_result(generations[0].text)
+
+    async def aclose(self) -> None:
+        """
+        Cancel the batches not sent yet and the requests in flight.
+        """
+        for batch in self._pending.values():
+            batch.timer.cancel()
+            for future in batch.futures:
+                future.cancel()
+        self._pending.clear()
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
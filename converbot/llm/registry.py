@@ -0,0 +1,262 @@
+import asyncio
+import threading
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+import aiohttp
+import openai
+from langchain.callbacks.base import CallbackManager
+from langchain.llms import OpenAI
+
+from converbot.callbacks import TokenStreamCallback
+from converbot.config.base import OpenAIModelConfig
+from converbot.llm.scheduler import LLMScheduler
+from converbot.llm.tokenizer import count_tokens
+from converbot.utils.retry import CircuitOpenError, RetryPolicy
+
+if TYPE_CHECKING:
+    # The dispatcher sends its batches through acall_language_model.
+    from converbot.llm.batching import BatchingDispatcher
+
+T = TypeVar("T")
+
+_LANGUAGE_MODELS: Dict[Tuple[Tuple[str, Any], ...], OpenAI] = {}
+_LANGUAGE_MODELS_LOCK = threading.Lock()
+
+_BATCHING_DISPATCHER: Optional["BatchingDispatcher"] = None
+
+_LLM_RETRY_POLICY: Optional[RetryPolicy] = None
+
+_LLM_SCHEDULER: Optional[LLMScheduler] = None
+
+# The errors of the OpenAI API likely to go away on retry.
+LLM_TRANSIENT_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.TryAgain,
+    aiohttp.ClientError,
+)
+
+
+def is_overload_error(error: BaseException) -> bool:
+    """
+    Whether an LLM error means the API is overloaded or down, rather than
+    the request being wrong.
+    """
+    return (
+        isinstance(
+            error,
+            (
+                CircuitOpenError,
+                openai.error.RateLimitError,
+                openai.error.ServiceUnavailableError,
+                openai.error.TryAgain,
+            ),
+        )
+        or "overloaded" in str(error).lower()
+    )
+
+
+def language_model_kwargs(config: OpenAIModelConfig) -> Dict[str, Any]:
+    """
+    Convert a model configuration to OpenAI LLM keyword arguments.
+
+    Args:
+        config: The model configuration.
+
+    Returns: The keyword arguments for the OpenAI LLM.
+    """
+    return dict(
+        model_name=config.model,
+        temperature=config.temperature,
+        max_tokens=config.max_tokens,
+        top_p=config.top_p,
+        frequency_penalty=config.frequency_penalty,
+        presence_penalty=config.presence_penalty,
+        best_of=config.best_of,
+    )
+
+
+def get_language_model(**kwargs: Any) -> OpenAI:
+    """
+    Get the process-wide OpenAI LLM for the given parameters, creating it
+    on first use.
+
+    Streaming LLMs (`streaming=True`) forward their tokens through a
+    TokenStreamCallback, see `set_token_queue`. While a retry policy is set,
+    the LLMs make a single attempt per call, see `set_llm_retry_policy`.
+
+    Args:
+        **kwargs: Arguments to pass to the OpenAI LLM.
+
+    Returns: The shared OpenAI LLM.
+    """
+    if _LLM_RETRY_POLICY is not None:
+        kwargs.setdefault("max_retries", 1)
+    key = tuple(sorted(kwargs.items()))
+    with _LANGUAGE_MODELS_LOCK:
+        language_model = _LANGUAGE_MODELS.get(key)
+        if language_model is None:
+            if kwargs.get("streaming", False):
+                kwargs["callback_manager"] = CallbackManager(
+                    [TokenStreamCallback()]
+                )
+            language_model = OpenAI(**kwargs)
+            _LANGUAGE_MODELS[key] = language_model
+    return language_model
+
+
+def set_batching_dispatcher(dispatcher: Optional["BatchingDispatcher"]) -> None:
+    """
+    Set the process-wide dispatcher batching the conversation completions.
+
+    Args:
+        dispatcher: The dispatcher, None to send every completion on its own.
+    """
+    global _BATCHING_DISPATCHER
+    _BATCHING_DISPATCHER = dispatcher
+
+
+def get_batching_dispatcher() -> Optional["BatchingDispatcher"]:
+    """
+    Get the process-wide dispatcher batching the conversation completions.
+
+    Returns: The dispatcher or None if completions are not batched.
+    """
+    return _BATCHING_DISPATCHER
+
+
+def set_llm_retry_policy(policy: Optional[RetryPolicy]) -> None:
+    """
+    Set the process-wide policy retrying the async LLM calls. Must be set
+    before the LLMs are created, so they leave the retries to it.
+
+    Args:
+        policy: The policy, None to leave the retries to the OpenAI LLMs.
+    """
+    global _LLM_RETRY_POLICY
+    _LLM_RETRY_POLICY = policy
+
+
+def get_llm_retry_policy() -> Optional[RetryPolicy]:
+    """
+    Get the process-wide policy retrying the async LLM calls.
+
+    Returns: The policy or None if the OpenAI LLMs retry on their own.
+    """
+    return _LLM_RETRY_POLICY
+
+
+def set_llm_scheduler(scheduler: Optional[LLMScheduler]) -> None:
+    """
+    Set the process-wide scheduler admitting the async LLM calls.
+
+    Args:
+        scheduler: The scheduler, None to send every call right away.
+    """
+    global _LLM_SCHEDULER
+    _LLM_SCHEDULER = scheduler
+
+
+def get_llm_scheduler() -> Optional[LLMScheduler]:
+    """
+    Get the process-wide scheduler admitting the async LLM calls.
+
+    Returns: The scheduler or None if the calls are sent right away.
+    """
+    return _LLM_SCHEDULER
+
+
+def estimate_tokens(language_model: OpenAI, prompt: str) -> int:
+    """
+    Estimate the tokens an LLM call counts against the rate limit: the
+    prompt tokens and the most completion tokens it may generate.
+
+    Args:
+        language_model: The LLM to call.
+        prompt: The formatted prompt.
+
+    Returns: The estimated number of tokens.
+    """
+    completion_tokens = max(language_model.max_tokens, 0) * max(
+        language_model.best_of, language_model.n
+    )
+    return count_tokens(prompt, language_model.model_name) + completion_tokens
+
+
+async def acall_language_model(
+    function: Callable[..., Awaitable[T]],
+    *args: Any,
+    estimated_tokens: int = 0,
+    **kwargs: Any,
+) -> T:
+    """
+    Make an async LLM call through the retry policy and the scheduler, if
+    any. Every attempt is admitted by the scheduler on its own.
+
+    Args:
+        function: The coroutine function making the call.
+        *args: The positional arguments of the function.
+        estimated_tokens: The tokens of the call, see `estimate_tokens`.
+        **kwargs: The keyword arguments of the function.
+
+    Returns: The result of the function.
+
+    Raises: LLMBusyError if the scheduler has no capacity in time.
+    """
+
+    async def call() -> T:
+        if _LLM_SCHEDULER is not None:
+            await _LLM_SCHEDULER.acquire(estimated_tokens)
+        return await function(*args, **kwargs)
+
+    if _LLM_RETRY_POLICY is None:
+        return await call()
+    return await _LLM_RETRY_POLICY.call(call)
+
+
+async def _create_http_session(
+    limit: int, keepalive_timeout: float
+) -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=limit, keepalive_timeout=keepalive_timeout
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+def open_http_session(
+    loop: asyncio.AbstractEventLoop,
+    limit: int = 100,
+    keepalive_timeout: float = 60.0,
+) -> aiohttp.ClientSession:
+    """
+    Open a pooled keep-alive HTTP session for the async OpenAI requests.
+
+    Without it the openai package opens a new session (and connection) per
+    async request. Synchronous requests already reuse a per-thread session.
+    Must be called before the loop starts running, so every task created
+    afterwards inherits the session.
+
+    Args:
+        loop: The event loop the bot runs on.
+        limit: The maximum number of simultaneous connections.
+        keepalive_timeout: Seconds to keep an idle connection open.
+
+    Returns: The HTTP session.
+    """
+    session = loop.run_until_complete(
+        _create_http_session(limit, keepalive_timeout)
+    )
+    openai.aiosession.set(session)
+    return session
+
+
+async def close_http_session() -> None:
+    """
+    Close the HTTP session opened by open_http_session, if any.
+    """
+    session: Optional[aiohttp.ClientSession] = openai.aiosession.get(None)
+    if session is not None:
+        await session.close()
@@ -0,0 +1,232 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextvars import ContextVar, Token
+from typing import Dict, Hashable, List, Optional
+
+CHAT_PRIORITY = 0
+ONBOARDING_PRIORITY = 1
+BACKGROUND_PRIORITY = 2
+
+_LLM_USER: ContextVar[Optional[Hashable]] = ContextVar("llm_user", default=None)
+_LLM_PRIORITY: ContextVar[int] = ContextVar("llm_priority", default=CHAT_PRIORITY)
+
+
+def set_llm_user(user_id: Optional[Hashable]) -> Token:
+    """
+    Attribute the LLM calls of the current task to the user.
+
+    Args:
+        user_id: The user id, None for calls on behalf of no one.
+
+    Returns: The context variable token to reset the user with.
+    """
+    return _LLM_USER.set(user_id)
+
+
+def set_llm_priority(priority: int) -> Token:
+    """
+    Set the priority of the LLM calls of the current task, lower first.
+
+    Args:
+        priority: One of CHAT_PRIORITY, ONBOARDING_PRIORITY and
+            BACKGROUND_PRIORITY.
+
+    Returns: The context variable token to reset the priority with.
+    """
+    return _LLM_PRIORITY.set(priority)
+
+
+def get_llm_priority() -> int:
+    """
+    Get the priority of the LLM calls of the current task.
+    """
+    return _LLM_PRIORITY.get()
+
+
+class LLMBusyError(Exception):
+    """
+    Raised when an LLM call waited too long for admission.
+    """
+
+
+class _TokenBucket:
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def time_until(self, amount: float) -> float:
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount: float) -> None:
+        self.level -= min(amount, self.capacity)
+
+
+class _Waiter:
+    def __init__(self, future: asyncio.Future, user_id: Hashable, tokens: int) -> None:
+        self.future = future
+        self.user_id = user_id
+        self.tokens = tokens
+        self.start_tag = 0.0
+        self.enqueued_at = time.monotonic()
+
+
+class LLMScheduler:
+    """
+    Admits the outbound LLM calls within the requests per minute and tokens
+    per minute of the OpenAI account.
+
+    Calls wait in a queue per priority and a lower priority only runs when
+    no higher one waits. Within a priority the users share the throughput by
+    weighted fair queuing on the tokens, so a chatty user waits behind the
+    others instead of starving them. A call waiting longer than `max_wait`
+    fails with LLMBusyError.
+
+    The tokens of a call are estimated up front, see `estimate_tokens`.
+
+    Args:
+        requests_per_minute: The maximum number of admitted calls per minute.
+        tokens_per_minute: The maximum number of admitted tokens per minute.
+        max_wait: The maximum number of seconds a call waits for admission.
+        weights: The weights of the users, 1 by default.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = 3000,
+        tokens_per_minute: float = 250000,
+        max_wait: float = 20.0,
+        weights: Optional[Dict[Hashable, float]] = None,
+    ) -> None:
+        self._requests = _TokenBucket(requests_per_minute)
+        self._tokens = _TokenBucket(tokens_per_minute)
+        self._max_wait = max_wait
+        self._weights: Dict[Hashable, float] = dict(weights or {})
+
+        self._queues: Dict[int, List] = {}
+        self._virtual_times: Dict[int, float] = {}
+        self._finish_tags: Dict[int, Dict[Hashable, float]] = {}
+        self._sequence = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+        self._admitted = 0
+        self._rejected = 0
+        self._wait_seconds = 0.0
+
+    @property
+    def metrics(self) -> Dict[str, float]:
+        """
+        The number of calls admitted and rejected as busy, the number of
+        waiting calls and the average admission wait.
+        """
+        return {
+            "admitted": self._admitted,
+            "rejected": self._rejected,
+            "queue_depth": sum(
+                not entry[-1].future.done()
+                for queue in self._queues.values()
+                for entry in queue
+            ),
+            "average_wait_seconds": (
+                self._wait_seconds / self._admitted if self._admitted else 0.0
+            ),
+        }
+
+    def set_weight(self, user_id: Hashable, weight: float) -> None:
+        """
+        Set the share of a user relative to the others, 1 by default.
+        """
+        self._weights[user_id] = weight
+
+    async def acquire(self, tokens: int, max_wait: Optional[float] = None) -> None:
+        """
+        Wait until a call of the current user and priority is admitted.
+
+        Args:
+            tokens: The estimated prompt and completion tokens of the call.
+            max_wait: The maximum number of seconds to wait, the scheduler's
+                by default.
+
+        Raises: LLMBusyError if the call isn't admitted in time.
+        """
+        user_id = _LLM_USER.get()
+        priority = _LLM_PRIORITY.get()
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), user_id, tokens)
+
+        # Start-time fair queuing: a user's calls are spaced by their cost.
+        virtual_time = self._virtual_times.get(priority, 0.0)
+        finish_tags = self._finish_tags.setdefault(priority, {})
+        waiter.start_tag = max(virtual_time, finish_tags.get(user_id, 0.0))
+        finish_tags[user_id] = waiter.start_tag + max(tokens, 1) / self._weights.get(
+            user_id, 1.0
+        )
+        heapq.heappush(
+            self._queues.setdefault(priority, []),
+            (waiter.start_tag, next(self._sequence), waiter),
+        )
+        self._dispatch()
+
+        timeout = self._max_wait if max_wait is None else max_wait
+        try:
+            await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            self._rejected += 1
+            raise LLMBusyError(f"No LLM capacity within {timeout:.0f}s") from None
+        finally:
+            # A cancelled waiter is skipped, and may unblock the ones behind.
+            self._dispatch()
+
+    def _next_waiter(self) -> Optional[_Waiter]:
+        for priority in sorted(self._queues):
+            queue = self._queues[priority]
+            while queue and queue[0][-1].future.done():
+                heapq.heappop(queue)
+            if queue:
+                return queue[0][-1]
+            del self._queues[priority]
+        return None
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        now = time.monotonic()
+        self._requests.refill(now)
+        self._tokens.refill(now)
+        while True:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            delay = max(self._requests.time_until(1), self._tokens.time_until(waiter.tokens))
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+
+            priority = min(self._queues)
+            heapq.heappop(self._queues[priority])
+            self._requests.take(1)
+            self._tokens.take(waiter.tokens)
+            self._virtual_times[priority] = waiter.start_tag
+            self._forget_idle_users(priority)
+
+            self._admitted += 1
+            self._wait_seconds += now - waiter.enqueued_at
+            waiter.future.set_result(None)
+
+    def _forget_idle_users(self, priority: int) -> None:
+        # Users whose last call started are caught up with by the clock.
+        virtual_time = self._virtual_times[priority]
+        finish_tags = self._finish_tags[priority]
+        if len(finish_tags) > 2 * len(self._queues.get(priority, ())) + 64:
+            for user_id in [
+                user_id for user_id, tag in finish_tags.items() if tag <= virtual_time
+            ]:
+                del finish_tags[user_id]
@@ -0,0 +1,34 @@
+from functools import lru_cache
+
+import tiktoken
+
+FALLBACK_ENCODING = "gpt2"
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(model_name: str) -> tiktoken.Encoding:
+    """
+    Get the process-wide tokenizer for the model, loading it on first use.
+
+    Args:
+        model_name: The OpenAI model name.
+
+    Returns: The tokenizer.
+    """
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding(FALLBACK_ENCODING)
+
+
+def count_tokens(text: str, model_name: str) -> int:
+    """
+    Count the tokens of the text with the model's tokenizer.
+
+    Args:
+        text: The text to count the tokens of.
+        model_name: The OpenAI model name.
+
+    Returns: The number of tokens.
+    """
+    return len(get_tokenizer(model_name).encode(text))
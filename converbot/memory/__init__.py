@@ -0,0 +1 @@
+from converbot.memory.summary_buffer import SummaryBufferMemory
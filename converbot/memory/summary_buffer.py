@@ -0,0 +1,218 @@
+from collections import deque
+from itertools import islice
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from langchain import LLMChain
+from langchain.chains.conversation.memory import \
+    ConversationSummaryBufferMemory
+from pydantic import Field
+
+from converbot.llm import acall_language_model, count_tokens, estimate_tokens
+
+
+class SummaryBufferMemory(ConversationSummaryBufferMemory):
+    """
+    Conversation summary buffer memory with an asynchronous save/prune path.
+
+    The synchronous path behaves exactly like ConversationSummaryBufferMemory,
+    the asynchronous one summarizes pruned lines without blocking the event
+    loop. With `deferred_pruning` the asynchronous save only appends the new
+    lines and the owner is expected to call `aprune` in the background.
+    `input_key` must be set.
+
+    The buffer is a deque of lines with their token counts counted once, on
+    append, so pruning and the token limit checks never recount the history.
+    Use `set_buffer` instead of assigning the buffer.
+
+    The memory counts the lines ever appended and dropped, so the change since
+    a `cursor` can be computed with `delta_since`.
+
+    Args:
+        model_name: The model whose tokenizer counts the buffer tokens.
+        deferred_pruning: Whether `asave_context` leaves pruning to the caller.
+        hard_token_limit: The maximum number of buffer tokens put into the
+            prompt while pruning lags behind.
+    """
+
+    buffer: Deque[str] = Field(default_factory=deque)
+    token_counts: Deque[int] = Field(default_factory=deque)
+    buffer_token_count: int = 0
+    appended_count: int = 0
+    dropped_count: int = 0
+    model_name: str = "text-davinci-003"
+    deferred_pruning: bool = False
+    hard_token_limit: Optional[int] = None
+
+    @property
+    def needs_pruning(self) -> bool:
+        return self.buffer_token_count > self.max_token_limit
+
+    def set_buffer(
+        self, buffer: List[str], token_counts: Optional[List[int]] = None
+    ) -> None:
+        """
+        Replace the buffer.
+
+        Args:
+            buffer: The new buffer lines.
+            token_counts: The token counts of the lines, counted if omitted.
+        """
+        if token_counts is None or len(token_counts) != len(buffer):
+            token_counts = [
+                count_tokens(line, self.model_name) for line in buffer
+            ]
+        self.buffer = deque(buffer)
+        self.token_counts = deque(token_counts)
+        self.buffer_token_count = sum(self.token_counts)
+
+    def _append(self, line: str) -> None:
+        token_count = count_tokens(line, self.model_name)
+        self.buffer.append(line)
+        self.token_counts.append(token_count)
+        self.buffer_token_count += token_count
+        self.appended_count += 1
+
+    def cursor(self) -> Tuple[int, int, str]:
+        """
+        Get the position of the memory to compute later changes from.
+
+        Returns: The appended and dropped line counts and the moving summary.
+        """
+        return self.appended_count, self.dropped_count, self.moving_summary_buffer
+
+    def delta_since(
+        self, cursor: Tuple[int, int, str]
+    ) -> Tuple[int, List[str], List[int], Optional[str]]:
+        """
+        Compute the change of the memory since the cursor was taken.
+
+        Args:
+            cursor: The cursor returned by `cursor`.
+
+        Returns: The number of lines dropped from the front, the appended lines
+            and their token counts, and the new moving summary or None if it
+            did not change.
+        """
+        appended_count, dropped_count, moving_summary_buffer = cursor
+        appended = self.appended_count - appended_count
+        dropped = self.dropped_count - dropped_count
+
+        # Lines appended and already dropped since the cursor are skipped.
+        new_lines = min(appended, len(self.buffer))
+        previous_length = len(self.buffer) - appended + dropped
+        start = len(self.buffer) - new_lines
+        return (
+            previous_length + new_lines - len(self.buffer),
+            list(islice(self.buffer, start, None)),
+            list(islice(self.token_counts, start, None)),
+            (
+                self.moving_summary_buffer
+                if self.moving_summary_buffer != moving_summary_buffer
+                else None
+            ),
+        )
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, str]:
+        buffer = self.buffer
+        if self.hard_token_limit is not None:
+            buffer = self._newest_lines(self.hard_token_limit)
+
+        if self.moving_summary_buffer == "":
+            return {self.memory_key: "\n".join(buffer)}
+        memory_val = self.moving_summary_buffer + "\n" + "\n".join(buffer)
+        return {self.memory_key: memory_val}
+
+    def _newest_lines(self, token_limit: int) -> List[str]:
+        if self.buffer_token_count <= token_limit:
+            return list(self.buffer)
+
+        lines = []
+        buffer_length = 0
+        for line, token_count in zip(
+            reversed(self.buffer), reversed(self.token_counts)
+        ):
+            buffer_length += token_count
+            if buffer_length > token_limit:
+                break
+            lines.append(line)
+        return lines[::-1]
+
+    def _format_new_lines(
+        self, inputs: Dict[str, Any], outputs: Dict[str, str]
+    ) -> str:
+        output_key = self.output_key or list(outputs.keys())[0]
+        human = f"{self.human_prefix}: {inputs[self.input_key]}"
+        ai = f"{self.ai_prefix}: {outputs[output_key]}"
+        return "\n".join([human, ai])
+
+    def _overflow_lines(self) -> List[str]:
+        """
+        Find the oldest lines to drop for the buffer to fit the token limit.
+
+        Returns: The overflowing lines, oldest first.
+        """
+        buffer_length = self.buffer_token_count
+        overflow = 0
+        for token_count in self.token_counts:
+            if buffer_length <= self.max_token_limit:
+                break
+            buffer_length -= token_count
+            overflow += 1
+        return list(islice(self.buffer, overflow))
+
+    def _drop_oldest(self, count: int) -> None:
+        for _ in range(count):
+            self.buffer.popleft()
+            self.buffer_token_count -= self.token_counts.popleft()
+            self.dropped_count += 1
+
+    def save_context(
+        self, inputs: Dict[str, Any], outputs: Dict[str, str]
+    ) -> None:
+        self._append(self._format_new_lines(inputs, outputs))
+        self.prune()
+
+    async def asave_context(
+        self, inputs: Dict[str, Any], outputs: Dict[str, str]
+    ) -> None:
+        self._append(self._format_new_lines(inputs, outputs))
+        if not self.deferred_pruning:
+            await self.aprune()
+
+    def prune(self) -> None:
+        """
+        Fold the lines exceeding the token limit into the moving summary.
+        """
+        pruned_memory = self._overflow_lines()
+        if not pruned_memory:
+            return
+        chain = LLMChain(llm=self.llm, prompt=self.prompt)
+        self.moving_summary_buffer = chain.predict(
+            summary=self.moving_summary_buffer,
+            new_lines="\n".join(pruned_memory),
+        )
+        self._drop_oldest(len(pruned_memory))
+
+    async def aprune(self) -> None:
+        """
+        Fold the lines exceeding the token limit into the moving summary
+        without blocking the event loop.
+
+        The lines stay in the buffer until their summary is ready, so turns
+        running meanwhile still see them. Must not run concurrently with
+        another prune of the same memory.
+        """
+        pruned_memory = self._overflow_lines()
+        if not pruned_memory:
+            return
+        chain = LLMChain(llm=self.llm, prompt=self.prompt)
+        inputs = dict(
+            summary=self.moving_summary_buffer,
+            new_lines="\n".join(pruned_memory),
+        )
+        self.moving_summary_buffer = await acall_language_model(
+            chain.apredict,
+            estimated_tokens=estimate_tokens(self.llm, self.prompt.format(**inputs)),
+            **inputs,
+        )
+        self._drop_oldest(len(pruned_memory))
@@ -2,8 +2,10 @@ import json
 from pathlib import Path
 
 from converbot.constants import DEFAULT_CHATBOT_NAME, DEFAULT_USER_NAME
-from converbot.handlers.context_handler import ConversationBotContextHandler
-from converbot.handlers.text_style_handler import ConversationTextStyleHandler
+from converbot.handlers.shared import (
+    get_context_handler,
+    get_text_style_handler,
+)
 from converbot.prompt.prompt import ConversationPrompt
 
 
@@ -27,8 +29,8 @@ class ConversationalPromptGenerator:
         user_name: str = DEFAULT_USER_NAME,
         chatbot_name: str = DEFAULT_CHATBOT_NAME,
     ) -> None:
-        self._text_style_handler = ConversationTextStyleHandler()
-        self._context_handler = ConversationBotContextHandler()
+        self._text_style_handler = get_text_style_handler()
+        self._context_handler = get_context_handler()
 
         self._user_name = user_name
         self._chatbot_name = chatbot_name
@@ -51,6 +53,23 @@ class ConversationalPromptGenerator:
         text_style = self._text_style_handler(context)
         context_summary = self._context_handler(context)
 
+        return self._build_prompt(context_summary, text_style)
+
+    async def acall(self, context: str) -> ConversationPrompt:
+        """
+        Generate the prompt without blocking the event loop.
+
+        Args:
+            context: The description of the companion.
+        """
+        text_style = await self._text_style_handler.acall(context)
+        context_summary = await self._context_handler.acall(context)
+
+        return self._build_prompt(context_summary, text_style)
+
+    def _build_prompt(
+        self, context_summary: str, text_style: str
+    ) -> ConversationPrompt:
         return ConversationPrompt(
             prompt_text=(
                 self._prompt_start_text
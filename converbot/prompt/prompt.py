@@ -1,10 +1,110 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any
+
 from langchain import PromptTemplate
 
+MEMORY_KEY = "chat_history"
+USER_INPUT_KEY = "user_input"
+CONVERSATION_TONE_KEY = "conversation_tone"
+
+COMPILED_TEMPLATE_CACHE_SIZE = 1024
+
+
+class CompiledConversationTemplate(PromptTemplate):
+    """
+    An immutable conversation prompt template with the static prompt text
+    rendered once. Formatting only concatenates the history, input and tone.
+
+    Args:
+        prefix: The rendered static part of the prompt.
+        user_turn_prefix: The text between the history and the user input.
+        chatbot_turn_prefix: The text between the user input and the tone.
+    """
+
+    prefix: str
+    user_turn_prefix: str
+    chatbot_turn_prefix: str
+
+    class Config:
+        allow_mutation = False
+
+    def format(self, **kwargs: Any) -> str:
+        return "".join(
+            (
+                self.prefix,
+                kwargs[MEMORY_KEY],
+                self.user_turn_prefix,
+                kwargs[USER_INPUT_KEY],
+                self.chatbot_turn_prefix,
+                kwargs[CONVERSATION_TONE_KEY],
+                "):",
+            )
+        )
+
+
+_COMPILED_TEMPLATES: "OrderedDict[str, CompiledConversationTemplate]" = (
+    OrderedDict()
+)
+_COMPILED_TEMPLATES_LOCK = threading.Lock()
+
+
+def compile_conversation_template(
+    prompt_text: str, user_name: str, chatbot_name: str
+) -> CompiledConversationTemplate:
+    """
+    Get the shared compiled template for the prompt, compiling it on first
+    use. Templates are cached by a hash of their content.
+
+    Args:
+        prompt_text: The static prompt text.
+        user_name: The user name.
+        chatbot_name: The chatbot name.
+
+    Returns: The compiled template.
+    """
+    key = hashlib.sha256(
+        "\0".join((prompt_text, user_name, chatbot_name)).encode()
+    ).hexdigest()
+
+    with _COMPILED_TEMPLATES_LOCK:
+        template = _COMPILED_TEMPLATES.get(key)
+        if template is not None:
+            _COMPILED_TEMPLATES.move_to_end(key)
+            return template
+
+    prefix = prompt_text + "\n"
+    user_turn_prefix = f"\n{user_name}: "
+    chatbot_turn_prefix = f"\n{chatbot_name} ("
+    template = CompiledConversationTemplate(
+        input_variables=[MEMORY_KEY, USER_INPUT_KEY, CONVERSATION_TONE_KEY],
+        template=(
+            prefix
+            + f"{{{MEMORY_KEY}}}"
+            + user_turn_prefix
+            + f"{{{USER_INPUT_KEY}}}"
+            + chatbot_turn_prefix
+            + f"{{{CONVERSATION_TONE_KEY}}}):"
+        ),
+        validate_template=False,
+        prefix=prefix,
+        user_turn_prefix=user_turn_prefix,
+        chatbot_turn_prefix=chatbot_turn_prefix,
+    )
+
+    with _COMPILED_TEMPLATES_LOCK:
+        template = _COMPILED_TEMPLATES.setdefault(key, template)
+        _COMPILED_TEMPLATES.move_to_end(key)
+        while len(_COMPILED_TEMPLATES) > COMPILED_TEMPLATE_CACHE_SIZE:
+            _COMPILED_TEMPLATES.popitem(last=False)
+    return template
+
 
 class ConversationPrompt:
-    memory_key = "chat_history"
-    user_input_key = "user_input"
-    conversation_tone_key = "conversation_tone"
+    memory_key = MEMORY_KEY
+    user_input_key = USER_INPUT_KEY
+    conversation_tone_key = CONVERSATION_TONE_KEY
 
     def __init__(
         self,
@@ -13,24 +113,8 @@ class ConversationPrompt:
         chatbot_name: str = "You",
     ):
         self._prompt_text = prompt_text
-
-        string_base_template = """PROMPT_TEXT
-{chat_history}
-USER_NAME: {user_input}
-CHATBOT_NAME ({conversation_tone}):"""
-        string_base_template = string_base_template.replace(
-            "PROMPT_TEXT", prompt_text
-        )
-        string_base_template = string_base_template.replace(
-            "USER_NAME", user_name
-        )
-        string_base_template = string_base_template.replace(
-            "CHATBOT_NAME", chatbot_name
-        )
-
-        self._prompt = PromptTemplate(
-            input_variables=["chat_history", "user_input", "conversation_tone"],
-            template=string_base_template,
+        self._prompt = compile_conversation_template(
+            prompt_text, user_name, chatbot_name
         )
 
         self._user_name = user_name
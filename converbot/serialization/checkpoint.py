@@ -1,10 +1,40 @@
 import json
-from dataclasses import dataclass
+import struct
+import zlib
+from dataclasses import asdict, dataclass
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 
 from converbot.config.gptconversation import GPT3ConversationConfig
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON_CHECKPOINT_SUFFIX = ".json"
+BINARY_CHECKPOINT_SUFFIX = ".ckpt"
+CHECKPOINT_SUFFIXES = (JSON_CHECKPOINT_SUFFIX, BINARY_CHECKPOINT_SUFFIX)
+
+BINARY_CHECKPOINT_MAGIC = b"CVCK"
+BINARY_CHECKPOINT_SCHEMA_VERSION = 1
+# Magic, schema version, encoding, compression.
+_BINARY_HEADER = struct.Struct(">4sBBB")
+
+JSON_ENCODING, MSGPACK_ENCODING = 0, 1
+NO_COMPRESSION, ZLIB_COMPRESSION, ZSTD_COMPRESSION = 0, 1, 2
+COMPRESSIONS = {
+    "none": NO_COMPRESSION,
+    "zlib": ZLIB_COMPRESSION,
+    "zstd": ZSTD_COMPRESSION,
+}
+DEFAULT_COMPRESSION = "zstd" if zstandard is not None else "zlib"
+
 
 @dataclass
 class GPT3ConversationCheckpoint:
@@ -18,6 +48,8 @@ class GPT3ConversationCheckpoint:
         prompt_chatbot_name: The name of the chatbot.
         memory_buffer: The buffer for the memory.
         memory_moving_summary_buffer: The moving summary buffer for the memory.
+        bot_description: The description of the companion.
+        memory_token_counts: The token counts of the memory buffer lines.
     """
 
     config: GPT3ConversationConfig
@@ -27,6 +59,42 @@ class GPT3ConversationCheckpoint:
     memory_buffer: List[str]
     memory_moving_summary_buffer: str
     bot_description: Optional[str] = None
+    memory_token_counts: Optional[List[int]] = None
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "GPT3ConversationCheckpoint":
+        data = dict(data)
+        data["config"] = GPT3ConversationConfig(**data["config"])
+        return cls(**data)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def load(cls, file_path: Path) -> "GPT3ConversationCheckpoint":
+        """
+        Load a checkpoint from a json or a binary file, detecting the format
+        from the file content.
+
+        Args:
+            file_path: Path to the checkpoint file.
+        """
+        data = file_path.read_bytes()
+        if data.startswith(BINARY_CHECKPOINT_MAGIC):
+            return cls.from_bytes(data)
+        return cls.from_dict(json.loads(data))
+
+    def save(self, save_path: Path) -> None:
+        """
+        Save the checkpoint in the format given by the file suffix.
+
+        Args:
+            save_path: The path to save the checkpoint.
+        """
+        if save_path.suffix == BINARY_CHECKPOINT_SUFFIX:
+            self.to_binary(save_path)
+        else:
+            self.to_json(save_path)
 
     @classmethod
     def from_json(cls, file_path: Path) -> "GPT3ConversationCheckpoint":
@@ -36,9 +104,7 @@ class GPT3ConversationCheckpoint:
         Args:
             file_path: Path to JSON file.
         """
-        data = json.loads(file_path.read_text())
-        data["config"] = GPT3ConversationConfig(**data["config"])
-        return cls(**data)
+        return cls.from_dict(json.loads(file_path.read_text()))
 
     def to_json(self, save_path: Path) -> None:
         """
@@ -47,7 +113,90 @@ class GPT3ConversationCheckpoint:
         Args:
             save_path: The path to save the configuration.
         """
-        self.config = self.config.__dict__  # noqa
         with open(save_path, "w") as f:
-            json.dump(self.__dict__, f, indent=4)
-        self.config = GPT3ConversationConfig(**self.config)  # noqa
+            json.dump(self.to_dict(), f, indent=4)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "GPT3ConversationCheckpoint":
+        """
+        Decode a binary checkpoint.
+
+        Args:
+            data: The binary checkpoint.
+        """
+        magic, schema_version, encoding, compression = _BINARY_HEADER.unpack_from(
+            data
+        )
+        if magic != BINARY_CHECKPOINT_MAGIC:
+            raise ValueError("Not a binary conversation checkpoint")
+        if schema_version > BINARY_CHECKPOINT_SCHEMA_VERSION:
+            raise ValueError(
+                f"Unsupported checkpoint schema version: {schema_version}"
+            )
+
+        payload = data[_BINARY_HEADER.size:]
+        if compression == ZLIB_COMPRESSION:
+            payload = zlib.decompress(payload)
+        elif compression == ZSTD_COMPRESSION:
+            if zstandard is None:
+                raise ImportError("zstandard is required to read the checkpoint")
+            payload = zstandard.ZstdDecompressor().decompress(payload)
+
+        if encoding == MSGPACK_ENCODING:
+            if msgpack is None:
+                raise ImportError("msgpack is required to read the checkpoint")
+            return cls.from_dict(msgpack.unpackb(payload))
+        return cls.from_dict(json.loads(payload))
+
+    def to_bytes(self, compression: str = DEFAULT_COMPRESSION) -> bytes:
+        """
+        Encode the checkpoint to the compact binary format: msgpack if it is
+        installed, compact json otherwise, behind a versioned header.
+
+        Args:
+            compression: The compression, one of COMPRESSIONS.
+        """
+        if msgpack is not None:
+            encoding = MSGPACK_ENCODING
+            payload = msgpack.packb(self.to_dict())
+        else:
+            encoding = JSON_ENCODING
+            payload = json.dumps(self.to_dict(), separators=(",", ":")).encode()
+
+        compression_id = COMPRESSIONS[compression]
+        if compression_id == ZLIB_COMPRESSION:
+            payload = zlib.compress(payload)
+        elif compression_id == ZSTD_COMPRESSION:
+            if zstandard is None:
+                raise ImportError("zstandard is required for zstd compression")
+            payload = zstandard.ZstdCompressor().compress(payload)
+
+        header = _BINARY_HEADER.pack(
+            BINARY_CHECKPOINT_MAGIC,
+            BINARY_CHECKPOINT_SCHEMA_VERSION,
+            encoding,
+            compression_id,
+        )
+        return header + payload
+
+    @classmethod
+    def from_binary(cls, file_path: Path) -> "GPT3ConversationCheckpoint":
+        """
+        Load a checkpoint from a binary file.
+
+        Args:
+            file_path: Path to the binary file.
+        """
+        return cls.from_bytes(file_path.read_bytes())
+
+    def to_binary(
+        self, save_path: Path, compression: str = DEFAULT_COMPRESSION
+    ) -> None:
+        """
+        Save the checkpoint to a binary file.
+
+        Args:
+            save_path: The path to save the checkpoint.
+            compression: The compression, one of COMPRESSIONS.
+        """
+        save_path.write_bytes(self.to_bytes(compression))
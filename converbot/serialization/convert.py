@@ -0,0 +1,126 @@
+import argparse
+from pathlib import Path
+from typing import Optional
+
+from converbot.constants import CONVERSATION_INDEX_FILE_NAME, CONVERSATION_SAVE_DIR
+from converbot.database.index import ConversationIndex
+from converbot.serialization.checkpoint import (
+    BINARY_CHECKPOINT_SUFFIX,
+    COMPRESSIONS,
+    DEFAULT_COMPRESSION,
+    JSON_CHECKPOINT_SUFFIX,
+    GPT3ConversationCheckpoint,
+)
+
+FORMAT_SUFFIXES = {
+    "json": JSON_CHECKPOINT_SUFFIX,
+    "binary": BINARY_CHECKPOINT_SUFFIX,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Convert the saved conversation checkpoints between the "
+                    "json and the binary formats"
+    )
+    parser.add_argument(
+        "--save_dir",
+        help="Directory with the saved conversations",
+        type=Path,
+        required=False,
+        default=CONVERSATION_SAVE_DIR,
+    )
+    parser.add_argument(
+        "--to",
+        help="Target checkpoint format",
+        type=str,
+        choices=list(FORMAT_SUFFIXES),
+        required=False,
+        default="binary",
+    )
+    parser.add_argument(
+        "--compression",
+        help="Compression of the binary checkpoints",
+        type=str,
+        choices=list(COMPRESSIONS),
+        required=False,
+        default=DEFAULT_COMPRESSION,
+    )
+    parser.add_argument(
+        "--index_path",
+        help="Path to the SQLite index of the saved conversations, "
+             f"{CONVERSATION_INDEX_FILE_NAME} in the save directory by default",
+        type=Path,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--keep",
+        help="Keep the original checkpoints",
+        action="store_true",
+    )
+    return parser.parse_args()
+
+
+def convert_checkpoints(
+    save_dir: Path,
+    target_suffix: str,
+    compression: str = DEFAULT_COMPRESSION,
+    keep: bool = False,
+    index_path: Optional[Path] = None,
+) -> int:
+    """
+    Convert every checkpoint under the directory to the target format, and
+    point the conversation index to the converted checkpoints.
+
+    Args:
+        save_dir: Directory with the saved conversations.
+        target_suffix: The suffix of the target format.
+        compression: Compression of the binary checkpoints.
+        keep: Whether to keep the original checkpoints.
+        index_path: The path to the SQLite index of the saved conversations,
+            the default index of the directory by default. The index is
+            built on the next start if it doesn't exist.
+
+    Returns: The number of converted checkpoints.
+    """
+    index_path = index_path or save_dir / CONVERSATION_INDEX_FILE_NAME
+    index = ConversationIndex(index_path, save_dir) if index_path.exists() else None
+
+    converted = 0
+    try:
+        for suffix in FORMAT_SUFFIXES.values():
+            if suffix == target_suffix:
+                continue
+            for file_path in save_dir.rglob(f"*{suffix}"):
+                checkpoint = GPT3ConversationCheckpoint.load(file_path)
+                target_path = file_path.with_suffix(target_suffix)
+                if target_suffix == BINARY_CHECKPOINT_SUFFIX:
+                    checkpoint.to_binary(target_path, compression=compression)
+                else:
+                    checkpoint.to_json(target_path)
+                if index is not None:
+                    index.update_path(file_path, target_path)
+                if not keep:
+                    file_path.unlink()
+                converted += 1
+    finally:
+        if index is not None:
+            index.close()
+    return converted
+
+
+def main():
+    args = parse_args()
+    converted = convert_checkpoints(
+        args.save_dir,
+        FORMAT_SUFFIXES[args.to],
+        compression=args.compression,
+        keep=args.keep,
+        index_path=args.index_path,
+    )
+    print(f"Converted {converted} checkpoints.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import json
+import uuid
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import List, Optional
+
+from converbot.serialization.checkpoint import GPT3ConversationCheckpoint
+
+
+@dataclass
+class JournalRecord:
+    """
+    The change of a conversation memory since the previous record.
+
+    Args:
+        dropped: The number of buffer lines dropped from the front.
+        lines: The lines appended to the buffer.
+        token_counts: The token counts of the appended lines.
+        moving_summary_buffer: The new moving summary, None if unchanged.
+        record_id: The unique id of the record, so a retried write stores it
+            once.
+    """
+
+    dropped: int
+    lines: List[str]
+    token_counts: List[int]
+    moving_summary_buffer: Optional[str] = None
+    record_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+
+    @property
+    def empty(self) -> bool:
+        return (
+            self.dropped == 0
+            and not self.lines
+            and self.moving_summary_buffer is None
+        )
+
+    def apply(self, checkpoint: GPT3ConversationCheckpoint) -> None:
+        """
+        Apply the change to the memory stored in a checkpoint.
+
+        Args:
+            checkpoint: The checkpoint to update.
+        """
+        del checkpoint.memory_buffer[: self.dropped]
+        checkpoint.memory_buffer.extend(self.lines)
+        if checkpoint.memory_token_counts is not None:
+            del checkpoint.memory_token_counts[: self.dropped]
+            checkpoint.memory_token_counts.extend(self.token_counts)
+        if self.moving_summary_buffer is not None:
+            checkpoint.memory_moving_summary_buffer = self.moving_summary_buffer
+
+
+class ConversationJournal:
+    """
+    An append-only log of the memory changes made after a checkpoint.
+
+    Args:
+        file_path: The path to the JSON lines journal file.
+    """
+
+    def __init__(self, file_path: Path) -> None:
+        self._file_path = file_path
+
+    def append(self, record: JournalRecord) -> None:
+        """
+        Append a record to the journal.
+
+        Args:
+            record: The record to append.
+        """
+        with open(self._file_path, "a") as f:
+            f.write(json.dumps(asdict(record)) + "\n")
+
+    def read(self) -> List[JournalRecord]:
+        """
+        Read the journal records, skipping a record torn by a crash.
+
+        Returns: The records, oldest first.
+        """
+        if not self._file_path.exists():
+            return []
+        records = []
+        for line in self._file_path.read_text().splitlines():
+            try:
+                records.append(JournalRecord(**json.loads(line)))
+            except json.JSONDecodeError:
+                break
+        return records
+
+    def replay(self, checkpoint: GPT3ConversationCheckpoint) -> int:
+        """
+        Apply the journal records to a checkpoint.
+
+        Args:
+            checkpoint: The checkpoint the journal was started from.
+
+        Returns: The number of records applied.
+        """
+        records = self.read()
+        for record in records:
+            record.apply(checkpoint)
+        return len(records)
+
+    def clear(self) -> None:
+        """
+        Remove the journal, e.g. after its records were folded into a
+        checkpoint.
+        """
+        self._file_path.unlink(missing_ok=True)
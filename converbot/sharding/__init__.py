@@ -0,0 +1,3 @@
+from converbot.sharding.dispatcher import ShardDispatcher
+from converbot.sharding.ring import HashRing
+from converbot.sharding.worker import ShardWorker
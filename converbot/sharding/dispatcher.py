@@ -0,0 +1,492 @@
+import argparse
+import asyncio
+import hmac
+import subprocess
+import sys
+from typing import Any, Awaitable, Callable, Collection, Dict, List, Optional, Sequence
+
+from aiogram import Bot
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
+
+from converbot.app.webhook import DEFAULT_WEBHOOK_PATH, create_webhook_app
+from converbot.sharding.ring import HashRing
+
+RING_ROUTE = "/ring"
+UPDATE_ROUTE = "/update"
+WORKERS_ROUTE = "/workers"
+# The ring version an update was routed by, see ShardWorker.
+RING_VERSION_HEADER = "X-Ring-Version"
+SHARD_SECRET_HEADER = "X-Shard-Secret"
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+
+def create_shard_secret_middleware(
+    paths: Collection[str], shard_secret: Optional[str]
+) -> Callable[..., Awaitable[web.StreamResponse]]:
+    """
+    Create an aiohttp middleware rejecting the requests to the sharding
+    control routes without the secret shared by the dispatchers and workers.
+
+    Args:
+        paths: The paths of the control routes, other routes aren't checked.
+        shard_secret: The shared secret, None to accept every request.
+    """
+
+    @web.middleware
+    async def check_shard_secret(
+        request: web.Request,
+        handler: Callable[[web.Request], Awaitable[web.StreamResponse]],
+    ) -> web.StreamResponse:
+        if (
+            shard_secret is not None
+            and request.path in paths
+            and not hmac.compare_digest(
+                request.headers.get(SHARD_SECRET_HEADER, ""), shard_secret
+            )
+        ):
+            raise web.HTTPUnauthorized()
+        return await handler(request)
+
+    return check_shard_secret
+
+
+def get_shard_headers(shard_secret: Optional[str]) -> Dict[str, str]:
+    """
+    Get the headers authenticating a request to the sharding control routes.
+    """
+    return {} if shard_secret is None else {SHARD_SECRET_HEADER: shard_secret}
+
+
+def get_update_user_id(update: Dict[str, Any]) -> Optional[int]:
+    """
+    Find the id of the user who sent a Telegram update.
+
+    Args:
+        update: The update as received from Telegram.
+
+    Returns: The user id, None for updates without a sender.
+    """
+    for value in update.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("chat")
+            if isinstance(sender, dict) and "id" in sender:
+                return sender["id"]
+    return None
+
+
+class ShardDispatcher:
+    """
+    Routes the Telegram updates to the worker owning their user by
+    consistent hashing of the user id. The updates are long polled or
+    received on a webhook.
+
+    When workers join or leave, the new ring is sent to every worker before
+    any update is routed by it. Workers write and forget the users they no
+    longer own before answering, so the new owner finds their latest state
+    in the shared checkpoint store. Updates wait while the ring changes.
+
+    Every update carries the version of the ring it was routed by, so a
+    worker dropped as unreachable learns it left the ring and stops serving
+    its users, see ShardWorker.
+
+    Args:
+        replicas: The number of ring positions of a worker.
+        request_timeout: The number of seconds to wait for a worker.
+        max_refusals: The number of times an update refused by the workers
+            is routed again.
+        shard_secret: The secret shared with the workers, None to accept
+            every request.
+    """
+
+    def __init__(
+        self,
+        replicas: int = 100,
+        request_timeout: float = 30.0,
+        max_refusals: int = 3,
+        shard_secret: Optional[str] = None,
+    ) -> None:
+        self._ring = HashRing(replicas=replicas)
+        self._ring_version = 0
+        self._replicas = replicas
+        self._ring_lock = asyncio.Lock()
+        self._timeout = ClientTimeout(total=request_timeout)
+        self._max_refusals = max_refusals
+        self._shard_secret = shard_secret
+        self._session: Optional[ClientSession] = None
+
+    @property
+    def ring(self) -> Dict[str, Any]:
+        return {
+            "version": self._ring_version,
+            "nodes": self._ring.nodes,
+            "replicas": self._replicas,
+        }
+
+    async def start(self) -> None:
+        self._session = ClientSession(
+            timeout=self._timeout, headers=get_shard_headers(self._shard_secret)
+        )
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+    async def add_worker(self, url: str) -> Dict[str, Any]:
+        """
+        Add a worker to the ring, handing it over its users.
+
+        Args:
+            url: The base url of the worker.
+
+        Returns: The new ring.
+        """
+        async with self._ring_lock:
+            if url not in self._ring:
+                await self._change_ring(self._ring.nodes + [url])
+            return self.ring
+
+    async def remove_worker(self, url: str, handoff: bool = True) -> Dict[str, Any]:
+        """
+        Remove a worker from the ring, handing its users over to the others.
+
+        Args:
+            url: The base url of the worker.
+            handoff: Whether the worker can still release its users.
+
+        Returns: The new ring.
+        """
+        async with self._ring_lock:
+            if url in self._ring:
+                nodes = [node for node in self._ring.nodes if node != url]
+                await self._change_ring(nodes, notify=[url] if handoff else [])
+            return self.ring
+
+    async def _change_ring(self, nodes: List[str], notify: Sequence[str] = ()) -> None:
+        """
+        Send the new ring to the workers and switch to it.
+
+        Args:
+            nodes: The workers of the new ring.
+            notify: Workers leaving the ring to send it to as well.
+        """
+        self._ring_version += 1
+        ring = {"version": self._ring_version, "nodes": nodes, "replicas": self._replicas}
+        # The joining workers learn the ring from their registration.
+        workers = [node for node in self._ring.nodes if node in nodes] + list(notify)
+        results = await asyncio.gather(
+            *(self._session.post(f"{worker}{RING_ROUTE}", json=ring) for worker in workers),
+            return_exceptions=True,
+        )
+        for worker, result in zip(workers, results):
+            if isinstance(result, BaseException):
+                print(f"Failed to hand off the users of {worker}: {result}")
+                continue
+            if result.status != 200:
+                print(f"Failed to hand off the users of {worker}: {result.status}")
+            result.release()
+        self._ring = HashRing(nodes, replicas=self._replicas)
+
+    async def route(self, update: Dict[str, Any]) -> None:
+        """
+        Forward an update to the worker owning its user.
+
+        Workers failing to accept it are removed from the ring, and the
+        update is routed again. So is an update refused by a worker not
+        owning its user by the latest ring.
+
+        Args:
+            update: The update as received from Telegram.
+        """
+        user_id = get_update_user_id(update)
+        key = str(user_id if user_id is not None else update.get("update_id"))
+        refusals = 0
+        while True:
+            async with self._ring_lock:
+                worker = self._ring.get_node(key)
+            if worker is None:
+                print(f"No workers to route update {update.get('update_id')} to")
+                return
+            try:
+                async with self._session.post(
+                    f"{worker}{UPDATE_ROUTE}",
+                    json=update,
+                    headers={RING_VERSION_HEADER: str(self._ring_version)},
+                ) as response:
+                    if response.status == 409:
+                        refusals += 1
+                        if refusals > self._max_refusals:
+                            print(
+                                f"Dropping update {update.get('update_id')} "
+                                f"refused by {worker}"
+                            )
+                            return
+                        continue
+                    response.raise_for_status()
+                return
+            except (ClientError, asyncio.TimeoutError) as e:
+                print(f"Removing unreachable worker {worker}: {e}")
+                await self.remove_worker(worker, handoff=False)
+
+    async def poll(self, bot: Bot, timeout: int = 20) -> None:
+        """
+        Long poll the Telegram updates and route them. The updates of a user
+        are routed in order.
+
+        Args:
+            bot: The bot to poll the updates of.
+            timeout: The long polling timeout in seconds.
+        """
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=timeout)
+            except Exception as e:
+                print(e)
+                await asyncio.sleep(1)
+                continue
+            if not updates:
+                continue
+            offset = updates[-1].update_id + 1
+
+            by_worker: Dict[Optional[str], List[Dict[str, Any]]] = {}
+            for update in updates:
+                data = update.to_python()
+                user_id = get_update_user_id(data)
+                by_worker.setdefault(
+                    self._ring.get_node(str(user_id if user_id is not None else update.update_id)),
+                    [],
+                ).append(data)
+            await asyncio.gather(
+                *(self._route_in_order(batch) for batch in by_worker.values())
+            )
+
+    async def _route_in_order(self, updates: List[Dict[str, Any]]) -> None:
+        for update in updates:
+            await self.route(update)
+
+    def create_app(
+        self,
+        webhook_path: Optional[str] = None,
+        secret_token: Optional[str] = None,
+    ) -> web.Application:
+        """
+        Create the web application the workers register with.
+
+        Args:
+            webhook_path: The path to receive the Telegram webhook on, None
+                when polling.
+            secret_token: The secret token expected from Telegram.
+        """
+
+        async def register(request: web.Request) -> web.Response:
+            data = await request.json()
+            return web.json_response(await self.add_worker(data["url"]))
+
+        async def deregister(request: web.Request) -> web.Response:
+            data = await request.json()
+            return web.json_response(
+                await self.remove_worker(data["url"], handoff=data.get("handoff", True))
+            )
+
+        async def ring(request: web.Request) -> web.Response:
+            return web.json_response(self.ring)
+
+        async def webhook(request: web.Request) -> web.Response:
+            await self.route(await request.json())
+            return web.Response(text="ok")
+
+        if webhook_path is None:
+            app = web.Application()
+        else:
+            app = create_webhook_app(webhook_path, secret_token)
+            app.router.add_post(webhook_path, webhook)
+        app.middlewares.append(
+            create_shard_secret_middleware([WORKERS_ROUTE, RING_ROUTE], self._shard_secret)
+        )
+        app.router.add_post(WORKERS_ROUTE, register)
+        app.router.add_delete(WORKERS_ROUTE, deregister)
+        app.router.add_get(RING_ROUTE, ring)
+        return app
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Arguments after -- are passed to the spawned bot workers."
+    )
+    parser.add_argument(
+        "--telegram_token",
+        help="Telegram token",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "--host",
+        help="Host to listen for the workers and the webhook on",
+        type=str,
+        required=False,
+        default="127.0.0.1",
+    )
+    parser.add_argument(
+        "--port",
+        help="Port to listen for the workers and the webhook on",
+        type=int,
+        required=False,
+        default=8080,
+    )
+    parser.add_argument(
+        "--replicas",
+        help="Number of ring positions of a worker",
+        type=int,
+        required=False,
+        default=100,
+    )
+    parser.add_argument(
+        "--mode",
+        help="How the Telegram updates are received",
+        type=str,
+        choices=["polling", "webhook"],
+        required=False,
+        default="polling",
+    )
+    parser.add_argument(
+        "--webhook_path",
+        help="Path the webhook is received on",
+        type=str,
+        required=False,
+        default=DEFAULT_WEBHOOK_PATH,
+    )
+    parser.add_argument(
+        "--webhook_url",
+        help="Public base url of the webhook to register with Telegram, "
+             "not registered if omitted",
+        type=str,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--webhook_secret",
+        help="Secret token Telegram sends with the webhook requests",
+        type=str,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--shard_secret",
+        help="Secret the dispatcher and the workers authenticate each other "
+             "with, required unless they only listen on the loopback",
+        type=str,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--telegram_api_url",
+        help="Base url of the Telegram Bot API, e.g. a local fake",
+        type=str,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of local bot worker processes to spawn",
+        type=int,
+        required=False,
+        default=0,
+    )
+    parser.add_argument(
+        "--worker_port",
+        help="Port of the first spawned worker, the next ones count up",
+        type=int,
+        required=False,
+        default=8081,
+    )
+    argv = sys.argv[1:]
+    worker_argv = []
+    if "--" in argv:
+        worker_argv = argv[argv.index("--") + 1:]
+        argv = argv[: argv.index("--")]
+    args = parser.parse_args(argv)
+    if args.shard_secret is None and args.host not in LOOPBACK_HOSTS:
+        parser.error("--shard_secret is required to listen beyond the loopback")
+    args.worker_argv = worker_argv
+    return args
+
+
+def spawn_workers(args) -> List[subprocess.Popen]:
+    """
+    Spawn the local bot worker processes registering with this dispatcher.
+    """
+    dispatcher_url = f"http://127.0.0.1:{args.port}"
+    worker_argv = ["--telegram_token", args.telegram_token] + args.worker_argv
+    if args.telegram_api_url is not None:
+        worker_argv += ["--telegram_api_url", args.telegram_api_url]
+    if args.shard_secret is not None:
+        worker_argv += ["--shard_secret", args.shard_secret]
+    return [
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "converbot.app.run",
+                *worker_argv,
+                "--dispatcher_url",
+                dispatcher_url,
+                "--shard_host",
+                "127.0.0.1",
+                "--shard_port",
+                str(args.worker_port + worker),
+            ]
+        )
+        for worker in range(args.workers)
+    ]
+
+
+async def run(args) -> None:
+    shard_dispatcher = ShardDispatcher(
+        replicas=args.replicas, shard_secret=args.shard_secret
+    )
+    await shard_dispatcher.start()
+
+    webhook_path = args.webhook_path if args.mode == "webhook" else None
+    runner = web.AppRunner(
+        shard_dispatcher.create_app(webhook_path, args.webhook_secret)
+    )
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+
+    bot = Bot(
+        token=args.telegram_token,
+        server=(
+            TelegramAPIServer.from_base(args.telegram_api_url)
+            if args.telegram_api_url is not None
+            else TELEGRAM_PRODUCTION
+        ),
+    )
+    workers = spawn_workers(args)
+    try:
+        if webhook_path is None:
+            await shard_dispatcher.poll(bot)
+        else:
+            if args.webhook_url is not None:
+                await bot.set_webhook(
+                    args.webhook_url.rstrip("/") + webhook_path,
+                    secret_token=args.webhook_secret,
+                )
+            await asyncio.Event().wait()
+    finally:
+        # The workers hand their users off while the dispatcher still runs.
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            await asyncio.get_running_loop().run_in_executor(None, worker.wait)
+        await runner.cleanup()
+        await shard_dispatcher.close()
+        await bot.session.close()
+
+
+def main():
+    asyncio.run(run(parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import bisect
+import hashlib
+from typing import Iterable, List, Optional, Tuple
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    A consistent hash ring assigning keys to nodes.
+
+    Every node is placed on the ring `replicas` times, so adding or removing
+    a node only moves about 1/N of the keys, spread evenly over the other
+    nodes.
+
+    Args:
+        nodes: The initial nodes.
+        replicas: The number of ring positions of a node.
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), replicas: int = 100) -> None:
+        self._replicas = replicas
+        self._positions: List[Tuple[int, str]] = []
+        for node in nodes:
+            self.add_node(node)
+
+    @property
+    def nodes(self) -> List[str]:
+        return sorted({node for _, node in self._positions})
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __contains__(self, node: str) -> bool:
+        return node in self.nodes
+
+    def add_node(self, node: str) -> None:
+        if node in self:
+            return
+        for replica in range(self._replicas):
+            bisect.insort(self._positions, (_hash(f"{node}#{replica}"), node))
+
+    def remove_node(self, node: str) -> None:
+        self._positions = [
+            position for position in self._positions if position[1] != node
+        ]
+
+    def get_node(self, key: str) -> Optional[str]:
+        """
+        Get the node owning the key, None if the ring is empty.
+
+        Args:
+            key: The key, e.g. a user id.
+        """
+        if not self._positions:
+            return None
+        index = bisect.bisect(self._positions, (_hash(key), ""))
+        return self._positions[index % len(self._positions)][1]
@@ -0,0 +1,221 @@
+import asyncio
+from typing import Any, Dict, List, Optional, Set
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import ClientError, ClientSession, web
+
+from converbot.database.conversations import ConversationDB
+from converbot.sharding.dispatcher import (
+    RING_ROUTE,
+    RING_VERSION_HEADER,
+    UPDATE_ROUTE,
+    WORKERS_ROUTE,
+    create_shard_secret_middleware,
+    get_shard_headers,
+    get_update_user_id,
+)
+from converbot.sharding.ring import HashRing
+from converbot.utils.keyed_executor import KeyedExecutor
+
+
+class ShardWorker:
+    """
+    Serves the users a ShardDispatcher assigns to this process.
+
+    The worker registers with the dispatcher on start and deregisters on
+    stop, handing its users over. A worker can register with several
+    dispatchers behind a balancer, they keep the same rings. On every ring
+    change it waits for the running turns of the users it no longer owns,
+    then releases them to the shared checkpoint store.
+
+    A worker dropped from the ring as unreachable is fenced: on an update
+    routed by a newer ring, or when checking the ring periodically, it finds
+    itself missing, forgets its users without writing them and joins again.
+
+    Args:
+        dispatcher: The aiogram dispatcher handling the updates.
+        conversations: The conversations of this worker.
+        url: The base url the dispatcher reaches this worker at.
+        dispatcher_urls: The base urls of the ShardDispatchers.
+        ring_check_interval: The number of seconds between two ring checks.
+        shard_secret: The secret shared with the dispatchers, None to accept
+            every request.
+    """
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        conversations: ConversationDB,
+        url: str,
+        dispatcher_urls: List[str],
+        ring_check_interval: float = 10.0,
+        shard_secret: Optional[str] = None,
+    ) -> None:
+        self._dispatcher = dispatcher
+        self._conversations = conversations
+        self._url = url
+        self._dispatcher_urls = dispatcher_urls
+        self._ring_check_interval = ring_check_interval
+        self._shard_secret = shard_secret
+        self._ring: Optional[HashRing] = None
+        self._ring_version = 0
+        self._ring_lock = asyncio.Lock()
+        # The updates being processed, in order per user.
+        self._updates = KeyedExecutor()
+        self._tasks: Set[asyncio.Task] = set()
+        self._check_task: Optional[asyncio.Task] = None
+
+    def _session(self) -> ClientSession:
+        return ClientSession(headers=get_shard_headers(self._shard_secret))
+
+    def owns(self, user_id: str) -> bool:
+        return self._ring is not None and self._ring.get_node(user_id) == self._url
+
+    def _set_ring(self, ring: Dict[str, Any]) -> bool:
+        self._ring_version = max(self._ring_version, ring["version"])
+        # Several dispatchers behind a balancer send the same rings.
+        if self._ring is not None and self._ring.nodes == sorted(ring["nodes"]):
+            return False
+        self._ring = HashRing(ring["nodes"], replicas=ring["replicas"])
+        return True
+
+    async def _apply_ring(self, ring: Dict[str, Any]) -> int:
+        """
+        Switch to the ring and release the users this worker no longer owns,
+        once their running turns finished.
+
+        Returns: The number of users released.
+        """
+        if not self._set_ring(ring):
+            return 0
+        await self._updates.wait_idle(lambda user_id: not self.owns(user_id))
+        return await self._conversations.arelease_users(self.owns)
+
+    async def register(self) -> None:
+        """
+        Join the ring and register the saved conversations of the owned users.
+        """
+        async with self._session() as session:
+            for dispatcher_url in self._dispatcher_urls:
+                async with session.post(
+                    f"{dispatcher_url}{WORKERS_ROUTE}", json={"url": self._url}
+                ) as response:
+                    response.raise_for_status()
+                    self._set_ring(await response.json())
+        self._conversations.load_conversations(owns=self.owns)
+
+    async def deregister(self, handoff: bool = True) -> None:
+        """
+        Leave the ring.
+
+        Args:
+            handoff: Whether the dispatchers should ask this worker to
+                release its users, False if it already did.
+        """
+        async with self._session() as session:
+            for dispatcher_url in self._dispatcher_urls:
+                async with session.delete(
+                    f"{dispatcher_url}{WORKERS_ROUTE}",
+                    json={"url": self._url, "handoff": handoff},
+                ) as response:
+                    response.raise_for_status()
+
+    async def check_ring(self) -> None:
+        """
+        Fetch the latest ring from the dispatchers. Switch to it, or rejoin
+        if this worker was dropped from it.
+        """
+        async with self._ring_lock:
+            rings = []
+            async with self._session() as session:
+                for dispatcher_url in self._dispatcher_urls:
+                    try:
+                        async with session.get(f"{dispatcher_url}{RING_ROUTE}") as response:
+                            response.raise_for_status()
+                            rings.append(await response.json())
+                    except (ClientError, asyncio.TimeoutError) as e:
+                        print(f"Failed to get the ring from {dispatcher_url}: {e}")
+            if not rings:
+                return
+            ring = max(rings, key=lambda ring: ring["version"])
+            if self._url in ring["nodes"]:
+                await self._apply_ring(ring)
+                return
+
+            # The new owners loaded the users from the store, the state here
+            # is stale.
+            discarded = self._conversations.discard_users()
+            print(f"Dropped from the ring, rejoining without {discarded} users")
+            self._ring = None
+            await self.register()
+
+    async def _check_ring_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self._ring_check_interval)
+            try:
+                await self.check_ring()
+            except Exception as e:
+                print(e)
+
+    async def start(self) -> None:
+        """
+        Join the ring and start checking it.
+        """
+        await self.register()
+        self._check_task = asyncio.create_task(self._check_ring_periodically())
+
+    async def stop(self) -> None:
+        """
+        Finish the running turns, write and release every user, then leave
+        the ring. The users are written first: by now the web server refuses
+        the dispatcher's request to release them.
+        """
+        if self._check_task is not None:
+            self._check_task.cancel()
+        async with self._ring_lock:
+            await self._updates.wait_idle()
+            await self._conversations.arelease_users(lambda user_id: False)
+            await self.deregister(handoff=False)
+
+    async def _process_update(self, data: Dict[str, Any]) -> None:
+        Bot.set_current(self._dispatcher.bot)
+        Dispatcher.set_current(self._dispatcher)
+        await self._dispatcher.process_updates([types.Update(**data)])
+
+    def create_app(self) -> web.Application:
+        """
+        Create the web application the dispatcher forwards the updates to.
+        """
+
+        async def update(request: web.Request) -> web.Response:
+            data = await request.json()
+            if int(request.headers.get(RING_VERSION_HEADER, 0)) > self._ring_version:
+                # A ring change this worker missed, it may have been dropped.
+                await self.check_ring()
+            user_id = get_update_user_id(data)
+            key = str(user_id if user_id is not None else data.get("update_id"))
+            if not self.owns(key):
+                return web.json_response({"ok": False}, status=409)
+
+            # Acknowledge right away, the dispatcher waits for it. The ring
+            # changes wait for the user's turn to finish.
+            task = asyncio.create_task(self._updates.run(key, self._process_update, data))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            return web.json_response({"ok": True})
+
+        async def ring(request: web.Request) -> web.Response:
+            async with self._ring_lock:
+                released = await self._apply_ring(await request.json())
+            return web.json_response({"released": released})
+
+        app = web.Application(
+            middlewares=[
+                create_shard_secret_middleware(
+                    [UPDATE_ROUTE, RING_ROUTE], self._shard_secret
+                )
+            ]
+        )
+        app.router.add_post(UPDATE_ROUTE, update)
+        app.router.add_post(RING_ROUTE, ring)
+        return app
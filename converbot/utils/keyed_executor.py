@@ -0,0 +1,106 @@
+import asyncio
+import functools
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+async def _idle() -> None:
+    pass
+
+
+class _KeyState:
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.depth = 0
+
+
+class KeyedExecutor:
+    """
+    Runs coroutines one at a time and in arrival order per key, and
+    concurrently across keys.
+
+    The state of a key only exists while it has queued or running
+    coroutines, so idle keys cost nothing.
+    """
+
+    def __init__(self) -> None:
+        self._states: Dict[Hashable, _KeyState] = {}
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def queue_depth(self, key: Hashable) -> int:
+        """
+        Get the number of queued and running coroutines of the key.
+
+        Args:
+            key: The key, e.g. a user id.
+        """
+        state = self._states.get(key)
+        return 0 if state is None else state.depth
+
+    @property
+    def queue_depths(self) -> Dict[Hashable, int]:
+        """
+        The number of queued and running coroutines of every active key.
+        """
+        return {key: state.depth for key, state in self._states.items()}
+
+    async def run(
+        self, key: Hashable, function: Callable[..., Awaitable[T]], *args: Any, **kwargs: Any
+    ) -> T:
+        """
+        Run the coroutine function once the earlier ones of the key finished.
+
+        Args:
+            key: The key to order by.
+            function: The coroutine function.
+            *args: The positional arguments of the function.
+            **kwargs: The keyword arguments of the function.
+
+        Returns: The result of the function.
+        """
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _KeyState()
+        state.depth += 1
+        try:
+            # asyncio.Lock wakes up its waiters in FIFO order.
+            async with state.lock:
+                return await function(*args, **kwargs)
+        finally:
+            state.depth -= 1
+            if state.depth == 0:
+                del self._states[key]
+
+    async def wait_idle(
+        self, predicate: Optional[Callable[[Hashable], bool]] = None
+    ) -> None:
+        """
+        Wait until the coroutines queued so far for the matching keys finished.
+
+        Args:
+            predicate: Whether to wait for a key, all keys by default.
+        """
+        keys = [key for key in self._states if predicate is None or predicate(key)]
+        await asyncio.gather(*(self.run(key, _idle) for key in keys))
+
+    def ordered(
+        self, key: Callable[..., Hashable]
+    ) -> Callable[[Callable[..., Awaitable[T]]], Callable[..., Awaitable[T]]]:
+        """
+        Decorate a coroutine function to run in order per key.
+
+        Args:
+            key: Computes the key from the arguments of the function.
+        """
+
+        def decorator(function: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+            @functools.wraps(function)
+            async def wrapper(*args: Any, **kwargs: Any) -> T:
+                return await self.run(key(*args, **kwargs), function, *args, **kwargs)
+
+            return wrapper
+
+        return decorator
@@ -0,0 +1,238 @@
+import asyncio
+import random
+import time
+from typing import Any, Awaitable, Callable, Optional, Sequence, Type, TypeVar
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a service the circuit breaker considers down.
+    """
+
+
+def is_transient_error(
+    error: BaseException, transient_errors: Sequence[Type[BaseException]] = ()
+) -> bool:
+    """
+    Whether an error is likely to go away on retry: timeouts, overloads and
+    the errors of the service.
+
+    Args:
+        error: The error.
+        transient_errors: The transient error types of the service, e.g.
+            its rate limits and dropped connections.
+    """
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, (asyncio.TimeoutError, *transient_errors)):
+        return True
+    return "overloaded" in str(error).lower()
+
+
+def get_retry_after(error: BaseException) -> Optional[float]:
+    """
+    Get the number of seconds the service asked to wait before a retry.
+
+    Returns: The number of seconds, None if the error doesn't tell.
+    """
+    headers = getattr(error, "headers", None) or {}
+    try:
+        retry_after = headers.get("retry-after") or headers.get("Retry-After")
+        if retry_after is not None:
+            return max(0.0, float(retry_after))
+    except (AttributeError, TypeError, ValueError):
+        pass
+    # aiogram's RetryAfter.
+    timeout = getattr(error, "timeout", None)
+    if isinstance(timeout, (int, float)):
+        return float(timeout)
+    return None
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service for a while.
+
+    After `failure_threshold` consecutive transient failures, see
+    `is_transient_error`, the circuit opens
+    and calls fail fast with CircuitOpenError. After `reset_timeout` seconds
+    one trial call goes through, closing the circuit on success and opening
+    it again on failure.
+
+    Args:
+        failure_threshold: The number of consecutive failures opening it.
+        reset_timeout: The number of seconds to stay open.
+        name: The name of the service, for the messages.
+        transient_errors: The transient error types of the service.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        name: str = "service",
+        transient_errors: Sequence[Type[BaseException]] = (),
+    ) -> None:
+        self._transient_errors = tuple(transient_errors)
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._name = name
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and self._remaining() <= 0:
+            return HALF_OPEN
+        return self._state
+
+    def _remaining(self) -> float:
+        return self._opened_at + self._reset_timeout - time.monotonic()
+
+    def allow(self) -> None:
+        """
+        Check that a call may go through.
+
+        Raises: CircuitOpenError if the circuit is open, or half open with
+            its trial call still running.
+        """
+        if self._state == CLOSED:
+            return
+        if self._state == OPEN and self._remaining() <= 0:
+            self._state = HALF_OPEN
+            return
+        raise CircuitOpenError(
+            f"The {self._name} is unavailable, retrying in "
+            f"{max(0.0, self._remaining()):.0f}s"
+        )
+
+    def record_success(self) -> None:
+        self._state = CLOSED
+        self._failures = 0
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._state == HALF_OPEN or self._failures >= self._failure_threshold:
+            if self._state != OPEN:
+                print(f"The {self._name} is failing, opening the circuit")
+            self._state = OPEN
+            self._opened_at = time.monotonic()
+
+    async def call(
+        self, function: Callable[..., Awaitable[T]], *args: Any, **kwargs: Any
+    ) -> T:
+        """
+        Call the coroutine function unless the circuit is open. Only transient
+        errors count as failures of the service.
+        """
+        self.allow()
+        try:
+            result = await function(*args, **kwargs)
+        except BaseException as e:
+            if isinstance(e, Exception) and is_transient_error(
+                e, self._transient_errors
+            ):
+                self.record_failure()
+            elif self._state == HALF_OPEN:
+                # The trial told nothing about the service, e.g. it was
+                # cancelled, the next call tries again.
+                self._state = OPEN
+                self._opened_at = time.monotonic() - self._reset_timeout
+            raise
+        self.record_success()
+        return result
+
+
+class RetryPolicy:
+    """
+    Retries a coroutine function on transient errors with exponential backoff
+    and full jitter, honoring the retry-after the service asks for.
+
+    Only wrap idempotent steps: every attempt runs the whole function again.
+
+    Args:
+        max_attempts: The maximum number of attempts, including the first.
+        base_delay: The delay in seconds before the first retry.
+        max_delay: The maximum delay in seconds between two attempts.
+        jitter: Whether to wait a random delay up to the backoff.
+        transient_errors: The transient error types of the service, retried
+            unless `retry_on` is given.
+        retry_on: Whether to retry after an error.
+        breaker: The circuit breaker of the service, if any.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 20.0,
+        jitter: bool = True,
+        transient_errors: Sequence[Type[BaseException]] = (),
+        retry_on: Optional[Callable[[BaseException], bool]] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ) -> None:
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._jitter = jitter
+        if retry_on is None:
+            transient_errors = tuple(transient_errors)
+
+            def retry_on(error: BaseException) -> bool:
+                return is_transient_error(error, transient_errors)
+
+        self._retry_on = retry_on
+        self._breaker = breaker
+
+    @property
+    def breaker(self) -> Optional[CircuitBreaker]:
+        return self._breaker
+
+    def get_delay(self, attempt: int, error: BaseException) -> float:
+        """
+        Get the number of seconds to wait after a failed attempt.
+
+        Args:
+            attempt: The number of the failed attempt, from 1.
+            error: The error of the attempt.
+        """
+        delay = min(self._max_delay, self._base_delay * 2 ** (attempt - 1))
+        if self._jitter:
+            delay = random.uniform(0, delay)
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self._max_delay))
+        return delay
+
+    async def call(
+        self, function: Callable[..., Awaitable[T]], *args: Any, **kwargs: Any
+    ) -> T:
+        """
+        Call the coroutine function, retrying it on transient errors.
+
+        Returns: The result of the first successful attempt.
+
+        Raises: The error of the last attempt, or CircuitOpenError if the
+            circuit breaker is open.
+        """
+        attempt = 1
+        while True:
+            try:
+                if self._breaker is not None:
+                    return await self._breaker.call(function, *args, **kwargs)
+                return await function(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self._max_attempts or not self._retry_on(e):
+                    raise
+                delay = self.get_delay(attempt, e)
+                print(f"Attempt {attempt} failed, retrying in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+            attempt += 1
@@ -19,9 +19,15 @@ setup(
     version="0.0.1",
     packages=find_packages(exclude=["tests", "config"]),
     install_requires=_load_requirements(THIS_DIR),
+    extras_require={
+        "binary": ["msgpack", "zstandard"],
+        "test": ["pytest"],
+    },
     entry_points={
         "console_scripts": [
             "run_converbot = converbot.app.run:main",
+            "run_converbot_dispatcher = converbot.sharding.dispatcher:main",
+            "convert_converbot_checkpoints = converbot.serialization.convert:main",
         ],
     },
 )
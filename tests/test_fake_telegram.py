@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiogram")
+
+from aiogram import Bot
+from aiogram.bot.api import TelegramAPIServer
+from aiohttp import ClientResponseError, ClientSession, web
+
+from converbot.app.fake_telegram import FakeTelegram
+from converbot.app.webhook import create_webhook_app
+
+WEBHOOK_PATH = "/webhook"
+SECRET = "secret"
+
+
+async def start(app):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+
+def test_records_the_messages_of_the_bot():
+    async def main():
+        fake_telegram = FakeTelegram("http://127.0.0.1:1/unused")
+        runner, url = await start(fake_telegram.create_app())
+        bot = Bot(token="123456:TEST", server=TelegramAPIServer.from_base(url))
+        try:
+            message = await bot.send_message(42, "Hello!")
+            await bot.edit_message_text(
+                "Hello again!", chat_id=42, message_id=message.message_id
+            )
+            replies = await fake_telegram.wait_for_replies(1, timeout=1.0)
+        finally:
+            await (await bot.get_session()).close()
+            await runner.cleanup()
+        return fake_telegram, replies
+
+    fake_telegram, replies = asyncio.run(main())
+
+    assert replies == 1
+    assert fake_telegram.replies == {42: ["Hello!"]}
+    assert [call["method"] for call in fake_telegram.calls] == [
+        "sendmessage",
+        "editmessagetext",
+    ]
+
+
+def test_sends_updates_with_the_secret_token():
+    received = []
+
+    async def webhook(request):
+        received.append(await request.json())
+        return web.Response(text="ok")
+
+    async def main():
+        app = create_webhook_app(WEBHOOK_PATH, SECRET)
+        app.router.add_post(WEBHOOK_PATH, webhook)
+        runner, url = await start(app)
+        try:
+            async with ClientSession() as session:
+                fake_telegram = FakeTelegram(f"{url}{WEBHOOK_PATH}", SECRET)
+                await fake_telegram.send_update(
+                    session, fake_telegram.make_update(7, "Hi")
+                )
+                intruder = FakeTelegram(f"{url}{WEBHOOK_PATH}", "wrong")
+                try:
+                    await intruder.send_update(session, intruder.make_update(7, "Hi"))
+                except ClientResponseError as e:
+                    return e.status
+        finally:
+            await runner.cleanup()
+
+    assert asyncio.run(main()) == 401
+    assert len(received) == 1
+    assert received[0]["message"]["from"]["id"] == 7
+    assert received[0]["message"]["text"] == "Hi"
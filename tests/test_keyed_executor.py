@@ -0,0 +1,140 @@
+import asyncio
+
+from converbot.utils.keyed_executor import KeyedExecutor
+
+
+def test_runs_the_coroutines_of_a_key_in_arrival_order():
+    events = []
+
+    async def turn(key, index):
+        events.append((key, index, "start"))
+        # The later turns are faster, they would overtake unordered.
+        await asyncio.sleep(0.01 * (5 - index))
+        events.append((key, index, "end"))
+
+    async def main():
+        executor = KeyedExecutor()
+        await asyncio.gather(
+            *(
+                executor.run(key, turn, key, index)
+                for index in range(5)
+                for key in ("a", "b")
+            )
+        )
+        return executor
+
+    executor = asyncio.run(main())
+
+    for key in ("a", "b"):
+        assert [(index, event) for k, index, event in events if k == key] == [
+            (index, event) for index in range(5) for event in ("start", "end")
+        ]
+    # Idle keys are forgotten.
+    assert len(executor) == 0
+
+
+def test_runs_different_keys_concurrently():
+    running = 0
+    max_running = 0
+
+    async def turn():
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def main():
+        executor = KeyedExecutor()
+        await asyncio.gather(*(executor.run(key, turn) for key in range(4)))
+
+    asyncio.run(main())
+
+    assert max_running == 4
+
+
+def test_keeps_the_order_after_a_failure():
+    events = []
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        events.append("fail")
+        raise ValueError("failed")
+
+    async def succeed():
+        events.append("succeed")
+
+    async def main():
+        executor = KeyedExecutor()
+        return await asyncio.gather(
+            executor.run("a", fail),
+            executor.run("a", succeed),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(main())
+
+    assert isinstance(results[0], ValueError)
+    assert events == ["fail", "succeed"]
+
+
+def test_counts_the_queued_coroutines():
+    async def main():
+        executor = KeyedExecutor()
+        release = asyncio.Event()
+        tasks = [
+            asyncio.create_task(executor.run("a", release.wait)) for _ in range(3)
+        ]
+        await asyncio.sleep(0)
+        depths = executor.queue_depth("a"), executor.queue_depths
+        release.set()
+        await asyncio.gather(*tasks)
+        return depths, executor.queue_depth("a")
+
+    (depth, depths), depth_after = asyncio.run(main())
+
+    assert depth == 3
+    assert depths == {"a": 3}
+    assert depth_after == 0
+
+
+def test_ordered_decorator_orders_by_the_key_function():
+    events = []
+    executor = KeyedExecutor()
+
+    @executor.ordered(key=lambda user_id, text: user_id)
+    async def handle(user_id, text):
+        await asyncio.sleep(0.01 if text == "first" else 0)
+        events.append((user_id, text))
+
+    async def main():
+        await asyncio.gather(handle(1, "first"), handle(1, "second"), handle(2, "other"))
+
+    asyncio.run(main())
+
+    assert [text for user_id, text in events if user_id == 1] == ["first", "second"]
+    # The other user didn't wait for the first one.
+    assert events[0] == (2, "other")
+
+
+def test_wait_idle_waits_for_the_matching_keys_only():
+    events = []
+
+    async def turn(key, delay):
+        await asyncio.sleep(delay)
+        events.append(key)
+
+    async def main():
+        executor = KeyedExecutor()
+        tasks = [
+            asyncio.create_task(executor.run("released", turn, "released", 0.02)),
+            asyncio.create_task(executor.run("kept", turn, "kept", 0.2)),
+        ]
+        await asyncio.sleep(0)
+        await executor.wait_idle(lambda key: key == "released")
+        events.append("idle")
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+
+    assert events == ["released", "idle", "kept"]
@@ -0,0 +1,206 @@
+import asyncio
+import time
+
+import pytest
+
+from converbot.utils.retry import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryPolicy,
+    get_retry_after,
+    is_transient_error,
+)
+
+
+class TransientError(Exception):
+    pass
+
+
+class Calls:
+    """
+    A coroutine function failing with the given errors, then returning "ok".
+    """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.count = 0
+
+    async def __call__(self):
+        self.count += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+def create_breaker(reset_timeout=0.05):
+    return CircuitBreaker(
+        failure_threshold=2,
+        reset_timeout=reset_timeout,
+        transient_errors=(TransientError,),
+    )
+
+
+def fail_until_open(breaker):
+    for _ in range(2):
+        with pytest.raises(TransientError):
+            asyncio.run(breaker.call(Calls(TransientError())))
+
+
+def test_transient_errors():
+    assert is_transient_error(TransientError(), (TransientError,))
+    assert is_transient_error(asyncio.TimeoutError())
+    assert is_transient_error(RuntimeError("The server is overloaded"))
+    assert not is_transient_error(TransientError())
+    assert not is_transient_error(CircuitOpenError(), (CircuitOpenError,))
+
+
+def test_retry_after():
+    class HTTPError(Exception):
+        headers = {"retry-after": "3"}
+
+    class RetryAfter(Exception):
+        timeout = 5
+
+    assert get_retry_after(HTTPError()) == 3.0
+    assert get_retry_after(RetryAfter()) == 5.0
+    assert get_retry_after(ValueError()) is None
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = create_breaker()
+    fail_until_open(breaker)
+    calls = Calls()
+
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(breaker.call(calls))
+
+    assert breaker.state == OPEN
+    assert calls.count == 0
+
+
+def test_breaker_ignores_the_errors_of_the_requests():
+    breaker = create_breaker()
+
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            asyncio.run(breaker.call(Calls(ValueError())))
+
+    assert breaker.state == CLOSED
+
+
+def test_half_open_breaker_closes_on_a_successful_trial():
+    breaker = create_breaker()
+    fail_until_open(breaker)
+    time.sleep(0.06)
+
+    assert breaker.state == HALF_OPEN
+    assert asyncio.run(breaker.call(Calls())) == "ok"
+    assert breaker.state == CLOSED
+
+
+def test_half_open_breaker_opens_again_on_a_failed_trial():
+    breaker = create_breaker()
+    fail_until_open(breaker)
+    time.sleep(0.06)
+
+    with pytest.raises(TransientError):
+        asyncio.run(breaker.call(Calls(TransientError())))
+
+    assert breaker.state == OPEN
+
+
+def test_half_open_breaker_allows_a_single_trial():
+    async def main():
+        breaker = create_breaker()
+        breaker.record_failure()
+        breaker.record_failure()
+        await asyncio.sleep(0.06)
+        trial = asyncio.create_task(breaker.call(asyncio.sleep, 0.05, "ok"))
+        await asyncio.sleep(0)
+        with pytest.raises(CircuitOpenError):
+            await breaker.call(Calls())
+        return await trial, breaker.state
+
+    assert asyncio.run(main()) == ("ok", CLOSED)
+
+
+def test_cancelled_trial_lets_the_next_call_try():
+    async def main():
+        breaker = create_breaker(reset_timeout=10.0)
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker._opened_at -= 10.0
+        trial = asyncio.create_task(breaker.call(asyncio.sleep, 1.0))
+        await asyncio.sleep(0)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        return await breaker.call(Calls())
+
+    assert asyncio.run(main()) == "ok"
+
+
+def test_policy_retries_transient_errors():
+    calls = Calls(TransientError(), TransientError())
+    policy = RetryPolicy(base_delay=0.001, transient_errors=(TransientError,))
+
+    assert asyncio.run(policy.call(calls)) == "ok"
+    assert calls.count == 3
+
+
+def test_policy_gives_up_after_the_last_attempt():
+    calls = Calls(*(TransientError() for _ in range(5)))
+    policy = RetryPolicy(
+        max_attempts=3, base_delay=0.001, transient_errors=(TransientError,)
+    )
+
+    with pytest.raises(TransientError):
+        asyncio.run(policy.call(calls))
+    assert calls.count == 3
+
+
+def test_policy_does_not_retry_other_errors():
+    calls = Calls(ValueError())
+    policy = RetryPolicy(base_delay=0.001, transient_errors=(TransientError,))
+
+    with pytest.raises(ValueError):
+        asyncio.run(policy.call(calls))
+    assert calls.count == 1
+
+
+def test_policy_stops_at_an_open_breaker():
+    breaker = create_breaker()
+    calls = Calls(*(TransientError() for _ in range(5)))
+    policy = RetryPolicy(
+        max_attempts=5,
+        base_delay=0.001,
+        transient_errors=(TransientError,),
+        breaker=breaker,
+    )
+
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(policy.call(calls))
+    assert calls.count == 2
+
+
+def test_delay_grows_exponentially_up_to_the_maximum():
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0, jitter=False)
+
+    assert [policy.get_delay(attempt, ValueError()) for attempt in range(1, 5)] == [
+        1.0,
+        2.0,
+        4.0,
+        5.0,
+    ]
+
+
+def test_delay_honors_the_retry_after():
+    class RetryAfter(Exception):
+        timeout = 3
+
+    policy = RetryPolicy(base_delay=0.1, max_delay=10.0)
+
+    assert policy.get_delay(1, RetryAfter()) == 3.0
@@ -0,0 +1,66 @@
+import pytest
+
+# The sharding package imports the dispatcher.
+pytest.importorskip("aiogram")
+
+from converbot.sharding.ring import HashRing
+
+KEYS = [str(user_id) for user_id in range(10000)]
+
+
+def test_empty_ring_has_no_owner():
+    assert HashRing().get_node("1") is None
+
+
+def test_assigns_every_key_to_a_node():
+    ring = HashRing(["a", "b", "c"])
+
+    owners = {ring.get_node(key) for key in KEYS}
+
+    assert owners == {"a", "b", "c"}
+    assert ring.nodes == ["a", "b", "c"]
+    assert "b" in ring and "d" not in ring
+
+
+def test_added_node_only_takes_keys_over():
+    ring = HashRing(["a", "b", "c"])
+    before = {key: ring.get_node(key) for key in KEYS}
+
+    ring.add_node("d")
+    after = {key: ring.get_node(key) for key in KEYS}
+
+    moved = [key for key in KEYS if before[key] != after[key]]
+    # Keys only move to the new node, about 1/N of them.
+    assert all(after[key] == "d" for key in moved)
+    assert 0.15 < len(moved) / len(KEYS) < 0.35
+
+
+def test_removed_node_hands_its_keys_to_the_others():
+    ring = HashRing(["a", "b", "c", "d"])
+    before = {key: ring.get_node(key) for key in KEYS}
+
+    ring.remove_node("d")
+    after = {key: ring.get_node(key) for key in KEYS}
+
+    for key in KEYS:
+        if before[key] == "d":
+            assert after[key] in ("a", "b", "c")
+        else:
+            assert after[key] == before[key]
+
+
+def test_assignment_only_depends_on_the_nodes():
+    assert [HashRing(["a", "b", "c"]).get_node(key) for key in KEYS[:100]] == [
+        HashRing(["c", "a", "b"]).get_node(key) for key in KEYS[:100]
+    ]
+
+
+def test_adding_a_node_twice_is_ignored():
+    ring = HashRing(["a", "b"])
+
+    ring.add_node("a")
+    ring.remove_node("b")
+
+    assert all(ring.get_node(key) == "a" for key in KEYS[:100])
+    ring.remove_node("a")
+    assert ring.get_node("1") is None
@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+# The llm package imports the OpenAI LLMs.
+pytest.importorskip("langchain")
+
+from converbot.llm.scheduler import (
+    BACKGROUND_PRIORITY,
+    CHAT_PRIORITY,
+    LLMBusyError,
+    LLMScheduler,
+    set_llm_priority,
+    set_llm_user,
+)
+
+
+async def acquire(scheduler, admitted, user_id, tokens, priority=CHAT_PRIORITY):
+    set_llm_user(user_id)
+    set_llm_priority(priority)
+    await scheduler.acquire(tokens)
+    admitted.append(user_id)
+
+
+def test_admits_within_the_budget_right_away():
+    async def main():
+        scheduler = LLMScheduler(requests_per_minute=60, tokens_per_minute=6000)
+        admitted = []
+        await asyncio.wait_for(
+            asyncio.gather(*(acquire(scheduler, admitted, user, 10) for user in "abc")),
+            timeout=0.5,
+        )
+        return admitted, scheduler.metrics
+
+    admitted, metrics = asyncio.run(main())
+
+    assert admitted == ["a", "b", "c"]
+    assert metrics["admitted"] == 3
+    assert metrics["queue_depth"] == 0
+
+
+def test_a_chatty_user_does_not_starve_the_others():
+    async def main():
+        # 100 tokens per second once the first call drained the bucket.
+        scheduler = LLMScheduler(tokens_per_minute=6000)
+        admitted = []
+        await acquire(scheduler, admitted, "chatty", 6000)
+        backlog = [
+            asyncio.create_task(acquire(scheduler, admitted, "chatty", 10))
+            for _ in range(4)
+        ]
+        await asyncio.sleep(0)
+        newcomer = asyncio.create_task(acquire(scheduler, admitted, "newcomer", 10))
+        await asyncio.gather(*backlog, newcomer)
+        return admitted
+
+    admitted = asyncio.run(main())
+
+    # The newcomer goes ahead of the backlog queued before it.
+    assert admitted[:2] == ["chatty", "newcomer"]
+    assert admitted.count("chatty") == 5
+
+
+def test_admits_the_higher_priorities_first():
+    async def main():
+        scheduler = LLMScheduler(tokens_per_minute=6000)
+        admitted = []
+        await acquire(scheduler, admitted, "warmup", 6000)
+        background = asyncio.create_task(
+            acquire(scheduler, admitted, "background", 10, BACKGROUND_PRIORITY)
+        )
+        await asyncio.sleep(0)
+        chat = asyncio.create_task(acquire(scheduler, admitted, "chat", 10))
+        await asyncio.gather(background, chat)
+        return admitted
+
+    assert asyncio.run(main()) == ["warmup", "chat", "background"]
+
+
+def test_rejects_the_calls_waiting_too_long():
+    async def main():
+        scheduler = LLMScheduler(tokens_per_minute=600, max_wait=0.05)
+        await scheduler.acquire(600)
+        with pytest.raises(LLMBusyError):
+            await scheduler.acquire(100)
+        return scheduler.metrics
+
+    metrics = asyncio.run(main())
+
+    assert metrics["rejected"] == 1
+    assert metrics["queue_depth"] == 0
+
+
+def test_a_rejected_call_does_not_block_the_ones_behind():
+    async def main():
+        scheduler = LLMScheduler(tokens_per_minute=6000)
+        await scheduler.acquire(6000)
+        admitted = []
+        # Waits for far more tokens than the next call.
+        large = asyncio.create_task(scheduler.acquire(3000, max_wait=0.05))
+        await asyncio.sleep(0)
+        small = asyncio.create_task(acquire(scheduler, admitted, "small", 10))
+        with pytest.raises(LLMBusyError):
+            await large
+        await asyncio.wait_for(small, timeout=1.0)
+        return admitted
+
+    assert asyncio.run(main()) == ["small"]
+
+
+def test_weights_share_the_throughput():
+    async def main():
+        scheduler = LLMScheduler(tokens_per_minute=6000, weights={"heavy": 3.0})
+        admitted = []
+        await acquire(scheduler, admitted, "warmup", 6000)
+        tasks = [
+            asyncio.create_task(acquire(scheduler, admitted, user, 10))
+            for _ in range(4)
+            for user in ("light", "heavy")
+        ]
+        await asyncio.gather(*tasks)
+        return admitted[1:]
+
+    admitted = asyncio.run(main())
+
+    # The heavier user gets 3 calls for each of the lighter one's.
+    assert admitted[:4].count("heavy") == 3
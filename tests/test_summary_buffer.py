@@ -0,0 +1,102 @@
+import pytest
+
+pytest.importorskip("langchain")
+
+from langchain.llms.fake import FakeListLLM
+
+from converbot.memory import summary_buffer
+from converbot.memory.summary_buffer import SummaryBufferMemory
+
+
+@pytest.fixture(autouse=True)
+def count_words(monkeypatch):
+    # No tokenizer download, a token per word.
+    monkeypatch.setattr(
+        summary_buffer, "count_tokens", lambda text, model_name: len(text.split())
+    )
+
+
+def create_memory(max_token_limit=10):
+    return SummaryBufferMemory(
+        llm=FakeListLLM(responses=[f"summary {index}" for index in range(100)]),
+        max_token_limit=max_token_limit,
+        input_key="input",
+        human_prefix="Human",
+        ai_prefix="AI",
+    )
+
+
+def save_turns(memory, count, start=0):
+    for index in range(start, start + count):
+        memory.save_context({"input": f"question {index}"}, {"output": f"answer {index}"})
+
+
+def replay(lines, delta):
+    dropped, new_lines, token_counts, moving_summary_buffer = delta
+    return lines[dropped:] + new_lines
+
+
+def test_delta_without_changes_is_empty():
+    memory = create_memory()
+    save_turns(memory, 1)
+
+    assert memory.delta_since(memory.cursor()) == (0, [], [], None)
+
+
+def test_delta_without_pruning_only_appends():
+    memory = create_memory(max_token_limit=100)
+    save_turns(memory, 1)
+    lines = list(memory.buffer)
+    cursor = memory.cursor()
+
+    save_turns(memory, 2, start=1)
+    delta = memory.delta_since(cursor)
+
+    assert delta[0] == 0
+    assert delta[1] == list(memory.buffer)[1:]
+    assert delta[2] == [6, 6]
+    assert delta[3] is None
+    assert replay(lines, delta) == list(memory.buffer)
+
+
+def test_delta_after_pruning_replays_to_the_buffer():
+    memory = create_memory()
+    save_turns(memory, 1)
+    lines = list(memory.buffer)
+    cursor = memory.cursor()
+
+    # A turn is 6 words, the limit of 10 keeps only the newest one.
+    save_turns(memory, 2, start=1)
+    delta = memory.delta_since(cursor)
+
+    assert memory.dropped_count == 2
+    assert replay(lines, delta) == list(memory.buffer)
+    assert delta[3] == memory.moving_summary_buffer == "summary 1"
+
+
+def test_delta_skips_lines_appended_and_pruned_since_the_cursor():
+    memory = create_memory()
+    save_turns(memory, 1)
+    lines = list(memory.buffer)
+    cursor = memory.cursor()
+
+    save_turns(memory, 5, start=1)
+    dropped, new_lines, token_counts, _ = memory.delta_since(cursor)
+
+    # Only the lines still in the buffer are sent.
+    assert dropped == len(lines)
+    assert new_lines == list(memory.buffer) == ["Human: question 5\nAI: answer 5"]
+    assert token_counts == list(memory.token_counts)
+
+
+def test_successive_deltas_replay_to_the_buffer():
+    memory = create_memory(max_token_limit=20)
+    lines = []
+    cursor = memory.cursor()
+
+    for turn in range(10):
+        save_turns(memory, 1, start=turn)
+        delta = memory.delta_since(cursor)
+        lines = replay(lines, delta)
+        cursor = memory.cursor()
+        assert lines == list(memory.buffer)